@@ -1,6 +1,10 @@
 
+import argparse
+import hashlib
+import importlib
 import psycopg2
 import os
+import sys
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -84,10 +88,13 @@ SQL_CREATE_TABLES = [
         image_url TEXT NOT NULL,
         featured BOOLEAN NULL DEFAULT false,
         review_count INTEGER NULL DEFAULT 0,
+        rating_sum INTEGER NULL DEFAULT 0,
+        rating_avg DOUBLE PRECISION NULL,
         ingredients TEXT[] NULL,
         category_id INTEGER NULL,
         stock INTEGER NULL DEFAULT 100,
         sku TEXT NOT NULL UNIQUE,
+        search_vector TSVECTOR NULL,
         created_at TIMESTAMP WITH TIME ZONE NULL DEFAULT now(),
         updated_at TIMESTAMP WITH TIME ZONE NULL DEFAULT now()
     );
@@ -174,6 +181,8 @@ SQL_CREATE_TABLES = [
         payment_status payment_status NULL DEFAULT 'pending',
         stripe_payment_intent_id TEXT NULL,
         notes TEXT NULL,
+        held_at TIMESTAMP WITH TIME ZONE NULL,
+        hold_reason TEXT NULL,
         created_at TIMESTAMP WITH TIME ZONE NULL DEFAULT now(),
         updated_at TIMESTAMP WITH TIME ZONE NULL DEFAULT now()
     );
@@ -200,6 +209,54 @@ SQL_CREATE_TABLES = [
         is_resolved BOOLEAN NULL DEFAULT false,
         created_at TIMESTAMP WITH TIME ZONE NULL DEFAULT now()
     );
+    """,
+    # Sales reporting summaries, one row per reporting day (and product,
+    # category or status pair), maintained by db_reporting.py. Products
+    # without a category are summarized under category_id 0.
+    """
+    CREATE TABLE IF NOT EXISTS sales_daily (
+        day DATE PRIMARY KEY,
+        order_count INTEGER NOT NULL,
+        customer_count INTEGER NOT NULL,
+        revenue DOUBLE PRECISION NOT NULL,
+        units INTEGER NOT NULL,
+        refreshed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sales_daily_product (
+        day DATE NOT NULL,
+        product_id INTEGER NOT NULL,
+        units INTEGER NOT NULL,
+        revenue DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (day, product_id)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sales_daily_category (
+        day DATE NOT NULL,
+        category_id INTEGER NOT NULL,
+        units INTEGER NOT NULL,
+        revenue DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (day, category_id)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sales_daily_status (
+        day DATE NOT NULL,
+        status order_status NOT NULL,
+        payment_status payment_status NOT NULL,
+        order_count INTEGER NOT NULL,
+        revenue DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (day, status, payment_status)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS reporting_watermarks (
+        name TEXT PRIMARY KEY,
+        watermark TIMESTAMP WITH TIME ZONE NOT NULL,
+        refreshed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+    );
     """
 ]
 
@@ -227,78 +284,850 @@ SQL_ADD_FOREIGN_KEYS = [
 SQL_CREATE_INDEXES = [
     "CREATE INDEX IF NOT EXISTS idx_products_featured ON products (featured) WHERE featured = true;",
     "CREATE INDEX IF NOT EXISTS idx_products_category ON products (category_id);",
-    "CREATE INDEX IF NOT EXISTS idx_products_name_search ON products USING gin (to_tsvector('english', name));",
+    # search_vector is added to older databases by migration 0002; see check_migrations().
+    "CREATE INDEX IF NOT EXISTS idx_products_search_vector ON products USING gin (search_vector);",
     "CREATE INDEX IF NOT EXISTS idx_orders_user ON orders (user_id);",
     "CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status);",
-    "CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders (created_at DESC);",
-    "CREATE INDEX IF NOT EXISTS idx_cart_items_cart ON cart_items (cart_id);"
+    # The boot diff builds indexes on tables that already hold rows with
+    # CREATE INDEX CONCURRENTLY after its transaction; see deferred_indexes().
+    #
+    # Keyset pagination of the admin listings and exports (db_listing.py),
+    # newest first or oldest first; on orders it also serves the created_at
+    # range scans idx_orders_created_at was declared for.
+    "CREATE INDEX IF NOT EXISTS idx_orders_created_id ON orders (created_at, id);",
+    "CREATE INDEX IF NOT EXISTS idx_users_created_id ON users (created_at, id);",
+    "CREATE INDEX IF NOT EXISTS idx_reviews_created_id ON reviews (created_at, id);",
+    "CREATE INDEX IF NOT EXISTS idx_enquiries_created_id ON enquiries (created_at, id);",
+    "CREATE INDEX IF NOT EXISTS idx_newsletter_subscriptions_created_id ON newsletter_subscriptions (created_at, id);",
+    # One cart per user and one line per product in a cart; add-to-cart
+    # upserts against these. Existing duplicates must be merged first
+    # (db_carts.py), and they also index the cart foreign keys. On tables
+    # that already hold rows the boot diff leaves them to 'carts dedup'.
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_carts_user_unique ON carts (user_id);",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_cart_items_cart_product ON cart_items (cart_id, product_id);",
+    # Foreign key columns, so that cascaded deletes and joins on them do not
+    # scan the referencing table.
+    "CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user_id);",
+    "CREATE INDEX IF NOT EXISTS idx_addresses_user ON addresses (user_id);",
+    "CREATE INDEX IF NOT EXISTS idx_wishlists_user ON wishlists (user_id);",
+    "CREATE INDEX IF NOT EXISTS idx_wishlists_product ON wishlists (product_id);",
+    "CREATE INDEX IF NOT EXISTS idx_reviews_user ON reviews (user_id);",
+    "CREATE INDEX IF NOT EXISTS idx_reviews_product ON reviews (product_id);",
+    "CREATE INDEX IF NOT EXISTS idx_cart_items_product ON cart_items (product_id);",
+    "CREATE INDEX IF NOT EXISTS idx_orders_shipping_address ON orders (shipping_address_id);",
+    "CREATE INDEX IF NOT EXISTS idx_orders_billing_address ON orders (billing_address_id);",
+    "CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items (order_id);",
+    "CREATE INDEX IF NOT EXISTS idx_order_items_product ON order_items (product_id);",
+    "CREATE INDEX IF NOT EXISTS idx_enquiries_user ON enquiries (user_id);",
+    # Change detection for the sales reporting refresh.
+    "CREATE INDEX IF NOT EXISTS idx_orders_updated_at ON orders (updated_at);",
+    "CREATE INDEX IF NOT EXISTS idx_order_items_created_at ON order_items (created_at);",
+    # Claim queue for the order workers.
+    "CREATE INDEX IF NOT EXISTS idx_orders_pending ON orders (created_at, id) WHERE status = 'pending';"
 ]
 
-def create_schema():
-    """Creates the complete database schema."""
-    conn = None
-    cursor = None
+# Range-partitioned orders and order_items (monthly, by created_at).
+# Partitioned tables need the partition key in every unique constraint, so the
+# primary keys become (id, created_at) and order_number is only unique per
+# created_at. No unique constraint can then cover orders.id alone, which is
+# why the partitioned profile drops fk_order_items_order: order rows and their
+# items share a month and are archived together by dropping partitions.
+# Monthly partitions are managed by db_partitions.py; the DEFAULT partitions
+# catch rows outside every managed range.
+SQL_CREATE_PARTITIONED_ORDERS = """
+    CREATE TABLE IF NOT EXISTS orders (
+        id SERIAL NOT NULL,
+        user_id INTEGER NOT NULL,
+        order_number TEXT NOT NULL,
+        status order_status NULL DEFAULT 'pending',
+        total DOUBLE PRECISION NOT NULL,
+        shipping_address_id INTEGER NOT NULL,
+        billing_address_id INTEGER NOT NULL,
+        payment_status payment_status NULL DEFAULT 'pending',
+        stripe_payment_intent_id TEXT NULL,
+        notes TEXT NULL,
+        held_at TIMESTAMP WITH TIME ZONE NULL,
+        hold_reason TEXT NULL,
+        created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+        updated_at TIMESTAMP WITH TIME ZONE NULL DEFAULT now(),
+        PRIMARY KEY (id, created_at),
+        UNIQUE (order_number, created_at)
+    ) PARTITION BY RANGE (created_at);
+"""
+
+SQL_CREATE_PARTITIONED_ORDER_ITEMS = """
+    CREATE TABLE IF NOT EXISTS order_items (
+        id SERIAL NOT NULL,
+        order_id INTEGER NOT NULL,
+        product_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        price DOUBLE PRECISION NOT NULL,
+        created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+        PRIMARY KEY (id, created_at)
+    ) PARTITION BY RANGE (created_at);
+"""
+
+# Session storage tuned for churn. Every login inserts a session and every
+# captcha refresh updates one; a low fillfactor leaves room on each page so
+# those updates stay HOT, and expired rows are purged by db_sessions.py.
+SESSION_STORAGE_OPTIONS = "fillfactor = 70, autovacuum_vacuum_scale_factor = 0.02"
+
+SQL_CREATE_TUNED_SESSIONS = f"""
+    CREATE TABLE IF NOT EXISTS sessions (
+        id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+        user_id INTEGER NOT NULL,
+        captcha_text TEXT NULL,
+        expires_at TIMESTAMP WITH TIME ZONE NOT NULL,
+        created_at TIMESTAMP WITH TIME ZONE NULL DEFAULT now()
+    ) WITH ({SESSION_STORAGE_OPTIONS});
+"""
+
+# Sessions are disposable, so skipping WAL is an option: an unlogged table
+# is truncated after a crash, which logs everyone out.
+SQL_CREATE_UNLOGGED_SESSIONS = f"""
+    CREATE UNLOGGED TABLE IF NOT EXISTS sessions (
+        id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+        user_id INTEGER NOT NULL,
+        captcha_text TEXT NULL,
+        expires_at TIMESTAMP WITH TIME ZONE NOT NULL,
+        created_at TIMESTAMP WITH TIME ZONE NULL DEFAULT now()
+    ) WITH ({SESSION_STORAGE_OPTIONS});
+"""
+
+# Daily partitions by expires_at let the purge drop whole expired days. The
+# partition key must be part of the primary key; ids are random UUIDs, so
+# uniqueness of id alone is not at risk.
+SQL_CREATE_PARTITIONED_SESSIONS = """
+    CREATE TABLE IF NOT EXISTS sessions (
+        id UUID NOT NULL DEFAULT gen_random_uuid(),
+        user_id INTEGER NOT NULL,
+        captcha_text TEXT NULL,
+        expires_at TIMESTAMP WITH TIME ZONE NOT NULL,
+        created_at TIMESTAMP WITH TIME ZONE NULL DEFAULT now(),
+        PRIMARY KEY (id, expires_at)
+    ) PARTITION BY RANGE (expires_at);
+"""
+
+SQL_CREATE_SESSIONS_EXPIRY_INDEX = "CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions (expires_at);"
+
+# Sharded stock with a reservation ledger, for products too hot for one row
+# lock. A sharded product's allocatable stock is split over stock_shards
+# rows; reserve_stock() takes units from whichever shard it can lock without
+# waiting, so concurrent checkouts of one product proceed in parallel, and
+# records them as 'held' reservations that expire. commit_stock() turns a
+# checkout's holds into 'committed' ones tied to its order, release_stock()
+# hands them back. db_stock.py releases expired holds and folds committed
+# reservations into products.stock, which stays the stock on hand, so that
+#     sum(available) = products.stock - held - committed but not yet folded.
+# Any other change to products.stock (a restock, or an order allocated by
+# db_orders.py without a reservation) is applied to the shards by a trigger.
+SQL_CREATE_STOCK_RESERVATION_STATUS = """
+    DO $$ BEGIN
+        CREATE TYPE stock_reservation_status AS ENUM ('held', 'committed', 'released');
+    EXCEPTION
+        WHEN duplicate_object THEN null;
+    END $$;
+"""
+
+SQL_CREATE_STOCK_SHARDS = """
+    CREATE TABLE IF NOT EXISTS stock_shards (
+        product_id INTEGER NOT NULL,
+        shard SMALLINT NOT NULL,
+        available INTEGER NOT NULL CHECK (available >= 0),
+        PRIMARY KEY (product_id, shard)
+    ) WITH (fillfactor = 50);
+"""
+
+SQL_CREATE_STOCK_RESERVATIONS = """
+    CREATE TABLE IF NOT EXISTS stock_reservations (
+        id BIGSERIAL PRIMARY KEY,
+        hold_key TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        shard SMALLINT NOT NULL,
+        quantity INTEGER NOT NULL CHECK (quantity > 0),
+        status stock_reservation_status NOT NULL DEFAULT 'held',
+        order_id INTEGER NULL,
+        expires_at TIMESTAMP WITH TIME ZONE NOT NULL,
+        folded_at TIMESTAMP WITH TIME ZONE NULL,
+        created_at TIMESTAMP WITH TIME ZONE NULL DEFAULT now(),
+        updated_at TIMESTAMP WITH TIME ZONE NULL DEFAULT now()
+    );
+"""
+
+SQL_CREATE_STOCK_FUNCTIONS = """
+    -- Reserves every (product, quantity) pair for hold_key, all or nothing.
+    -- Units come from the first shard with stock that no other transaction
+    -- holds, starting at a random shard; only when every such shard is busy
+    -- does it wait for one. Raises insufficient_resources when a product is
+    -- short, which rolls back the whole reservation.
+    CREATE OR REPLACE FUNCTION reserve_stock(p_hold_key TEXT, p_product_ids INTEGER[], p_quantities INTEGER[],
+                                             p_ttl INTERVAL DEFAULT '15 minutes')
+    RETURNS SETOF stock_reservations LANGUAGE plpgsql AS $$
+    DECLARE
+        item RECORD;
+        shard_count INTEGER;
+        start_shard INTEGER;
+        remaining INTEGER;
+        taken_shard SMALLINT;
+        taken INTEGER;
+        wait BOOLEAN;
+    BEGIN
+        FOR item IN
+            SELECT t.product_id, sum(t.quantity)::integer AS quantity
+            FROM unnest(p_product_ids, p_quantities) AS t(product_id, quantity)
+            GROUP BY t.product_id
+            ORDER BY t.product_id
+        LOOP
+            SELECT count(*) INTO shard_count FROM stock_shards WHERE product_id = item.product_id;
+            IF shard_count = 0 THEN
+                RAISE EXCEPTION 'product % has no stock shards', item.product_id USING ERRCODE = 'no_data_found';
+            END IF;
+            start_shard := floor(random() * shard_count);
+            remaining := item.quantity;
+            wait := false;
+            WHILE remaining > 0 LOOP
+                IF wait THEN
+                    UPDATE stock_shards s SET available = s.available - least(s.available, remaining)
+                    FROM (SELECT shard, available FROM stock_shards
+                          WHERE product_id = item.product_id AND available > 0
+                          ORDER BY (shard - start_shard + shard_count) % shard_count
+                          LIMIT 1 FOR NO KEY UPDATE) pick
+                    WHERE s.product_id = item.product_id AND s.shard = pick.shard
+                    RETURNING s.shard, least(pick.available, remaining) INTO taken_shard, taken;
+                ELSE
+                    UPDATE stock_shards s SET available = s.available - least(s.available, remaining)
+                    FROM (SELECT shard, available FROM stock_shards
+                          WHERE product_id = item.product_id AND available > 0
+                          ORDER BY (shard - start_shard + shard_count) % shard_count
+                          LIMIT 1 FOR NO KEY UPDATE SKIP LOCKED) pick
+                    WHERE s.product_id = item.product_id AND s.shard = pick.shard
+                    RETURNING s.shard, least(pick.available, remaining) INTO taken_shard, taken;
+                END IF;
+                IF NOT FOUND THEN
+                    IF wait THEN
+                        RAISE EXCEPTION 'insufficient stock for product %', item.product_id
+                            USING ERRCODE = 'insufficient_resources';
+                    END IF;
+                    wait := true;
+                    CONTINUE;
+                END IF;
+                remaining := remaining - taken;
+                RETURN QUERY
+                    INSERT INTO stock_reservations (hold_key, product_id, shard, quantity, expires_at)
+                    VALUES (p_hold_key, item.product_id, taken_shard, taken, now() + p_ttl)
+                    RETURNING *;
+            END LOOP;
+        END LOOP;
+    END $$;
+
+    -- Hands held units back to the shards they came from; returns the units.
+    CREATE OR REPLACE FUNCTION stock_return_reservations(p_ids BIGINT[])
+    RETURNS INTEGER LANGUAGE sql AS $$
+        WITH released AS (
+            UPDATE stock_reservations
+            SET status = 'released', updated_at = now()
+            WHERE id = ANY(p_ids) AND status = 'held'
+            RETURNING product_id, shard, quantity
+        ),
+        returned AS (
+            UPDATE stock_shards s
+            SET available = s.available + r.quantity
+            FROM (SELECT product_id, shard, sum(quantity)::integer AS quantity FROM released GROUP BY 1, 2) r
+            WHERE s.product_id = r.product_id AND s.shard = r.shard
+        )
+        SELECT coalesce(sum(quantity), 0)::integer FROM released;
+    $$;
+
+    CREATE OR REPLACE FUNCTION release_stock(p_hold_key TEXT)
+    RETURNS INTEGER LANGUAGE sql AS $$
+        SELECT stock_return_reservations(array(
+            SELECT id FROM stock_reservations WHERE hold_key = p_hold_key AND status = 'held'));
+    $$;
+
+    -- Commits hold_key's unexpired holds to an order and releases any
+    -- expired ones; returns the units committed.
+    CREATE OR REPLACE FUNCTION commit_stock(p_hold_key TEXT, p_order_id INTEGER)
+    RETURNS INTEGER LANGUAGE plpgsql AS $$
+    DECLARE
+        committed INTEGER;
+    BEGIN
+        WITH done AS (
+            UPDATE stock_reservations
+            SET status = 'committed', order_id = p_order_id, updated_at = now()
+            WHERE hold_key = p_hold_key AND status = 'held' AND expires_at > now()
+            RETURNING quantity
+        )
+        SELECT coalesce(sum(quantity), 0) INTO committed FROM done;
+        PERFORM release_stock(p_hold_key);
+        RETURN committed;
+    END $$;
+
+    CREATE OR REPLACE FUNCTION release_expired_stock(p_limit INTEGER DEFAULT 1000)
+    RETURNS INTEGER LANGUAGE sql AS $$
+        SELECT stock_return_reservations(array(
+            SELECT id FROM stock_reservations
+            WHERE status = 'held' AND expires_at <= now()
+            ORDER BY expires_at
+            LIMIT p_limit
+            FOR UPDATE SKIP LOCKED));
+    $$;
+
+    -- Applies a change of products.stock to the product's shards: increases
+    -- are spread evenly, decreases taken from the fullest shards first.
+    -- db_stock.py sets plenaire.stock_folding while it folds committed
+    -- reservations, which the shards already account for.
+    CREATE OR REPLACE FUNCTION stock_shards_follow_products() RETURNS trigger LANGUAGE plpgsql AS $$
+    DECLARE
+        delta INTEGER := coalesce(NEW.stock, 0) - coalesce(OLD.stock, 0);
+        shard_count INTEGER;
+        shard_row RECORD;
+    BEGIN
+        IF current_setting('plenaire.stock_folding', true) = 'on' THEN
+            RETURN NULL;
+        END IF;
+        SELECT count(*) INTO shard_count FROM stock_shards WHERE product_id = NEW.id;
+        IF shard_count = 0 THEN
+            RETURN NULL;
+        ELSIF delta > 0 THEN
+            UPDATE stock_shards
+            SET available = available + delta / shard_count + (shard < delta % shard_count)::integer
+            WHERE product_id = NEW.id;
+        ELSE
+            FOR shard_row IN
+                SELECT shard, available FROM stock_shards
+                WHERE product_id = NEW.id AND available > 0
+                ORDER BY available DESC, shard
+                FOR NO KEY UPDATE
+            LOOP
+                EXIT WHEN delta = 0;
+                UPDATE stock_shards SET available = available - least(available, -delta)
+                WHERE product_id = NEW.id AND shard = shard_row.shard;
+                delta := delta + least(shard_row.available, -delta);
+            END LOOP;
+        END IF;
+        RETURN NULL;
+    END $$;
+    CREATE OR REPLACE TRIGGER trg_products_stock_shards
+        AFTER UPDATE OF stock ON products
+        FOR EACH ROW WHEN (NEW.stock IS DISTINCT FROM OLD.stock)
+        EXECUTE FUNCTION stock_shards_follow_products();
+"""
+
+# Optional schema profiles, enabled with DATABASE_SCHEMA_PROFILES (a comma-
+# separated list of names). A profile replaces declared objects by name,
+# drops some, or adds new ones; entries are (kind, sql) pairs except "drop",
+# which lists (kind, name). Switching an existing database to a profile that
+# changes a table's layout needs that module's conversion command, since the
+# catalog diff only creates missing objects.
+SCHEMA_PROFILES = {
+    "partitioned_orders": {
+        "replace": [
+            ('table', SQL_CREATE_PARTITIONED_ORDERS),
+            ('table', SQL_CREATE_PARTITIONED_ORDER_ITEMS),
+        ],
+        "drop": [('foreign_key', 'fk_order_items_order')],
+        "add": [
+            ('table', "CREATE TABLE IF NOT EXISTS orders_default PARTITION OF orders DEFAULT;"),
+            ('table', "CREATE TABLE IF NOT EXISTS order_items_default PARTITION OF order_items DEFAULT;"),
+        ],
+    },
+    "session_storage": {
+        "replace": [('table', SQL_CREATE_TUNED_SESSIONS)],
+        "add": [('index', SQL_CREATE_SESSIONS_EXPIRY_INDEX)],
+    },
+    "sessions_unlogged": {
+        "replace": [('table', SQL_CREATE_UNLOGGED_SESSIONS)],
+        "add": [('index', SQL_CREATE_SESSIONS_EXPIRY_INDEX)],
+    },
+    "sessions_partitioned": {
+        "replace": [('table', SQL_CREATE_PARTITIONED_SESSIONS)],
+        "add": [
+            ('table', f"CREATE TABLE IF NOT EXISTS sessions_default PARTITION OF sessions DEFAULT WITH ({SESSION_STORAGE_OPTIONS});"),
+            ('index', SQL_CREATE_SESSIONS_EXPIRY_INDEX),
+        ],
+    },
+    "stock_ledger": {
+        "add": [
+            ('enum', SQL_CREATE_STOCK_RESERVATION_STATUS),
+            ('table', SQL_CREATE_STOCK_SHARDS),
+            ('table', SQL_CREATE_STOCK_RESERVATIONS),
+            ('foreign_key', "ALTER TABLE stock_shards ADD CONSTRAINT fk_stock_shards_product FOREIGN KEY (product_id) REFERENCES products (id) ON DELETE CASCADE;"),
+            ('foreign_key', "ALTER TABLE stock_reservations ADD CONSTRAINT fk_stock_reservations_product FOREIGN KEY (product_id) REFERENCES products (id) ON DELETE CASCADE;"),
+            ('trigger', SQL_CREATE_STOCK_FUNCTIONS),
+            ('index', "CREATE INDEX IF NOT EXISTS idx_stock_reservations_hold ON stock_reservations (hold_key) WHERE status = 'held';"),
+            ('index', "CREATE INDEX IF NOT EXISTS idx_stock_reservations_expiry ON stock_reservations (expires_at) WHERE status = 'held';"),
+            ('index', "CREATE INDEX IF NOT EXISTS idx_stock_reservations_unfolded ON stock_reservations (product_id) WHERE status = 'committed' AND folded_at IS NULL;"),
+            ('index', "CREATE INDEX IF NOT EXISTS idx_stock_reservations_order ON stock_reservations (order_id, product_id) WHERE status = 'committed';"),
+        ],
+    },
+}
+
+ACTIVE_PROFILES = [name.strip() for name in os.getenv("DATABASE_SCHEMA_PROFILES", "").split(",") if name.strip()]
+
+# Functions and the triggers that call them. Each entry defines its function
+# with CREATE OR REPLACE and then creates one trigger, which names the entry.
+SQL_CREATE_TRIGGERS = [
+    # Weighted full-text document for product search: name (A), description
+    # (B) and ingredients (C). Kept in a stored column rather than a generated
+    # one so that existing rows can be backfilled in batches without a table
+    # rewrite (see db_search.py).
+    """
+    CREATE OR REPLACE FUNCTION products_search_document(name TEXT, description TEXT, ingredients TEXT[])
+    RETURNS TSVECTOR LANGUAGE sql IMMUTABLE AS $$
+        SELECT setweight(to_tsvector('english', coalesce(name, '')), 'A')
+            || setweight(to_tsvector('english', coalesce(description, '')), 'B')
+            || setweight(to_tsvector('english', coalesce(array_to_string(ingredients, ' '), '')), 'C');
+    $$;
+    CREATE OR REPLACE FUNCTION products_search_vector_update() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        NEW.search_vector := products_search_document(NEW.name, NEW.description, NEW.ingredients);
+        RETURN NEW;
+    END $$;
+    CREATE OR REPLACE TRIGGER trg_products_search_vector
+        BEFORE INSERT OR UPDATE OF name, description, ingredients ON products
+        FOR EACH ROW EXECUTE FUNCTION products_search_vector_update();
+    """,
+    # Review aggregates on products, adjusted by the delta of each review
+    # change. The products row lock serializes concurrent reviews of the same
+    # product; rows that predate the trigger are fixed up by db_reviews.py.
+    # rating_sum comes from migration 0003 on older databases; see
+    # check_migrations().
+    """
+    CREATE OR REPLACE FUNCTION reviews_aggregate_apply(target INTEGER, count_delta INTEGER, sum_delta INTEGER)
+    RETURNS void LANGUAGE sql AS $$
+        UPDATE products
+        SET review_count = coalesce(review_count, 0) + count_delta,
+            rating_sum = coalesce(rating_sum, 0) + sum_delta,
+            rating_avg = (coalesce(rating_sum, 0) + sum_delta)::double precision
+                         / nullif(coalesce(review_count, 0) + count_delta, 0)
+        WHERE id = target;
+    $$;
+    CREATE OR REPLACE FUNCTION reviews_aggregate_update() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            PERFORM reviews_aggregate_apply(NEW.product_id, 1, NEW.rating);
+        ELSIF TG_OP = 'DELETE' THEN
+            PERFORM reviews_aggregate_apply(OLD.product_id, -1, -OLD.rating);
+        ELSIF NEW.product_id = OLD.product_id THEN
+            IF NEW.rating <> OLD.rating THEN
+                PERFORM reviews_aggregate_apply(NEW.product_id, 0, NEW.rating - OLD.rating);
+            END IF;
+        ELSE
+            PERFORM reviews_aggregate_apply(OLD.product_id, -1, -OLD.rating);
+            PERFORM reviews_aggregate_apply(NEW.product_id, 1, NEW.rating);
+        END IF;
+        RETURN NULL;
+    END $$;
+    CREATE OR REPLACE TRIGGER trg_reviews_aggregate
+        AFTER INSERT OR DELETE OR UPDATE OF product_id, rating ON reviews
+        FOR EACH ROW EXECUTE FUNCTION reviews_aggregate_update();
+    """,
+    # Wakes the order workers (db_orders.py) listening on orders_pending.
+    # Statement level, so a bulk insert sends one notification; NOTIFY is
+    # delivered on commit, when the order's items are visible too.
+    """
+    CREATE OR REPLACE FUNCTION orders_notify_pending() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM pg_notify('orders_pending', '');
+        RETURN NULL;
+    END $$;
+    CREATE OR REPLACE TRIGGER trg_orders_notify_pending
+        AFTER INSERT ON orders
+        FOR EACH STATEMENT EXECUTE FUNCTION orders_notify_pending();
+    """
+]
+
+# Catalog lookups used to work out which declared objects already exist.
+# A single round trip covers enums (pg_type), tables (pg_class), foreign keys
+# (pg_constraint), indexes (pg_index) and triggers (pg_trigger) in the
+# current schema.
+SQL_CATALOG_SNAPSHOT = """
+    SELECT 'enum', t.typname
+    FROM pg_type t
+    JOIN pg_namespace n ON n.oid = t.typnamespace
+    WHERE t.typtype = 'e' AND n.nspname = current_schema()
+    UNION ALL
+    SELECT 'table', c.relname
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relkind IN ('r', 'p') AND n.nspname = current_schema()
+    UNION ALL
+    SELECT 'foreign_key', con.conname
+    FROM pg_constraint con
+    JOIN pg_namespace n ON n.oid = con.connamespace
+    WHERE con.contype = 'f' AND n.nspname = current_schema()
+    UNION ALL
+    SELECT 'index', c.relname
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = current_schema()
+    UNION ALL
+    SELECT 'trigger', tg.tgname
+    FROM pg_trigger tg
+    JOIN pg_class c ON c.oid = tg.tgrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE NOT tg.tgisinternal AND n.nspname = current_schema();
+"""
+
+def enum_name(sql):
+    """Returns the type name declared by an entry of SQL_CREATE_ENUMS."""
+    return sql.split('CREATE TYPE ')[1].split(' ')[0]
+
+def table_name(sql):
+    """Returns the table name declared by an entry of SQL_CREATE_TABLES."""
+    return sql.split('TABLE IF NOT EXISTS')[1].split('(')[0].split()[0]
+
+def constraint_name(sql):
+    """Returns the constraint name declared by an entry of SQL_ADD_FOREIGN_KEYS."""
+    return sql.split("ADD CONSTRAINT ")[1].split(" ")[0]
+
+def index_name(sql):
+    """Returns the index name declared by an entry of SQL_CREATE_INDEXES."""
+    return sql.split('INDEX IF NOT EXISTS ')[1].split(' ')[0]
+
+def index_table(sql):
+    """Returns the table a declared CREATE INDEX statement targets."""
+    return sql.split(" ON ")[1].split()[0]
+
+def trigger_name(sql):
+    """Returns the trigger name declared by an entry of SQL_CREATE_TRIGGERS."""
+    return sql.split('CREATE OR REPLACE TRIGGER ')[1].split()[0]
+
+def trigger_table(sql):
+    """Returns the table an entry of SQL_CREATE_TRIGGERS attaches its trigger to."""
+    return sql.split('CREATE OR REPLACE TRIGGER ')[1].split(' ON ')[1].split()[0]
+
+DECLARED_KINDS = [
+    ('enum', enum_name, SQL_CREATE_ENUMS),
+    ('table', table_name, SQL_CREATE_TABLES),
+    ('foreign_key', constraint_name, SQL_ADD_FOREIGN_KEYS),
+    ('trigger', trigger_name, SQL_CREATE_TRIGGERS),
+    ('index', index_name, SQL_CREATE_INDEXES),
+]
+
+def declared_objects(profiles=None):
+    """Lists every declared schema object as (kind, name, sql), in apply order.
+
+    Enabled schema profiles are applied on top of the declared lists.
+    """
+    profiles = ACTIVE_PROFILES if profiles is None else profiles
+    objects = []
+    for kind, parser, statements in DECLARED_KINDS:
+        entries = [(kind, parser(sql), sql) for sql in statements]
+        for profile in profiles:
+            spec = SCHEMA_PROFILES[profile]
+            replaced = {parser(sql): sql for k, sql in spec.get("replace", []) if k == kind}
+            dropped = {name for k, name in spec.get("drop", []) if k == kind}
+            entries = [(k, name, replaced.get(name, sql)) for k, name, sql in entries if name not in dropped]
+            present = {name for _k, name, _sql in entries}
+            entries += [(kind, parser(sql), sql) for k, sql in spec.get("add", []) if k == kind and parser(sql) not in present]
+        objects += entries
+    return objects
+
+# Metadata table recording the fingerprint of the last applied schema, so
+# that a boot against an up-to-date database costs one primary-key lookup.
+SQL_CREATE_METADATA_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_metadata (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        updated_at TIMESTAMP WITH TIME ZONE NULL DEFAULT now()
+    );
+"""
+
+SQL_FINGERPRINT_LOOKUP = "SELECT 1 FROM schema_metadata WHERE key = 'schema_fingerprint' AND value = %s;"
+
+SQL_FINGERPRINT_STORE = """
+    INSERT INTO schema_metadata (key, value, updated_at)
+    VALUES ('schema_fingerprint', %s, now())
+    ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at;
+"""
+
+# Serializes concurrent appliers (e.g. several pods booting at once) so they
+# do not race on the same CREATE statements.
+SQL_SCHEMA_LOCK = "SELECT pg_advisory_xact_lock(hashtext('plenaire_schema'));"
+
+# Unique indexes that rows written before them may violate. 'carts dedup'
+# (db_carts.py) merges the duplicates and builds them concurrently.
+DEDUP_INDEXES = ("idx_carts_user_unique", "idx_cart_items_cart_product")
+
+def schema_fingerprint():
+    """Returns a SHA-256 hash of every declared DDL statement."""
+    digest = hashlib.sha256()
+    for _kind, _name, sql in declared_objects():
+        digest.update(" ".join(sql.split()).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def fetch_catalog(cursor, lock=False):
+    """Returns the set of (kind, name) pairs present in the live database.
+
+    With lock=True the schema advisory lock is taken in the same round trip.
+    """
+    cursor.execute((SQL_SCHEMA_LOCK if lock else "") + SQL_CATALOG_SNAPSHOT)
+    return set(cursor.fetchall())
+
+def missing_objects(cursor, lock=False, kinds=None):
+    """Returns the declared objects that do not exist yet, in apply order.
+
+    kinds optionally restricts the result to some object kinds.
+    """
+    existing = fetch_catalog(cursor, lock=lock)
+    return [
+        obj for obj in declared_objects()
+        if obj[:2] not in existing and (kinds is None or obj[0] in kinds)
+    ]
+
+def populated_tables(cursor, tables):
+    """Returns the tables among tables that exist and hold at least one row."""
+    populated = set()
+    for table in sorted(set(tables)):
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (table,))
+        if cursor.fetchone()[0]:
+            cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {table});")
+            if cursor.fetchone()[0]:
+                populated.add(table)
+    return populated
+
+def deferred_indexes(cursor, missing):
+    """Returns the missing indexes the boot transaction must not build.
+
+    A plain CREATE INDEX blocks writes to its table for the whole build, so
+    indexes on tables that hold rows are built concurrently after the
+    transaction (build_deferred()). A DEDUP_INDEXES build also fails on
+    duplicate rows; those are left to 'carts dedup'.
+    """
+    candidates = [obj for obj in missing if obj[0] == 'index']
+    populated = populated_tables(cursor, [index_table(sql) for _kind, _name, sql in candidates])
+    return [obj for obj in candidates if index_table(obj[2]) in populated]
+
+def build_deferred(conn, cursor, deferred, config):
+    """Builds deferred indexes concurrently, then records the fingerprint once all exist."""
+    statements = [sql for _kind, name, sql in deferred if name not in DEDUP_INDEXES]
+    if statements:
+        # Imported here because db_indexes imports this module.
+        importlib.import_module("db_indexes").build_indexes(progress_interval=0, statements=statements, config=config)
+    if len(statements) == len(deferred):
+        cursor.execute(SQL_FINGERPRINT_STORE, (schema_fingerprint(),))
+        conn.commit()
+
+def fingerprint_matches(conn, cursor, fingerprint):
+    """Checks the stored fingerprint with a single indexed lookup."""
     try:
-        print(f"Connecting to database '{DB_CONFIG['database']}' on {DB_CONFIG['host']}...")
-        conn = psycopg2.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-        print("Connection successful.")
+        cursor.execute(SQL_FINGERPRINT_LOOKUP, (fingerprint,))
+        return cursor.fetchone() is not None
+    except psycopg2.Error as e:
+        if e.pgcode == '42P01':
+            # schema_metadata does not exist yet: a fresh database.
+            conn.rollback()
+            return False
+        raise
+
+def build_batch(cursor, statements, fingerprint=None):
+    """Joins statements and the fingerprint upsert into one multi-statement string."""
+    parts = [sql.strip() for sql in statements]
+    parts.append(SQL_CREATE_METADATA_TABLE.strip())
+    if fingerprint:
+        parts.append(cursor.mogrify(SQL_FINGERPRINT_STORE, (fingerprint,)).decode("utf-8").strip())
+    return "\n".join(part if part.endswith(";") else part + ";" for part in parts)
+
+def check_migrations(cursor):
+    """Returns the pending migrations of a fresh database; raises when an existing one needs them.
+
+    Declared objects can depend on columns that a migration adds to older
+    databases (idx_products_search_vector on search_vector, the review
+    aggregate trigger on rating_sum), so such a database must be migrated
+    before its catalogs are diffed. A fresh database gets those columns from
+    SQL_CREATE_TABLES, and its pending migrations are only recorded.
+    """
+    # Imported here because db_migrations imports this module.
+    migrations = importlib.import_module("db_migrations")
+    pending = migrations.pending_migrations(migrations.fetch_history(cursor))
+    tables = sorted({migrations.step_table(sql) for m in pending for sql in m["steps"]} - {None})
+    if tables:
+        cursor.execute("SELECT t FROM unnest(%s::text[]) t WHERE to_regclass(t) IS NOT NULL;", (tables,))
+        if cursor.fetchall():
+            names = ", ".join(f"{m['version']:04d} {m['name']}" for m in pending)
+            raise RuntimeError(f"This database has pending migrations ({names}); "
+                               f"run 'python create_db_updated.py migrate' first.")
+    return pending
+
+def record_migrations(cursor, pending):
+    """Records the migrations a fresh database did not need as applied."""
+    if not pending:
+        return
+    migrations = importlib.import_module("db_migrations")
+    cursor.execute(migrations.SQL_CREATE_HISTORY_TABLE)
+    for migration in pending:
+        cursor.execute(migrations.SQL_RECORD_SKIPPED_MIGRATION, (
+            migration["version"], migration["name"], migrations.migration_checksum(migration),
+        ))
+
+def apply_catalog_diff(conn, cursor, kinds=None):
+    """Applies only the missing declared objects, in a single transaction and round trip.
 
-        # Create Enumerated Types
-        print("\nCreating enumerated types...")
-        for sql in SQL_CREATE_ENUMS:
-            print(f"Executing: {sql.strip()[:100]}...")
+    Returns the indexes deferred to a concurrent build (deferred_indexes()).
+    The schema fingerprint is only recorded when every kind is applied and
+    no index was deferred, and only then are pending migrations checked
+    (migrate() applies single kinds around its migrations). The schema lock
+    is taken first, so that a concurrent apply has committed its migration
+    history before it is read. A full diff also re-runs the trigger entries
+    that exist: they are CREATE OR REPLACE, and the catalogs only show that
+    a function exists, not whether its body is the declared one.
+    """
+    cursor.execute(SQL_SCHEMA_LOCK)
+    pending = check_migrations(cursor) if kinds is None else []
+    print("\nReading system catalogs...")
+    missing = missing_objects(cursor, kinds=kinds)
+    deferred = deferred_indexes(cursor, missing) if kinds is None else []
+    missing = [obj for obj in missing if obj not in deferred]
+    replaced = [obj for obj in declared_objects() if obj[0] == 'trigger' and obj not in missing] if kinds is None else []
+    if missing:
+        print(f"{len(missing)} of {len(declared_objects())} declared objects are missing.")
+        for kind, name, _sql in missing:
+            print(f"Creating {kind.replace('_', ' ')}: {name}")
+    elif not deferred:
+        print("No declared objects are missing.")
+    if replaced:
+        print(f"Replacing {len(replaced)} existing trigger function(s).")
+    for _kind, name, sql in deferred:
+        if name in DEDUP_INDEXES:
+            print(f"Skipping index {name}: {index_table(sql)} may hold duplicates; "
+                  f"run 'python create_db_updated.py carts dedup' to merge them and build it.")
+        else:
+            print(f"Deferring index {name}: {index_table(sql)} holds rows, building it concurrently after commit.")
+    fingerprint = schema_fingerprint() if kinds is None and not deferred else None
+    statements = [obj[2] for obj in declared_objects() if obj in missing or obj in replaced]
+    if getattr(cursor, "recorder", None) is not None:
+        # Instrumented runs send one statement per round trip, still in one
+        # transaction, so that each is timed on its own.
+        for sql in statements:
             cursor.execute(sql)
-        conn.commit()
-        print("Enumerated types created (or already exist).")
+        cursor.execute(SQL_CREATE_METADATA_TABLE)
+        if fingerprint:
+            cursor.execute(SQL_FINGERPRINT_STORE, (fingerprint,))
+    else:
+        cursor.execute(build_batch(cursor, statements, fingerprint))
+    record_migrations(cursor, pending)
+    return deferred
+
+def apply_fingerprint(conn, cursor):
+    """Skips all work when the stored fingerprint matches the declared schema."""
+    fingerprint = schema_fingerprint()
+    if fingerprint_matches(conn, cursor, fingerprint):
+        print(f"\nSchema fingerprint {fingerprint[:12]} matches, nothing to apply.")
+        return []
+    print(f"\nSchema fingerprint {fingerprint[:12]} not recorded, diffing catalogs.")
+    return apply_catalog_diff(conn, cursor)
+
+def apply_statements(conn, cursor):
+    """Runs every declared statement, relying on duplicate errors to skip existing objects."""
+    objects = declared_objects()
+    pending = check_migrations(cursor)
+
+    def of_kind(kind):
+        return [(name, sql) for k, name, sql in objects if k == kind]
+
+    # Create Enumerated Types
+    print("\nCreating enumerated types...")
+    for _name, sql in of_kind('enum'):
+        print(f"Executing: {sql.strip()[:100]}...")
+        cursor.execute(sql)
+    conn.commit()
+    print("Enumerated types created (or already exist).")
+
+    # Create Tables
+    print("\nCreating tables...")
+    for name, sql in of_kind('table'):
+        print(f"Creating table: {name}")
+        cursor.execute(sql)
+    print("Tables created (or already exist).")
 
-        # Create Tables
-        print("\nCreating tables...")
-        for sql in SQL_CREATE_TABLES:
-            table_name = sql.split('CREATE TABLE IF NOT EXISTS')[1].split('(')[0].strip()
-            print(f"Creating table: {table_name}")
+    # Add Foreign Key Constraints
+    print("\nAdding foreign key constraints...")
+    for name, sql in of_kind('foreign_key'):
+        try:
+            print(f"Adding constraint: {name}")
             cursor.execute(sql)
-        print("Tables created (or already exist).")
-
-        # Add Foreign Key Constraints
-        print("\nAdding foreign key constraints...")
-        for sql in SQL_ADD_FOREIGN_KEYS:
-            constraint_name = sql.split("ADD CONSTRAINT ")[1].split(" ")[0]
-            try:
-                print(f"Adding constraint: {constraint_name}")
-                cursor.execute(sql)
-            except psycopg2.Error as e:
-                if e.pgcode in ('42P07', '42710'):
-                    print(f"Constraint {constraint_name} already exists, skipping.")
-                    conn.rollback()
-                else:
-                    raise
-        print("Foreign key constraints added (or already exist).")
-
-        # Create Indexes
-        print("\nCreating indexes...")
-        for sql in SQL_CREATE_INDEXES:
-            index_name = sql.split('CREATE INDEX IF NOT EXISTS ')[1].split(' ')[0]
-            try:
-                print(f"Creating index: {index_name}")
-                cursor.execute(sql)
-            except psycopg2.Error as e:
-                if e.pgcode == '42P07':
-                    print(f"Index {index_name} already exists, skipping.")
-                    conn.rollback()
-                else:
-                    raise
-        print("Indexes created (or already exist).")
+        except psycopg2.Error as e:
+            if e.pgcode in ('42P07', '42710'):
+                print(f"Constraint {name} already exists, skipping.")
+                conn.rollback()
+            else:
+                raise
+    print("Foreign key constraints added (or already exist).")
+
+    # Create Functions and Triggers
+    print("\nCreating triggers...")
+    for name, sql in of_kind('trigger'):
+        print(f"Creating trigger: {name}")
+        cursor.execute(sql)
+    print("Triggers created (or replaced).")
+
+    # Create Indexes
+    print("\nCreating indexes...")
+    for name, sql in of_kind('index'):
+        try:
+            print(f"Creating index: {name}")
+            cursor.execute(sql)
+        except psycopg2.Error as e:
+            if e.pgcode == '42P07':
+                print(f"Index {name} already exists, skipping.")
+                conn.rollback()
+            else:
+                raise
+    print("Indexes created (or already exist).")
+    record_migrations(cursor, pending)
+
+APPLY_MODES = {
+    "fingerprint": apply_fingerprint,
+    "diff": apply_catalog_diff,
+    "statements": apply_statements,
+}
+
+def create_schema(mode="fingerprint", config=None, recorder=None):
+    """Creates the complete database schema.
+
+    mode="fingerprint" returns after one lookup when the stored schema
+    fingerprint matches and otherwise falls through to "diff". mode="diff"
+    reads the system catalogs once and applies only the missing objects in
+    one transaction, except indexes on tables that already hold rows, which
+    are built concurrently once it commits; mode="statements" runs every
+    statement and skips the ones that fail as duplicates. config holds
+    connection parameters and defaults to DB_CONFIG. A
+    db_instrument.StatementRecorder passed as recorder records every
+    statement the run executes.
+    """
+    config = DB_CONFIG if config is None else config
+    conn = None
+    cursor = None
+    try:
+        print(f"Connecting to database '{config.get('database')}' on {config.get('host')}...")
+        conn = psycopg2.connect(**config)
+        if recorder is not None:
+            cursor = recorder.cursor(conn)
+            recorder.start(config, conn, mode)
+        else:
+            cursor = conn.cursor()
+        print("Connection successful.")
+
+        deferred = APPLY_MODES[mode](conn, cursor) or []
 
         # Commit all changes
         conn.commit()
+        if deferred:
+            build_deferred(conn, cursor, deferred, config)
         print("\nSchema creation completed successfully.")
+        if recorder is not None:
+            recorder.finish("ok")
 
     except psycopg2.Error as e:
         print(f"\nDatabase error: {e}")
         if conn:
             conn.rollback()
         print("Schema creation failed. Changes rolled back.")
+        if recorder is not None and conn:
+            recorder.finish("failed", e)
         raise
 
     except Exception as e:
@@ -306,6 +1135,8 @@ def create_schema():
         if conn:
             conn.rollback()
         print("Schema creation failed. Changes rolled back.")
+        if recorder is not None and conn:
+            recorder.finish("failed", e)
         raise
 
     finally:
@@ -315,5 +1146,73 @@ def create_schema():
             conn.close()
         print("Database connection closed.")
 
+# Subcommands implemented in sibling modules, imported only when used.
+SUBCOMMANDS = {
+    "migrate": "db_migrations",
+    "indexes": "db_indexes",
+    "advisor": "db_advisor",
+    "search": "db_search",
+    "reviews": "db_reviews",
+    "seed": "db_seed",
+    "bench": "db_benchmark",
+    "load": "db_load",
+    "partitions": "db_partitions",
+    "orders": "db_orders",
+    "reporting": "db_reporting",
+    "sessions": "db_sessions",
+    "carts": "db_carts",
+    "archive": "db_archive",
+    "layout": "db_layout",
+    "listing": "db_listing",
+    "rollout": "db_rollout",
+    "health": "db_health",
+    "replica": "db_replica",
+    "newsletter": "db_newsletter",
+    "stock": "db_stock",
+    "testdb": "db_testdb",
+}
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in SUBCOMMANDS:
+        importlib.import_module(SUBCOMMANDS[argv[0]]).main(argv[1:])
+        return
+
+    parser = argparse.ArgumentParser(
+        description="Create the Plenaire e-commerce database schema.",
+        epilog=f"subcommands: {', '.join(SUBCOMMANDS)} (run '<subcommand> --help' for details)",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=sorted(APPLY_MODES),
+        default="fingerprint",
+        help="fingerprint: skip everything when the stored schema hash matches (default); "
+             "diff: apply only objects missing from the catalogs; "
+             "statements: run every statement and skip duplicates",
+    )
+    parser.add_argument("--report", help="write a JSON report of every statement's timing and lock waits")
+    parser.add_argument("--metrics", help="write the run as a Prometheus textfile (e.g. for node_exporter)")
+    args = parser.parse_args(argv)
+    if not (args.report or args.metrics):
+        create_schema(mode=args.mode)
+        return
+
+    from db_instrument import StatementRecorder
+    recorder = StatementRecorder(declared_objects())
+    try:
+        create_schema(mode=args.mode, recorder=recorder)
+    finally:
+        if recorder.run.get("outcome"):
+            summary = recorder.summary()
+            print(f"\n{summary['statements']} statements, {summary['lock_wait_s']:.2f}s waiting on locks. Slowest:")
+            for r in recorder.slowest():
+                print(f"  {r['wall_s']:8.3f}s  lock wait {r['lock_wait_s']:6.2f}s  {r['outcome']:<7} {r['kind']} {r['name']}")
+            if args.report:
+                recorder.write_report(args.report)
+                print(f"Report written to {args.report}")
+            if args.metrics:
+                recorder.write_metrics(args.metrics)
+                print(f"Metrics written to {args.metrics}")
+
 if __name__ == "__main__":
-    create_schema()
+    main()
@@ -0,0 +1,311 @@
+
+import argparse
+import json
+import re
+import sys
+import psycopg2
+
+from create_db_updated import DB_CONFIG
+
+# Index advisor.
+#
+# 1. Foreign key coverage: every FK whose columns are not the leading columns
+#    of a valid, non-partial index makes cascaded deletes and joins on it scan
+#    the referencing table.
+# 2. Workload: reads pg_stat_statements (or a captured query log), extracts
+#    the equality, range and ORDER BY columns each statement uses per table,
+#    and proposes composite or partial indexes that are not already covered,
+#    ranked by an estimate of the execution time spent in sequential scans.
+
+SQL_UNINDEXED_FOREIGN_KEYS = """
+    SELECT con.conname,
+           con.conrelid::regclass::text,
+           array_agg(a.attname ORDER BY k.ord)
+    FROM pg_constraint con
+    JOIN pg_namespace n ON n.oid = con.connamespace
+    CROSS JOIN LATERAL unnest(con.conkey) WITH ORDINALITY AS k(attnum, ord)
+    JOIN pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = k.attnum
+    WHERE con.contype = 'f'
+      AND n.nspname = current_schema()
+      AND NOT EXISTS (
+          SELECT 1
+          FROM pg_index i
+          WHERE i.indrelid = con.conrelid
+            AND i.indisvalid
+            AND i.indpred IS NULL
+            AND (i.indkey::int2[])[0:cardinality(con.conkey) - 1] @> con.conkey
+            AND (i.indkey::int2[])[0:cardinality(con.conkey) - 1] <@ con.conkey
+      )
+    GROUP BY con.conname, con.conrelid
+    ORDER BY 2, 1;
+"""
+
+# Leading columns of every valid index, used to skip candidates that an
+# existing index already serves.
+SQL_INDEX_PREFIXES = """
+    SELECT t.relname, i.indpred IS NOT NULL,
+           array_agg(a.attname ORDER BY k.ord)
+    FROM pg_index i
+    JOIN pg_class t ON t.oid = i.indrelid
+    JOIN pg_namespace n ON n.oid = t.relnamespace
+    CROSS JOIN LATERAL unnest(i.indkey::int2[]) WITH ORDINALITY AS k(attnum, ord)
+    LEFT JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+    WHERE n.nspname = current_schema() AND i.indisvalid
+    GROUP BY i.indexrelid, t.relname, i.indpred;
+"""
+
+SQL_STATEMENT_STATS = """
+    SELECT query, calls, total_exec_time
+    FROM pg_stat_statements
+    WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+      AND query ~* '^\\s*(select|update|delete)'
+    ORDER BY total_exec_time DESC
+    LIMIT %s;
+"""
+
+IDENTIFIER = r'"?([A-Za-z_][A-Za-z0-9_]*)"?'
+COLUMN_REF = rf'(?:{IDENTIFIER}\s*\.\s*)?{IDENTIFIER}'
+VALUE = r"(\$\d+|'(?:[^']|'')*'|-?\d+(?:\.\d+)?|true|false|null)"
+
+TABLE_RE = re.compile(rf'\b(?:from|join|update|delete\s+from)\s+{IDENTIFIER}(?:\s+(?:as\s+)?{IDENTIFIER})?', re.IGNORECASE)
+PREDICATE_RE = re.compile(rf'{COLUMN_REF}\s*(=|<>|!=|<=|>=|<|>|\bin\b|\bis\b|\bbetween\b)\s*\(?\s*{VALUE}', re.IGNORECASE)
+ORDER_BY_RE = re.compile(r'\border\s+by\s+(.+?)(?:\blimit\b|\boffset\b|\bfor\b|$)', re.IGNORECASE | re.DOTALL)
+LOG_LINE_RE = re.compile(r'duration:\s*([\d.]+)\s*ms\s+(?:statement|execute[^:]*):\s*(.*)', re.IGNORECASE)
+
+# Words TABLE_RE can capture as an alias that are really the next keyword.
+SQL_KEYWORDS = {
+    "where", "on", "join", "left", "right", "inner", "outer", "full", "cross", "group", "order",
+    "limit", "offset", "set", "using", "returning", "lateral", "natural", "for", "union", "having",
+}
+
+def unindexed_foreign_keys(cursor):
+    """Returns (constraint, table, columns) for every FK without a covering index."""
+    cursor.execute(SQL_UNINDEXED_FOREIGN_KEYS)
+    return cursor.fetchall()
+
+def foreign_key_index_sql(table, columns):
+    """Returns the CREATE INDEX statement covering an FK."""
+    name = f"idx_{table}_{'_'.join(c.removesuffix('_id') for c in columns)}"
+    return f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({', '.join(columns)});"
+
+def index_prefixes(cursor):
+    """Returns {table: [leading column lists of non-partial indexes]}."""
+    cursor.execute(SQL_INDEX_PREFIXES)
+    prefixes = {}
+    for table, partial, columns in cursor.fetchall():
+        if not partial:
+            prefixes.setdefault(table, []).append([c for c in columns if c])
+    return prefixes
+
+def load_statement_stats(cursor, limit):
+    """Returns (query, calls, total_ms) from pg_stat_statements, or None when unavailable."""
+    try:
+        cursor.execute(SQL_STATEMENT_STATS, (limit,))
+        return cursor.fetchall()
+    except psycopg2.Error as e:
+        print(f"pg_stat_statements is not available: {str(e).splitlines()[0]}")
+        return None
+
+def load_query_log(path):
+    """Aggregates a captured query log into (query, calls, total_ms).
+
+    Lines in PostgreSQL's log_min_duration_statement format ("duration: 1.2 ms
+    statement: ...") contribute their duration; any other file is read as
+    semicolon-separated statements counting one call and 1 ms each.
+    """
+    stats = {}
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    matches = LOG_LINE_RE.findall(text)
+    if matches:
+        entries = [(float(ms), query) for ms, query in matches]
+    else:
+        entries = [(1.0, query) for query in text.split(";") if query.strip()]
+    for ms, query in entries:
+        key = " ".join(query.split()).rstrip(";")
+        calls, total = stats.get(key, (0, 0.0))
+        stats[key] = (calls + 1, total + ms)
+    return sorted(((q, c, t) for q, (c, t) in stats.items()), key=lambda row: -row[2])
+
+def extract_access_patterns(query):
+    """Returns {table: {"eq": [...], "range": [...], "order": [...], "filters": [...]}}.
+
+    "filters" collects column = 'literal' and column = true/false predicates,
+    which are candidates for a partial index predicate rather than an index
+    column.
+    """
+    aliases = {}
+    tables = []
+    for table, alias in TABLE_RE.findall(query):
+        if table.lower() in SQL_KEYWORDS:
+            continue
+        tables.append(table)
+        aliases[table] = table
+        if alias and alias.lower() not in SQL_KEYWORDS:
+            aliases[alias] = table
+
+    def resolve(qualifier):
+        if qualifier:
+            return aliases.get(qualifier)
+        return tables[0] if len(set(tables)) == 1 else None
+
+    patterns = {}
+    def entry(table):
+        return patterns.setdefault(table, {"eq": [], "range": [], "order": [], "filters": []})
+
+    where = re.split(r'\bwhere\b', query, maxsplit=1, flags=re.IGNORECASE)
+    predicates = where[1] if len(where) > 1 else ""
+    for qualifier, column, op, value in PREDICATE_RE.findall(predicates):
+        table = resolve(qualifier)
+        if not table:
+            continue
+        op = op.lower()
+        # Quoted strings and booleans select a small, fixed subset of rows
+        # (status = 'pending', featured = true): a partial index predicate.
+        low_cardinality = value.startswith("'") or value.lower() in ("true", "false")
+        if op == "=" and low_cardinality:
+            entry(table)["filters"].append(f"{column} = {value}")
+        elif op in ("=", "in", "is"):
+            entry(table)["eq"].append(column)
+        elif op in ("<", ">", "<=", ">=", "between"):
+            entry(table)["range"].append(column)
+
+    order = ORDER_BY_RE.search(predicates or query)
+    if order:
+        for item in order.group(1).split(","):
+            match = re.match(rf'\s*{COLUMN_REF}\s*(desc|asc)?', item, re.IGNORECASE)
+            if match:
+                table = resolve(match.group(1))
+                if table:
+                    direction = f" {match.group(3).upper()}" if match.group(3) else ""
+                    entry(table)["order"].append(match.group(2) + direction)
+
+    for columns in patterns.values():
+        for key in columns:
+            columns[key] = list(dict.fromkeys(columns[key]))
+    return patterns
+
+def candidate_index(table, pattern):
+    """Builds (columns, predicate) for one table access pattern, or None."""
+    columns = list(pattern["eq"])
+    trailing = pattern["range"][:1] or pattern["order"][:1]
+    for column in trailing:
+        if column.split()[0] not in columns:
+            columns.append(column)
+    if not columns:
+        return None
+    predicate = " AND ".join(pattern["filters"]) or None
+    return columns, predicate
+
+def is_covered(columns, predicate, prefixes):
+    """Returns True when an existing non-partial index already leads with these columns."""
+    if predicate:
+        return False
+    wanted = [c.split()[0] for c in columns]
+    return any(existing[:len(wanted)] == wanted for existing in prefixes)
+
+def seq_scan_share(cursor, query, table):
+    """Returns the share of planner cost spent in sequential scans of table, or None.
+
+    The query text comes from a log, so it is only planned inside a read-only
+    transaction that is rolled back.
+    """
+    generic = "$1" in query
+    cursor.execute("BEGIN READ ONLY;")
+    try:
+        cursor.execute(f"EXPLAIN ({'GENERIC_PLAN, ' if generic else ''}FORMAT JSON) {query}")
+        plan = cursor.fetchone()[0]
+    except psycopg2.Error:
+        return None
+    finally:
+        cursor.execute("ROLLBACK;")
+    plan = (json.loads(plan) if isinstance(plan, str) else plan)[0]["Plan"]
+
+    def seq_cost(node):
+        cost = node["Total Cost"] if node.get("Node Type") == "Seq Scan" and node.get("Relation Name") == table else 0.0
+        return cost + sum(seq_cost(child) for child in node.get("Plans", []))
+
+    total = plan["Total Cost"] or 1.0
+    return min(1.0, seq_cost(plan) / total)
+
+def recommend_indexes(cursor, workload):
+    """Returns ranked recommendations as dicts with sql, savings_ms and queries."""
+    prefixes = index_prefixes(cursor)
+    recommendations = {}
+    for query, calls, total_ms in workload:
+        # More than one statement: EXPLAIN would run all but the first.
+        if ";" in query:
+            continue
+        for table, pattern in extract_access_patterns(query).items():
+            candidate = candidate_index(table, pattern)
+            if not candidate or is_covered(*candidate, prefixes.get(table, [])):
+                continue
+            share = seq_scan_share(cursor, query, table)
+            if share == 0.0:
+                continue
+            columns, predicate = candidate
+            key = (table, tuple(columns), predicate)
+            rec = recommendations.setdefault(key, {"savings_ms": 0.0, "calls": 0, "queries": [], "verified": True})
+            rec["savings_ms"] += total_ms * (share if share is not None else 1.0)
+            rec["calls"] += calls
+            rec["verified"] = rec["verified"] and share is not None
+            rec["queries"].append(query)
+
+    ranked = []
+    for (table, columns, predicate), rec in recommendations.items():
+        name = f"idx_{table}_{'_'.join(c.split()[0] for c in columns)}"
+        if predicate:
+            name += "_partial"
+        sql = f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"
+        if predicate:
+            sql += f" WHERE {predicate}"
+        ranked.append(dict(rec, sql=sql + ";"))
+    return sorted(ranked, key=lambda rec: -rec["savings_ms"])
+
+def advise(query_log=None, limit=200):
+    """Prints missing FK indexes and workload-driven index recommendations."""
+    conn = None
+    cursor = None
+    try:
+        conn = psycopg2.connect(**DB_CONFIG)
+        conn.autocommit = True
+        cursor = conn.cursor()
+
+        print("Foreign keys without a covering index:")
+        missing = unindexed_foreign_keys(cursor)
+        for constraint, table, columns in missing:
+            print(f"  {foreign_key_index_sql(table, columns)}  -- {constraint}")
+        if not missing:
+            print("  none")
+
+        workload = load_query_log(query_log) if query_log else load_statement_stats(cursor, limit)
+        if workload is None:
+            print("\nNo workload to analyze; pass --query-log to use a captured log instead.")
+            return missing, []
+
+        print(f"\nWorkload recommendations from {len(workload)} statements:")
+        recommendations = recommend_indexes(cursor, workload)
+        for rec in recommendations:
+            note = "" if rec["verified"] else " (plan unavailable, upper bound)"
+            print(f"  {rec['sql']}")
+            print(f"      est. savings {rec['savings_ms']:.1f} ms over {rec['calls']} calls{note}")
+            print(f"      e.g. {rec['queries'][0][:120]}")
+        if not recommendations:
+            print("  none")
+        return missing, recommendations
+
+    finally:
+        if cursor:
+            cursor.close()
+        if conn:
+            conn.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recommend missing foreign key and workload indexes.")
+    parser.add_argument("--query-log", help="captured query log to analyze instead of pg_stat_statements")
+    parser.add_argument("--limit", type=int, default=200, help="number of top pg_stat_statements entries to analyze")
+    args = parser.parse_args(argv)
+    advise(query_log=args.query_log, limit=args.limit)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,437 @@
+
+import argparse
+import csv
+import gzip
+import hashlib
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+import psycopg2
+
+from create_db_updated import DB_CONFIG
+
+# Archival of old orders.
+#
+# export streams completed orders older than a cutoff, with their items,
+# through COPY ... TO STDOUT into gzip-compressed chunk files (NDJSON, one
+# order per line with an "items" array, or CSV, one row per item with the
+# order columns repeated). Each chunk is a range of order ids read from one
+# REPEATABLE READ snapshot and is hashed as it is written, so memory use does
+# not depend on the volume archived. manifest.json in the archive directory
+# records the cutoff, the columns and every chunk's id range, row counts and
+# SHA-256, and is rewritten after each chunk, so an interrupted export
+# resumes where it stopped.
+#
+# delete verifies each chunk and removes exactly the orders it contains, in
+# small throttled batches: items first, then orders, skipping any order
+# updated since it was exported. Users, addresses and products are never
+# deleted; orders reference them with ON DELETE RESTRICT, and import needs
+# them to be present. import loads chunks back through a staging table with
+# ON CONFLICT DO NOTHING, and reports orders whose user, addresses or
+# products no longer exist instead of failing on them.
+#
+# The sales reporting summaries keep the archived days; a reporting backfill
+# over an archived range would recompute them without the archived orders.
+
+MANIFEST = "manifest.json"
+FORMATS = ("ndjson", "csv")
+DEFAULT_MONTHS = 12
+DEFAULT_STATUSES = ("delivered", "cancelled")
+DEFAULT_CHUNK_ORDERS = 10000
+DEFAULT_BATCH_SIZE = 500
+READ_BLOCK_BYTES = 1024 * 1024
+
+# COPY's CSV mode with quote and delimiter bytes that never occur in JSON
+# text copies each document verbatim, without text-mode backslash escaping.
+RAW_COPY_OPTIONS = "FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02'"
+
+SQL_COLUMNS = """
+    SELECT a.attname, format_type(a.atttypid, a.atttypmod)
+    FROM pg_attribute a
+    WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped
+    ORDER BY a.attnum;
+"""
+
+ELIGIBLE = "o.created_at < %(cutoff)s AND o.status::text = ANY(%(statuses)s)"
+
+SQL_NEXT_CHUNK = f"""
+    SELECT max(id), count(*) FROM (
+        SELECT o.id FROM orders o
+        WHERE o.id > %(after)s AND {ELIGIBLE}
+        ORDER BY o.id
+        LIMIT %(limit)s
+    ) chunk;
+"""
+
+SQL_CHUNK_ITEMS = f"""
+    SELECT count(*) FROM order_items i JOIN orders o ON o.id = i.order_id
+    WHERE o.id > %(after)s AND o.id <= %(through)s AND {ELIGIBLE};
+"""
+
+SQL_EXPORT_NDJSON = f"""
+    SELECT to_jsonb(o) || jsonb_build_object('items', coalesce(
+        (SELECT jsonb_agg(to_jsonb(i) ORDER BY i.id) FROM order_items i WHERE i.order_id = o.id), '[]'::jsonb))
+    FROM orders o
+    WHERE o.id > %(after)s AND o.id <= %(through)s AND {ELIGIBLE}
+    ORDER BY o.id
+"""
+
+# Orders that were exported and have not changed since, locked for delete.
+SQL_LOCK_ARCHIVED = """
+    SELECT o.id FROM orders o
+    JOIN unnest(%s::integer[], %s::timestamptz[]) AS a(id, updated_at) ON a.id = o.id
+    WHERE o.updated_at IS NOT DISTINCT FROM a.updated_at
+    ORDER BY o.id
+    FOR UPDATE OF o;
+"""
+
+# order_items first: the partitioned orders profile has no cascading foreign
+# key from order_items to orders.
+SQL_DELETE_ITEMS = "DELETE FROM order_items WHERE order_id = ANY(%s);"
+SQL_DELETE_ORDERS = "DELETE FROM orders WHERE id = ANY(%s);"
+
+SQL_STAGE_TABLES = """
+    DROP TABLE IF EXISTS archive_orders, archive_items;
+    CREATE TEMP TABLE archive_orders (LIKE orders) ON COMMIT DROP;
+    CREATE TEMP TABLE archive_items (LIKE order_items) ON COMMIT DROP;
+"""
+
+# Staged orders that cannot be restored because a row they reference is gone.
+SQL_UNRESTORABLE = """
+    DELETE FROM archive_orders s
+    WHERE NOT EXISTS (SELECT 1 FROM users u WHERE u.id = s.user_id)
+       OR NOT EXISTS (SELECT 1 FROM addresses a WHERE a.id = s.shipping_address_id)
+       OR NOT EXISTS (SELECT 1 FROM addresses a WHERE a.id = s.billing_address_id)
+       OR EXISTS (
+           SELECT 1 FROM archive_items i
+           WHERE i.order_id = s.id AND NOT EXISTS (SELECT 1 FROM products p WHERE p.id = i.product_id)
+       )
+    RETURNING s.id;
+"""
+
+SQL_RESTORE = """
+    WITH restored AS (
+        INSERT INTO orders SELECT * FROM archive_orders
+        ON CONFLICT DO NOTHING
+        RETURNING id
+    )
+    INSERT INTO order_items
+    SELECT i.* FROM archive_items i JOIN restored r ON r.id = i.order_id
+    ON CONFLICT DO NOTHING
+    RETURNING order_id;
+"""
+
+class HashingWriter:
+    """Binary file wrapper that hashes and counts everything written through it."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.digest = hashlib.sha256()
+        self.bytes = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.bytes += len(data)
+        return self.raw.write(data)
+
+    def flush(self):
+        self.raw.flush()
+
+def connect():
+    """Opens a connection using DB_CONFIG."""
+    return psycopg2.connect(**DB_CONFIG)
+
+def table_columns(cursor, table):
+    """Returns [(name, type)] for a table's columns in order."""
+    cursor.execute(SQL_COLUMNS, (table,))
+    return cursor.fetchall()
+
+def file_checksum(path):
+    """Returns the SHA-256 of a file, read in fixed-size blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(READ_BLOCK_BYTES), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_manifest(directory):
+    """Returns the archive's manifest, or None when the directory has none."""
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(directory, manifest):
+    """Writes the manifest atomically, so a crash never leaves it half written."""
+    path = os.path.join(directory, MANIFEST)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+def verify_chunk(directory, chunk):
+    """Raises when a chunk file is missing or does not match its recorded checksum."""
+    path = os.path.join(directory, chunk["file"])
+    if not os.path.exists(path):
+        raise RuntimeError(f"{chunk['file']} is missing")
+    if file_checksum(path) != chunk["sha256"]:
+        raise RuntimeError(f"{chunk['file']} does not match its manifest checksum")
+
+def csv_export_sql(order_columns, item_columns):
+    """Returns the SELECT for CSV chunks: one row per item, order columns first."""
+    columns = [f'o.{name} AS "order.{name}"' for name, _type in order_columns]
+    columns += [f'i.{name} AS "item.{name}"' for name, _type in item_columns]
+    return f"""
+        SELECT {', '.join(columns)}
+        FROM orders o LEFT JOIN order_items i ON i.order_id = o.id
+        WHERE o.id > %(after)s AND o.id <= %(through)s AND {ELIGIBLE}
+        ORDER BY o.id, i.id
+    """
+
+def export_chunk(cursor, directory, manifest, after, through):
+    """Streams one chunk into its compressed file; returns (file, rows, bytes, sha256)."""
+    params = {"after": after, "through": through, "cutoff": manifest["cutoff"], "statuses": manifest["statuses"]}
+    if manifest["format"] == "ndjson":
+        query = cursor.mogrify(SQL_EXPORT_NDJSON, params).decode()
+        copy = f"COPY ({query}) TO STDOUT WITH ({RAW_COPY_OPTIONS})"
+    else:
+        query = cursor.mogrify(csv_export_sql(manifest["columns"]["orders"], manifest["columns"]["order_items"]), params).decode()
+        copy = f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)"
+    name = f"orders_{after + 1:010d}_{through:010d}.{manifest['format']}.gz"
+    with open(os.path.join(directory, name + ".tmp"), "wb") as raw:
+        writer = HashingWriter(raw)
+        with gzip.GzipFile(fileobj=writer, mode="wb") as compressed:
+            cursor.copy_expert(copy, compressed)
+            rows = cursor.rowcount
+    os.replace(os.path.join(directory, name + ".tmp"), os.path.join(directory, name))
+    return name, rows, writer.bytes, writer.digest.hexdigest()
+
+def export(directory, months=DEFAULT_MONTHS, statuses=DEFAULT_STATUSES, fmt="ndjson",
+           chunk_orders=DEFAULT_CHUNK_ORDERS, delete=False, batch_size=DEFAULT_BATCH_SIZE, pause=0.0):
+    """Archives eligible orders into compressed chunks, resuming an existing manifest."""
+    os.makedirs(directory, exist_ok=True)
+    conn = connect()
+    conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    cursor = conn.cursor()
+    started = time.monotonic()
+    try:
+        manifest = load_manifest(directory)
+        if manifest is None:
+            cursor.execute("SELECT date_trunc('day', now()) - make_interval(months => %s);", (months,))
+            manifest = {
+                "format": fmt,
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "cutoff": cursor.fetchone()[0].isoformat(),
+                "statuses": list(statuses),
+                "columns": {table: table_columns(cursor, table) for table in ("orders", "order_items")},
+                "chunks": [],
+            }
+            conn.commit()
+        else:
+            print(f"Resuming the {manifest['format']} archive in {directory} "
+                  f"(cutoff {manifest['cutoff']}, {len(manifest['chunks'])} chunks written)")
+        after = manifest["chunks"][-1]["last_order_id"] if manifest["chunks"] else 0
+        params = {"cutoff": manifest["cutoff"], "statuses": manifest["statuses"], "limit": chunk_orders}
+
+        while True:
+            cursor.execute(SQL_NEXT_CHUNK, dict(params, after=after))
+            through, orders = cursor.fetchone()
+            if through is None:
+                conn.rollback()
+                break
+            cursor.execute(SQL_CHUNK_ITEMS, dict(params, after=after, through=through))
+            items = cursor.fetchone()[0]
+            name, rows, size, checksum = export_chunk(cursor, directory, manifest, after, through)
+            conn.commit()
+            manifest["chunks"].append({
+                "file": name,
+                "first_order_id": after + 1,
+                "last_order_id": through,
+                "orders": orders,
+                "items": items,
+                "rows": rows,
+                "bytes": size,
+                "sha256": checksum,
+            })
+            save_manifest(directory, manifest)
+            print(f"Wrote {name}: {orders} orders, {items} items, {size / 1024:.0f} KB")
+            after = through
+
+        total = sum(chunk["orders"] for chunk in manifest["chunks"])
+        print(f"Archive complete: {total} orders in {len(manifest['chunks'])} chunks "
+              f"({time.monotonic() - started:.1f}s).")
+    finally:
+        cursor.close()
+        conn.close()
+    if delete:
+        delete_archived(directory, batch_size=batch_size, pause=pause)
+    return manifest
+
+def archived_orders(directory, manifest, chunk):
+    """Yields (order id, updated_at) for every order in a chunk file, streaming it."""
+    with gzip.open(os.path.join(directory, chunk["file"]), "rt", encoding="utf-8", newline="") as f:
+        if manifest["format"] == "ndjson":
+            for line in f:
+                order = json.loads(line)
+                yield order["id"], order["updated_at"]
+        else:
+            last = None
+            for row in csv.DictReader(f):
+                if row["order.id"] != last:
+                    last = row["order.id"]
+                    yield int(last), row["order.updated_at"] or None
+
+def batches(rows, size):
+    """Groups an iterable into lists of at most size items."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def delete_archived(directory, batch_size=DEFAULT_BATCH_SIZE, pause=0.0):
+    """Deletes the orders recorded in a verified archive, one small transaction per batch."""
+    manifest = load_manifest(directory)
+    if manifest is None:
+        raise RuntimeError(f"No {MANIFEST} in {directory}")
+    conn = connect()
+    cursor = conn.cursor()
+    deleted = skipped = 0
+    started = time.monotonic()
+    try:
+        for chunk in manifest["chunks"]:
+            if chunk.get("deleted"):
+                continue
+            verify_chunk(directory, chunk)
+            for batch in batches(archived_orders(directory, manifest, chunk), batch_size):
+                ids = [order_id for order_id, _updated in batch]
+                cursor.execute(SQL_LOCK_ARCHIVED, (ids, [updated for _id, updated in batch]))
+                unchanged = [row[0] for row in cursor.fetchall()]
+                cursor.execute(SQL_DELETE_ITEMS, (unchanged,))
+                cursor.execute(SQL_DELETE_ORDERS, (unchanged,))
+                deleted += cursor.rowcount
+                conn.commit()
+                skipped += len(ids) - len(unchanged)
+                if pause:
+                    time.sleep(pause)
+            chunk["deleted"] = True
+            save_manifest(directory, manifest)
+            print(f"Deleted the orders of {chunk['file']} ({deleted} so far)")
+    finally:
+        cursor.close()
+        conn.close()
+    print(f"Deleted {deleted} archived orders in {time.monotonic() - started:.1f}s"
+          f"{f'; kept {skipped} changed or already removed since export' if skipped else ''}.")
+    return deleted
+
+def stage_chunk(cursor, directory, manifest, chunk):
+    """Copies one chunk file into the archive_orders and archive_items staging tables."""
+    cursor.execute(SQL_STAGE_TABLES)
+    with gzip.open(os.path.join(directory, chunk["file"]), "rb") as f:
+        if manifest["format"] == "ndjson":
+            cursor.execute("CREATE TEMP TABLE archive_documents (doc jsonb) ON COMMIT DROP;")
+            cursor.copy_expert(f"COPY archive_documents FROM STDIN WITH ({RAW_COPY_OPTIONS})", f)
+            cursor.execute("""
+                INSERT INTO archive_orders SELECT (jsonb_populate_record(NULL::archive_orders, doc)).* FROM archive_documents;
+                INSERT INTO archive_items SELECT (jsonb_populate_recordset(NULL::archive_items, doc->'items')).* FROM archive_documents;
+                DROP TABLE archive_documents;
+            """)
+        else:
+            order_columns = manifest["columns"]["orders"]
+            item_columns = manifest["columns"]["order_items"]
+            definitions = [f'"order.{name}" {type_}' for name, type_ in order_columns]
+            definitions += [f'"item.{name}" {type_}' for name, type_ in item_columns]
+            cursor.execute(f"CREATE TEMP TABLE archive_rows ({', '.join(definitions)}) ON COMMIT DROP;")
+            cursor.copy_expert("COPY archive_rows FROM STDIN WITH (FORMAT csv, HEADER)", f)
+            cursor.execute(f"""
+                INSERT INTO archive_orders ({', '.join(name for name, _type in order_columns)})
+                SELECT DISTINCT ON ("order.id") {', '.join(f'"order.{name}"' for name, _type in order_columns)}
+                FROM archive_rows ORDER BY "order.id";
+                INSERT INTO archive_items ({', '.join(name for name, _type in item_columns)})
+                SELECT {', '.join(f'"item.{name}"' for name, _type in item_columns)}
+                FROM archive_rows WHERE "item.id" IS NOT NULL;
+                DROP TABLE archive_rows;
+            """)
+
+def import_archive(directory):
+    """Restores every chunk of an archive; returns (orders restored, orders that could not be)."""
+    manifest = load_manifest(directory)
+    if manifest is None:
+        raise RuntimeError(f"No {MANIFEST} in {directory}")
+    conn = connect()
+    cursor = conn.cursor()
+    restored = unrestorable = 0
+    started = time.monotonic()
+    try:
+        for chunk in manifest["chunks"]:
+            verify_chunk(directory, chunk)
+            stage_chunk(cursor, directory, manifest, chunk)
+            cursor.execute(SQL_UNRESTORABLE)
+            missing = [row[0] for row in cursor.fetchall()]
+            cursor.execute(SQL_RESTORE)
+            orders = len({row[0] for row in cursor.fetchall()})
+            conn.commit()
+            restored += orders
+            unrestorable += len(missing)
+            print(f"Restored {orders} orders from {chunk['file']}"
+                  f"{f'; {len(missing)} reference deleted users, addresses or products (e.g. order {missing[0]})' if missing else ''}")
+    finally:
+        cursor.close()
+        conn.close()
+    print(f"Import complete: {restored} orders restored, {unrestorable} not restorable, "
+          f"in {time.monotonic() - started:.1f}s.")
+    return restored, unrestorable
+
+def verify(directory):
+    """Checks every chunk file against the manifest; returns the number checked."""
+    manifest = load_manifest(directory)
+    if manifest is None:
+        raise RuntimeError(f"No {MANIFEST} in {directory}")
+    for chunk in manifest["chunks"]:
+        verify_chunk(directory, chunk)
+    return len(manifest["chunks"])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Archive old orders to compressed files and restore them.")
+    actions = parser.add_subparsers(dest="action", required=True)
+
+    export_parser = actions.add_parser("export", help="stream eligible orders into compressed chunk files")
+    export_parser.add_argument("directory")
+    export_parser.add_argument("--older-than-months", type=int, default=DEFAULT_MONTHS)
+    export_parser.add_argument("--statuses", default=",".join(DEFAULT_STATUSES),
+                               help="comma-separated order statuses to archive")
+    export_parser.add_argument("--format", choices=FORMATS, default="ndjson")
+    export_parser.add_argument("--chunk-orders", type=int, default=DEFAULT_CHUNK_ORDERS, help="orders per file")
+    export_parser.add_argument("--delete", action="store_true", help="delete the archived orders afterwards")
+    export_parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="orders per delete transaction")
+    export_parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between delete batches")
+
+    delete_parser = actions.add_parser("delete", help="delete the orders recorded in an archive")
+    delete_parser.add_argument("directory")
+    delete_parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="orders per transaction")
+    delete_parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+
+    import_parser = actions.add_parser("import", help="restore the orders recorded in an archive")
+    import_parser.add_argument("directory")
+
+    verify_parser = actions.add_parser("verify", help="check chunk files against the manifest checksums")
+    verify_parser.add_argument("directory")
+
+    args = parser.parse_args(argv)
+    if args.action == "export":
+        export(args.directory, months=args.older_than_months, statuses=args.statuses.split(","), fmt=args.format,
+               chunk_orders=args.chunk_orders, delete=args.delete, batch_size=args.batch_size, pause=args.pause)
+    elif args.action == "delete":
+        delete_archived(args.directory, batch_size=args.batch_size, pause=args.pause)
+    elif args.action == "import":
+        import_archive(args.directory)
+    elif args.action == "verify":
+        print(f"{verify(args.directory)} chunk(s) match their checksums.")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
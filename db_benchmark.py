@@ -0,0 +1,290 @@
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import psycopg2
+
+from create_db_updated import DB_CONFIG, create_schema, schema_fingerprint
+from db_seed import seed
+
+# Query workload benchmark.
+#
+# Replays the storefront's hot queries (as issued by server/storage.ts)
+# against the schema from create_schema(), reports latency percentiles and
+# throughput per query, captures EXPLAIN (ANALYZE, BUFFERS) plans, and diffs
+# two result files so index or DDL changes can be judged on numbers.
+
+# Each workload entry is a list of statements run back to back, mirroring the
+# round trips storage.ts makes. Parameters are drawn by the named sampler.
+WORKLOAD = {
+    "product_search": {
+        "params": "search_term",
+        "statements": [
+            "SELECT * FROM products WHERE search_vector @@ websearch_to_tsquery('english', %(term)s) "
+            "ORDER BY ts_rank(search_vector, websearch_to_tsquery('english', %(term)s)) DESC;",
+        ],
+    },
+    "category_listing": {
+        "params": "category",
+        "statements": ["SELECT * FROM products WHERE category_id = %(category_id)s;"],
+    },
+    "featured_product": {
+        "params": None,
+        "statements": ["SELECT * FROM products WHERE featured = true LIMIT 1;"],
+    },
+    "cart_with_items": {
+        "params": "user",
+        "statements": [
+            "SELECT * FROM carts WHERE user_id = %(user_id)s LIMIT 1;",
+            "SELECT ci.*, p.* FROM cart_items ci LEFT JOIN products p ON ci.product_id = p.id "
+            "WHERE ci.cart_id = (SELECT id FROM carts WHERE user_id = %(user_id)s LIMIT 1);",
+        ],
+    },
+    "order_with_items": {
+        "params": "order",
+        "statements": [
+            "SELECT * FROM orders WHERE id = %(order_id)s LIMIT 1;",
+            "SELECT oi.*, p.* FROM order_items oi LEFT JOIN products p ON oi.product_id = p.id "
+            "WHERE oi.order_id = %(order_id)s;",
+        ],
+    },
+    "admin_all_orders": {
+        "params": None,
+        "statements": ["SELECT * FROM orders ORDER BY created_at DESC;"],
+    },
+}
+
+SEARCH_TERMS = ("lavender", "serum", "hydrating oil", "rose toner", "vitamin c", "night mask", "gentle cleanser")
+
+# Rows per table at scale factor 1.
+SCALE_USERS = 10000
+SCALE_PRODUCTS = 1000
+SCALE_CATEGORIES = 20
+
+DEFAULT_DURATION = 5.0
+DEFAULT_WARMUP = 1.0
+
+class ParamSampler:
+    """Draws query parameters from the id ranges present in the database."""
+
+    def __init__(self, cursor, seed):
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ranges = {}
+        for table in ("users", "categories", "orders"):
+            cursor.execute(f"SELECT coalesce(min(id), 0), coalesce(max(id), 0) FROM {table};")
+            self.ranges[table] = cursor.fetchone()
+
+    def draw(self, kind):
+        with self.lock:
+            if kind is None:
+                return {}
+            if kind == "search_term":
+                return {"term": self.rng.choice(SEARCH_TERMS)}
+            table, key = {"category": ("categories", "category_id"), "user": ("users", "user_id"),
+                          "order": ("orders", "order_id")}[kind]
+            low, high = self.ranges[table]
+            return {key: self.rng.randint(low, high)}
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+def format_ms(value):
+    """Formats a latency in milliseconds; n/a when no operation completed."""
+    return "n/a" if value is None else f"{value:.2f} ms"
+
+def run_operation(cursor, statements, params):
+    """Runs one workload operation and returns its latency in milliseconds."""
+    started = time.perf_counter()
+    for sql in statements:
+        cursor.execute(sql, params)
+        cursor.fetchall()
+    return (time.perf_counter() - started) * 1000.0
+
+def client_loop(sampler, query, deadline):
+    """Runs one query repeatedly on its own connection until deadline; returns latencies."""
+    conn = psycopg2.connect(**DB_CONFIG)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    latencies = []
+    try:
+        while time.monotonic() < deadline:
+            latencies.append(run_operation(cursor, query["statements"], sampler.draw(query["params"])))
+    finally:
+        cursor.close()
+        conn.close()
+    return latencies
+
+def capture_plans(cursor, sampler, query):
+    """Returns EXPLAIN (ANALYZE, BUFFERS) JSON plans for each statement of a query."""
+    params = sampler.draw(query["params"])
+    plans = []
+    for sql in query["statements"]:
+        cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+        plans.append(json.loads(plan) if isinstance(plan, str) else plan)
+    return plans
+
+def benchmark_query(sampler, query, duration, warmup, concurrency):
+    """Measures one workload query and returns its result record."""
+    if warmup:
+        client_loop(sampler, query, time.monotonic() + warmup)
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(client_loop, sampler, query, started + duration) for _ in range(concurrency)]
+        latencies = sorted(ms for future in futures for ms in future.result())
+    elapsed = time.monotonic() - started
+    return {
+        "operations": len(latencies),
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": latencies[-1] if latencies else None,
+    }
+
+def setup_database(scale, seed_value, yes_truncate=False, config=None):
+    """Builds the schema and loads a dataset at the given scale factor.
+
+    Reseeding truncates the seeded tables, so it needs yes_truncate. config
+    holds connection parameters and defaults to DB_CONFIG.
+    """
+    config = config or DB_CONFIG
+    if not yes_truncate:
+        raise RuntimeError(f"--setup truncates users, products, orders and every table that references them in "
+                           f"database '{config.get('database')}'; "
+                           f"pass --yes-truncate to confirm, or run against a 'testdb acquire' database.")
+    create_schema(config=config)
+    seed(users=int(SCALE_USERS * scale), products=int(SCALE_PRODUCTS * scale), categories=int(SCALE_CATEGORIES * scale) or 1,
+         seed_value=seed_value, truncate=True, config=config)
+
+def run_benchmark(queries=None, duration=DEFAULT_DURATION, warmup=DEFAULT_WARMUP, concurrency=1, seed_value=1,
+                  label=None, output=None, setup=False, scale=1.0, yes_truncate=False):
+    """Runs the workload and returns (and optionally writes) the result document."""
+    if setup:
+        setup_database(scale, seed_value, yes_truncate=yes_truncate)
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    try:
+        sampler = ParamSampler(cursor, seed_value)
+        row = None
+        cursor.execute("SELECT to_regclass('schema_metadata') IS NOT NULL;")
+        if cursor.fetchone()[0]:
+            cursor.execute("SELECT value FROM schema_metadata WHERE key = 'schema_fingerprint';")
+            row = cursor.fetchone()
+        cursor.execute("SELECT relname, n_live_tup FROM pg_stat_user_tables ORDER BY relname;")
+        table_rows = dict(cursor.fetchall())
+
+        results = {}
+        for name in queries or WORKLOAD:
+            query = WORKLOAD[name]
+            print(f"Benchmarking {name} for {duration:.0f}s with {concurrency} client(s)...")
+            results[name] = benchmark_query(sampler, query, duration, warmup, concurrency)
+            results[name]["plans"] = capture_plans(cursor, sampler, query)
+            r = results[name]
+            print(f"  {r['operations']} ops, {r['throughput']:.1f} ops/s, "
+                  f"p50 {format_ms(r['p50_ms'])}, p95 {format_ms(r['p95_ms'])}, p99 {format_ms(r['p99_ms'])}")
+    finally:
+        cursor.close()
+        conn.close()
+
+    document = {
+        "label": label,
+        "recorded_at": datetime.now(timezone.utc).isoformat(),
+        "schema_fingerprint": row[0] if row else None,
+        "declared_fingerprint": schema_fingerprint(),
+        "settings": {"duration": duration, "warmup": warmup, "concurrency": concurrency, "seed": seed_value},
+        "table_rows": table_rows,
+        "results": results,
+    }
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(document, f, indent=2, default=str)
+        print(f"Results written to {output}")
+    return document
+
+def plan_summary(plans):
+    """Returns node types and shared buffer hits/reads for each statement's plan."""
+    summaries = []
+    for plan in plans or []:
+        root = plan[0]["Plan"]
+        nodes = []
+        def walk(node):
+            label = node["Node Type"]
+            if node.get("Index Name"):
+                label += f" using {node['Index Name']}"
+            elif node.get("Relation Name"):
+                label += f" on {node['Relation Name']}"
+            nodes.append(label)
+            for child in node.get("Plans", []):
+                walk(child)
+        walk(root)
+        summaries.append(f"{' > '.join(nodes)} (hit {root.get('Shared Hit Blocks', 0)}, read {root.get('Shared Read Blocks', 0)})")
+    return " | ".join(summaries)
+
+def diff_results(baseline_path, candidate_path):
+    """Prints per-query changes between two result files."""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(candidate_path, encoding="utf-8") as f:
+        candidate = json.load(f)
+
+    def change(old, new):
+        if old is None or new is None or old == 0:
+            return "    n/a"
+        return f"{(new - old) / old * 100:+7.1f}%"
+
+    print(f"baseline:  {baseline.get('label') or baseline_path} ({(baseline.get('schema_fingerprint') or '?')[:12]})")
+    print(f"candidate: {candidate.get('label') or candidate_path} ({(candidate.get('schema_fingerprint') or '?')[:12]})")
+    print(f"\n{'query':<20} {'p50':>9} {'p95':>9} {'p99':>9} {'ops/s':>9}")
+    for name in baseline["results"]:
+        if name not in candidate["results"]:
+            continue
+        old, new = baseline["results"][name], candidate["results"][name]
+        print(f"{name:<20} {change(old['p50_ms'], new['p50_ms'])} {change(old['p95_ms'], new['p95_ms'])} "
+              f"{change(old['p99_ms'], new['p99_ms'])} {change(old['throughput'], new['throughput'])}")
+        old_plan, new_plan = plan_summary(old.get("plans")), plan_summary(new.get("plans"))
+        if old_plan != new_plan:
+            print(f"    plan: {old_plan}\n       -> {new_plan}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the storefront query workload.")
+    actions = parser.add_subparsers(dest="action", required=True)
+
+    run_parser = actions.add_parser("run", help="run the workload")
+    run_parser.add_argument("--query", action="append", choices=sorted(WORKLOAD), help="query to run (repeatable; default all)")
+    run_parser.add_argument("--duration", type=float, default=DEFAULT_DURATION, help="seconds per query")
+    run_parser.add_argument("--warmup", type=float, default=DEFAULT_WARMUP, help="warm-up seconds per query")
+    run_parser.add_argument("--concurrency", type=int, default=1, help="concurrent clients per query")
+    run_parser.add_argument("--seed", type=int, default=1)
+    run_parser.add_argument("--label", help="name for this run, e.g. the schema revision")
+    run_parser.add_argument("--output", help="write the results as JSON to this file")
+    run_parser.add_argument("--setup", action="store_true", help="create the schema and reseed before running")
+    run_parser.add_argument("--scale", type=float, default=1.0, help=f"scale factor for --setup ({SCALE_USERS} users at 1)")
+    run_parser.add_argument("--yes-truncate", action="store_true", help="confirm that --setup may empty the seeded tables")
+
+    diff_parser = actions.add_parser("diff", help="compare two result files")
+    diff_parser.add_argument("baseline")
+    diff_parser.add_argument("candidate")
+
+    args = parser.parse_args(argv)
+    if args.action == "run":
+        run_benchmark(queries=args.query, duration=args.duration, warmup=args.warmup, concurrency=args.concurrency,
+                      seed_value=args.seed, label=args.label, output=args.output, setup=args.setup, scale=args.scale,
+                      yes_truncate=args.yes_truncate)
+    else:
+        diff_results(args.baseline, args.candidate)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,243 @@
+
+import argparse
+import sys
+import time
+import psycopg2
+
+from create_db_updated import DB_CONFIG, DEDUP_INDEXES, declared_objects
+from db_indexes import build_indexes
+
+# Cart uniqueness.
+#
+# create_db_updated.py declares one cart per user (idx_carts_user_unique) and
+# one line per product in a cart (idx_cart_items_cart_product), so that
+# add-to-cart is a single INSERT ... ON CONFLICT DO UPDATE. Tables created
+# before these indexes may already hold duplicates, which would fail the
+# unique builds. This module merges them in short batches while the shop is
+# live: duplicate carts fold into each user's oldest cart, then duplicate
+# lines fold into their oldest line with the quantities summed. It then
+# builds the unique indexes concurrently and drops the plain indexes they
+# supersede. Run 'carts dedup' before deploying the upserting application;
+# create_schema() skips the unique indexes on tables that already hold rows.
+
+# Plain indexes from before the unique ones, whose columns they lead with.
+SUPERSEDED_INDEXES = ("idx_carts_user", "idx_cart_items_cart")
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_ATTEMPTS = 3
+
+# Locks every cart of the next batch of users that have more than one. The
+# lock also holds off item inserts into those carts (their foreign key check
+# needs a KEY SHARE lock) until the batch commits.
+SQL_LOCK_DUPLICATE_CARTS = """
+    SELECT id, user_id FROM carts
+    WHERE user_id IN (
+        SELECT user_id FROM carts
+        WHERE user_id > %s
+        GROUP BY user_id
+        HAVING count(*) > 1
+        ORDER BY user_id
+        LIMIT %s
+    )
+    ORDER BY id
+    FOR UPDATE;
+"""
+
+# Moves the items of every cart but the oldest onto the oldest; lines that
+# now repeat a product are merged by the item pass.
+SQL_MOVE_CART_ITEMS = """
+    WITH merge AS (
+        SELECT id, min(id) OVER (PARTITION BY user_id) AS keep_id
+        FROM carts WHERE id = ANY(%s)
+    )
+    UPDATE cart_items i
+    SET cart_id = m.keep_id, updated_at = now()
+    FROM merge m
+    WHERE i.cart_id = m.id AND m.id <> m.keep_id;
+"""
+
+SQL_DELETE_DUPLICATE_CARTS = """
+    DELETE FROM carts c
+    USING (SELECT id, min(id) OVER (PARTITION BY user_id) AS keep_id FROM carts WHERE id = ANY(%s)) m
+    WHERE c.id = m.id AND m.id <> m.keep_id;
+"""
+
+SQL_NEXT_CART_BATCH = """
+    SELECT max(id) FROM (
+        SELECT id FROM carts WHERE id > %s ORDER BY id LIMIT %s
+    ) batch;
+"""
+
+# Locks the repeated lines of the batch's carts, so a concurrent quantity
+# change is either in the sum or waits for the merge to commit.
+SQL_LOCK_DUPLICATE_ITEMS = """
+    SELECT i.id FROM cart_items i
+    WHERE i.cart_id > %(after)s AND i.cart_id <= %(through)s
+      AND EXISTS (
+          SELECT 1 FROM cart_items o
+          WHERE o.cart_id = i.cart_id AND o.product_id = i.product_id AND o.id <> i.id
+      )
+    ORDER BY i.id
+    FOR UPDATE;
+"""
+
+SQL_MERGE_ITEMS = """
+    WITH groups AS (
+        SELECT cart_id, product_id, min(id) AS keep_id,
+               sum(quantity)::integer AS quantity, max(updated_at) AS updated_at
+        FROM cart_items
+        WHERE cart_id > %(after)s AND cart_id <= %(through)s
+        GROUP BY cart_id, product_id
+        HAVING count(*) > 1
+    ),
+    kept AS (
+        UPDATE cart_items i
+        SET quantity = g.quantity, updated_at = greatest(g.updated_at, now())
+        FROM groups g
+        WHERE i.id = g.keep_id
+    )
+    DELETE FROM cart_items i
+    USING groups g
+    WHERE i.cart_id = g.cart_id AND i.product_id = g.product_id AND i.id <> g.keep_id;
+"""
+
+SQL_DUPLICATE_COUNTS = """
+    SELECT
+        (SELECT count(*) FROM (SELECT 1 FROM carts GROUP BY user_id HAVING count(*) > 1) d),
+        (SELECT coalesce(sum(n - 1), 0)::bigint FROM (SELECT count(*) AS n FROM carts GROUP BY user_id HAVING count(*) > 1) d),
+        (SELECT count(*) FROM (SELECT 1 FROM cart_items GROUP BY cart_id, product_id HAVING count(*) > 1) d),
+        (SELECT coalesce(sum(n - 1), 0)::bigint FROM (SELECT count(*) AS n FROM cart_items GROUP BY cart_id, product_id HAVING count(*) > 1) d);
+"""
+
+SQL_VALID_INDEXES = """
+    SELECT c.relname
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE i.indisvalid AND c.relname = ANY(%s);
+"""
+
+def connect():
+    """Opens a connection using DB_CONFIG."""
+    return psycopg2.connect(**DB_CONFIG)
+
+def unique_index_statements():
+    """Returns the declared CREATE UNIQUE INDEX statements for carts and cart_items."""
+    return [sql for kind, name, sql in declared_objects() if kind == 'index' and name in DEDUP_INDEXES]
+
+def duplicate_counts(cursor):
+    """Returns (users with several carts, surplus carts, repeated lines, surplus lines)."""
+    cursor.execute(SQL_DUPLICATE_COUNTS)
+    return cursor.fetchone()
+
+def merge_carts(conn, cursor, batch_size, pause):
+    """Folds every user's carts into their oldest one; returns the carts removed."""
+    last_user = 0
+    removed = 0
+    while True:
+        cursor.execute(SQL_LOCK_DUPLICATE_CARTS, (last_user, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            conn.rollback()
+            return removed
+        cart_ids = [row[0] for row in rows]
+        cursor.execute(SQL_MOVE_CART_ITEMS, (cart_ids,))
+        moved = cursor.rowcount
+        cursor.execute(SQL_DELETE_DUPLICATE_CARTS, (cart_ids,))
+        removed += cursor.rowcount
+        conn.commit()
+        last_user = max(row[1] for row in rows)
+        print(f"Merged carts through user {last_user} ({removed} carts removed, {moved} items moved in this batch)")
+        if pause:
+            time.sleep(pause)
+
+def merge_items(conn, cursor, batch_size, pause):
+    """Folds repeated (cart_id, product_id) lines into the oldest one; returns the lines removed."""
+    last_cart = 0
+    removed = 0
+    while True:
+        cursor.execute(SQL_NEXT_CART_BATCH, (last_cart, batch_size))
+        batch_end = cursor.fetchone()[0]
+        if batch_end is None:
+            conn.rollback()
+            return removed
+        cursor.execute(SQL_LOCK_DUPLICATE_ITEMS, {"after": last_cart, "through": batch_end})
+        if cursor.rowcount:
+            cursor.execute(SQL_MERGE_ITEMS, {"after": last_cart, "through": batch_end})
+            removed += cursor.rowcount
+            print(f"Merged cart lines through cart {batch_end} ({removed} lines removed)")
+        conn.commit()
+        last_cart = batch_end
+        if pause:
+            time.sleep(pause)
+
+def drop_superseded(cursor):
+    """Drops the plain indexes the unique ones replace, once the unique ones are valid."""
+    cursor.execute(SQL_VALID_INDEXES, (list(DEDUP_INDEXES),))
+    if len(cursor.fetchall()) < len(DEDUP_INDEXES):
+        return
+    for name in SUPERSEDED_INDEXES:
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+        print(f"Dropped {name} (if present)")
+
+def dedup(batch_size=DEFAULT_BATCH_SIZE, pause=0.0, attempts=DEFAULT_ATTEMPTS):
+    """Merges duplicate carts and cart lines, then builds the unique indexes concurrently.
+
+    Duplicates written while a build is starting fail that build; the merge
+    and build are then repeated, up to attempts times.
+    """
+    conn = connect()
+    cursor = conn.cursor()
+    started = time.monotonic()
+    try:
+        for attempt in range(1, attempts + 1):
+            users, carts, lines, items = duplicate_counts(cursor)
+            conn.commit()
+            print(f"{users} users with {carts} surplus carts, {lines} cart lines with {items} surplus rows.")
+            carts_removed = merge_carts(conn, cursor, batch_size, pause)
+            items_removed = merge_items(conn, cursor, batch_size, pause)
+            print(f"Removed {carts_removed} carts and {items_removed} cart lines.")
+            try:
+                build_indexes(statements=unique_index_statements(), progress_interval=0)
+                break
+            except RuntimeError:
+                if attempt == attempts:
+                    raise
+                print(f"Unique index build failed on new duplicates (attempt {attempt}), merging again...")
+        conn.autocommit = True
+        drop_superseded(cursor)
+        print(f"Cart uniqueness enforced in {time.monotonic() - started:.1f}s.")
+    finally:
+        cursor.close()
+        conn.close()
+
+def check():
+    """Returns duplicate_counts() for the live tables."""
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        return duplicate_counts(cursor)
+    finally:
+        cursor.close()
+        conn.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Merge duplicate carts and enforce cart uniqueness.")
+    actions = parser.add_subparsers(dest="action", required=True)
+
+    dedup_parser = actions.add_parser("dedup", help="merge duplicates in batches, then build the unique indexes")
+    dedup_parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="users or carts per transaction")
+    dedup_parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    dedup_parser.add_argument("--attempts", type=int, default=DEFAULT_ATTEMPTS,
+                              help="merge-and-build rounds before giving up on concurrent duplicates")
+
+    actions.add_parser("check", help="count duplicate carts and cart lines")
+
+    args = parser.parse_args(argv)
+    if args.action == "dedup":
+        dedup(batch_size=args.batch_size, pause=args.pause, attempts=args.attempts)
+    elif args.action == "check":
+        users, carts, lines, items = check()
+        print(f"{users} users with {carts} surplus carts, {lines} cart lines with {items} surplus rows.")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
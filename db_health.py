@@ -0,0 +1,328 @@
+
+import argparse
+import json
+import math
+import sys
+import psycopg2
+
+from create_db_updated import DB_CONFIG, declared_objects
+
+# Health and bloat report for the declared tables and their indexes.
+#
+# Everything comes from the statistics views and the planner's column
+# statistics, so the report never scans a table. Bloat is estimated: the
+# expected size of a table is its row count times the average row width
+# from pg_stats, packed at the table's fillfactor, and the same is done for
+# btree indexes with their key columns. The difference from the actual size
+# is reported as probable bloat. The estimate needs up-to-date statistics,
+# so run ANALYZE first if the tables were just loaded.
+#
+# Beside bloat, each table gets its dead-tuple ratio, HOT update ratio,
+# sequential scans, heap cache hit ratio and last (auto)vacuum and analyze.
+# Unused indexes are those with no scans since statistics were reset,
+# excluding unique and primary key indexes, which enforce constraints.
+# --suggest prints per-table storage settings (autovacuum thresholds,
+# fillfactor) for the flagged tables. Partitions are reported under their
+# own names and belong to the declared table at the root of their tree.
+
+BLOCK_HEADER = 24
+BTREE_SPECIAL = 16
+HEAP_TUPLE_HEADER = 23
+INDEX_TUPLE_HEADER = 8
+LINE_POINTER = 4
+MAXALIGN = 8
+DEFAULT_INDEX_FILLFACTOR = 90
+
+# Thresholds for flagging an object.
+DEAD_RATIO_WARN = 0.10
+BLOAT_RATIO_WARN = 0.30
+BLOAT_BYTES_MIN = 1024 * 1024
+HOT_RATIO_WARN = 0.50
+HOT_UPDATES_MIN = 1000
+CACHE_HIT_WARN = 0.99
+TABLE_CACHE_HIT_WARN = 0.95
+CACHE_READS_MIN = 1000
+DEFAULT_LARGE_TABLE_MB = 10
+
+# Settings --suggest proposes.
+CHURN_SETTINGS = {"autovacuum_vacuum_scale_factor": "0.02", "autovacuum_analyze_scale_factor": "0.02"}
+LARGE_TABLE_SETTINGS = {"autovacuum_vacuum_scale_factor": "0.05", "autovacuum_analyze_scale_factor": "0.02"}
+HOT_FILLFACTOR = "85"
+
+SQL_TABLE_STATS = """
+    SELECT c.relname,
+           coalesce(pg_partition_root(c.oid), c.oid)::regclass::text,
+           greatest(c.reltuples, 0)::bigint,
+           c.relpages,
+           pg_table_size(c.oid),
+           c.relnatts,
+           coalesce(c.reloptions, '{}'),
+           s.n_live_tup, s.n_dead_tup, s.n_tup_upd, s.n_tup_hot_upd, s.n_tup_del,
+           s.seq_scan, s.seq_tup_read, coalesce(s.idx_scan, 0),
+           s.n_mod_since_analyze,
+           greatest(s.last_autovacuum, s.last_vacuum),
+           greatest(s.last_autoanalyze, s.last_analyze),
+           s.autovacuum_count,
+           coalesce(io.heap_blks_hit, 0), coalesce(io.heap_blks_read, 0)
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    JOIN pg_stat_user_tables s ON s.relid = c.oid
+    JOIN pg_statio_user_tables io ON io.relid = c.oid
+    WHERE n.nspname = current_schema() AND c.relkind = 'r'
+    ORDER BY c.relname;
+"""
+
+SQL_INDEX_STATS = """
+    SELECT c.relname, t.relname, am.amname,
+           greatest(c.reltuples, 0)::bigint, c.relpages, pg_relation_size(c.oid),
+           coalesce(c.reloptions, '{}'),
+           i.indisunique OR i.indisprimary, i.indisvalid,
+           s.idx_scan,
+           (SELECT array_agg(a.attname ORDER BY k.ord)
+            FROM unnest(i.indkey::int2[]) WITH ORDINALITY AS k(attnum, ord)
+            LEFT JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum),
+           coalesce(io.idx_blks_hit, 0), coalesce(io.idx_blks_read, 0)
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    JOIN pg_class t ON t.oid = i.indrelid
+    JOIN pg_namespace n ON n.oid = t.relnamespace
+    JOIN pg_am am ON am.oid = c.relam
+    JOIN pg_stat_user_indexes s ON s.indexrelid = i.indexrelid
+    JOIN pg_statio_user_indexes io ON io.indexrelid = i.indexrelid
+    WHERE n.nspname = current_schema() AND t.relkind = 'r'
+    ORDER BY t.relname, c.relname;
+"""
+
+SQL_COLUMN_WIDTHS = """
+    SELECT tablename, attname, avg_width, null_frac
+    FROM pg_stats
+    WHERE schemaname = current_schema() AND NOT inherited;
+"""
+
+SQL_DATABASE_STATS = """
+    SELECT blks_hit, blks_read, stats_reset, current_setting('block_size')::int,
+           current_setting('autovacuum')
+    FROM pg_stat_database
+    WHERE datname = current_database();
+"""
+
+def connect():
+    """Opens a connection using DB_CONFIG."""
+    return psycopg2.connect(**DB_CONFIG)
+
+def align(size, alignment=MAXALIGN):
+    return (size + alignment - 1) // alignment * alignment
+
+def ratio(part, whole):
+    return part / whole if whole else None
+
+def storage_options(reloptions):
+    """Returns a table's or index's reloptions as a dict."""
+    return dict(option.split("=", 1) for option in reloptions)
+
+def column_widths(cursor):
+    """Returns {table: {column: (avg_width, null_frac)}} from pg_stats."""
+    cursor.execute(SQL_COLUMN_WIDTHS)
+    widths = {}
+    for table, column, width, null_frac in cursor.fetchall():
+        widths.setdefault(table, {})[column] = (width, null_frac)
+    return widths
+
+def expected_pages(rows, tuple_size, usable):
+    """Returns the pages rows of tuple_size bytes need at usable bytes per page."""
+    per_page = max(usable // (tuple_size + LINE_POINTER), 1)
+    return math.ceil(rows / per_page)
+
+def table_bloat(table, widths, block_size):
+    """Returns (estimated bloat bytes, ratio of the table) or (None, None) without statistics."""
+    columns = widths.get(table["name"])
+    if not columns or not table["rows"] or not table["pages"]:
+        return None, None
+    data = sum(width * (1 - null_frac) for width, null_frac in columns.values())
+    nulls = any(null_frac > 0 for _width, null_frac in columns.values())
+    header = align(HEAP_TUPLE_HEADER + (math.ceil(table["columns"] / 8) if nulls else 0))
+    fillfactor = int(table["options"].get("fillfactor", 100))
+    usable = (block_size - BLOCK_HEADER) * fillfactor // 100
+    expected = expected_pages(table["rows"], header + align(math.ceil(data)), usable)
+    bloat = max(table["pages"] - expected, 0) * block_size
+    return bloat, bloat / (table["pages"] * block_size)
+
+def index_bloat(index, widths, block_size):
+    """Returns (estimated bloat bytes, ratio) for a btree index, or (None, None)."""
+    columns = widths.get(index["table"], {})
+    if index["method"] != "btree" or not index["rows"] or index["pages"] <= 1:
+        return None, None
+    if any(column is None or column not in columns for column in index["columns"]):
+        # Expression columns have no per-column statistics here.
+        return None, None
+    data = sum(columns[column][0] * (1 - columns[column][1]) for column in index["columns"])
+    fillfactor = int(index["options"].get("fillfactor", DEFAULT_INDEX_FILLFACTOR))
+    usable = (block_size - BLOCK_HEADER - BTREE_SPECIAL) * fillfactor // 100
+    # Leaf pages, plus the metapage and roughly one internal page per hundred leaves.
+    leaves = expected_pages(index["rows"], INDEX_TUPLE_HEADER + align(math.ceil(data)), usable)
+    expected = leaves + 1 + math.ceil(leaves / 100)
+    bloat = max(index["pages"] - expected, 0) * block_size
+    return bloat, bloat / (index["pages"] * block_size)
+
+def declared_tables():
+    return {name for kind, name, _sql in declared_objects() if kind == "table"}
+
+def load_tables(cursor, declared):
+    keys = ("name", "declared", "rows", "pages", "size", "columns", "options", "live", "dead", "updates",
+            "hot_updates", "deletes", "seq_scans", "seq_rows", "index_scans", "modified", "last_vacuum",
+            "last_analyze", "autovacuums", "heap_hits", "heap_reads")
+    cursor.execute(SQL_TABLE_STATS)
+    tables = [dict(zip(keys, row)) for row in cursor.fetchall()]
+    for table in tables:
+        table["options"] = storage_options(table["options"])
+    return [t for t in tables if t["declared"] in declared or t["name"] in declared]
+
+def load_indexes(cursor, tables):
+    keys = ("name", "table", "method", "rows", "pages", "size", "options", "unique", "valid", "scans",
+            "columns", "hits", "reads")
+    cursor.execute(SQL_INDEX_STATS)
+    indexes = [dict(zip(keys, row)) for row in cursor.fetchall()]
+    for index in indexes:
+        index["options"] = storage_options(index["options"])
+    names = {t["name"] for t in tables}
+    return [i for i in indexes if i["table"] in names]
+
+def check_table(table, large_pages):
+    """Returns the findings for a table, and the settings that would address them."""
+    findings = []
+    settings = {}
+    live = table["live"] or 0
+    dead_ratio = ratio(table["dead"], live + table["dead"])
+    if dead_ratio is not None and dead_ratio >= DEAD_RATIO_WARN:
+        findings.append(f"{dead_ratio:.0%} dead tuples ({table['dead']}), last vacuumed {when(table['last_vacuum'])}")
+        settings.update(LARGE_TABLE_SETTINGS if table["pages"] >= large_pages else CHURN_SETTINGS)
+    if table["bloat_ratio"] is not None and table["bloat_ratio"] >= BLOAT_RATIO_WARN and table["bloat"] >= BLOAT_BYTES_MIN:
+        findings.append(f"~{table['bloat_ratio']:.0%} bloat ({mb(table['bloat'])}); "
+                        "reclaim with 'layout rewrite' or VACUUM FULL")
+    hot_ratio = ratio(table["hot_updates"], table["updates"])
+    if table["updates"] >= HOT_UPDATES_MIN and hot_ratio < HOT_RATIO_WARN:
+        findings.append(f"{hot_ratio:.0%} of {table['updates']} updates HOT; updates to indexed columns "
+                        "or full pages force new index entries")
+        if int(table["options"].get("fillfactor", 100)) > int(HOT_FILLFACTOR):
+            settings["fillfactor"] = HOT_FILLFACTOR
+    if table["seq_scans"] and table["pages"] >= large_pages:
+        share = ratio(table["seq_scans"], table["seq_scans"] + table["index_scans"])
+        findings.append(f"{table['seq_scans']} sequential scans on a {mb(table['size'])} table "
+                        f"({share:.0%} of scans, {table['seq_rows'] // table['seq_scans']} rows each)")
+    hit = ratio(table["heap_hits"], table["heap_hits"] + table["heap_reads"])
+    if table["heap_reads"] >= CACHE_READS_MIN and hit < TABLE_CACHE_HIT_WARN:
+        findings.append(f"heap cache hit ratio {hit:.1%}")
+    if table["modified"] > 50 + live // 10:
+        findings.append(f"{table['modified']} rows changed since last analyze ({when(table['last_analyze'])})")
+    # Only propose what the table does not already set.
+    settings = {k: v for k, v in settings.items() if table["options"].get(k) != v and k not in table["options"]}
+    return findings, settings
+
+def check_index(index):
+    findings = []
+    if not index["valid"]:
+        findings.append("invalid (interrupted concurrent build?); drop and rebuild")
+    if index["scans"] == 0 and not index["unique"]:
+        findings.append(f"unused ({mb(index['size'])}) since statistics were reset")
+    if index["bloat_ratio"] is not None and index["bloat_ratio"] >= BLOAT_RATIO_WARN and index["bloat"] >= BLOAT_BYTES_MIN:
+        findings.append(f"~{index['bloat_ratio']:.0%} bloat ({mb(index['bloat'])}); REINDEX CONCURRENTLY")
+    return findings
+
+def mb(size):
+    return f"{size / 1048576:.1f} MB"
+
+def pct(value):
+    return "-" if value is None else f"{value:.0%}"
+
+def when(timestamp):
+    return timestamp.strftime("%Y-%m-%d %H:%M") if timestamp else "never"
+
+def health(large_table_mb=DEFAULT_LARGE_TABLE_MB):
+    """Collects and checks the statistics of the declared tables and their indexes."""
+    conn = connect()
+    conn.autocommit = True
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SQL_DATABASE_STATS)
+        hits, reads, stats_reset, block_size, autovacuum = cursor.fetchone()
+        widths = column_widths(cursor)
+        tables = load_tables(cursor, declared_tables())
+        indexes = load_indexes(cursor, tables)
+    finally:
+        cursor.close()
+        conn.close()
+
+    large_pages = large_table_mb * 1048576 // block_size
+    for table in tables:
+        table["bloat"], table["bloat_ratio"] = table_bloat(table, widths, block_size)
+        table["findings"], table["settings"] = check_table(table, large_pages)
+    for index in indexes:
+        index["bloat"], index["bloat_ratio"] = index_bloat(index, widths, block_size)
+        index["findings"] = check_index(index)
+    database = {"cache_hit": ratio(hits, hits + reads), "stats_reset": stats_reset, "autovacuum": autovacuum,
+                "findings": []}
+    if database["cache_hit"] is not None and reads >= CACHE_READS_MIN and database["cache_hit"] < CACHE_HIT_WARN:
+        database["findings"].append(f"cache hit ratio {database['cache_hit']:.2%}; shared_buffers may be too small")
+    if autovacuum != "on":
+        database["findings"].append("autovacuum is off")
+    return database, tables, indexes
+
+def suggested_settings(tables):
+    """Returns ALTER TABLE statements applying the settings the checks proposed."""
+    statements = []
+    for table in tables:
+        if table["settings"]:
+            options = ", ".join(f"{k} = {v}" for k, v in sorted(table["settings"].items()))
+            statements.append(f"ALTER TABLE {table['name']} SET ({options});")
+    return statements
+
+def print_report(database, tables, indexes, suggest):
+    since = when(database["stats_reset"]) if database["stats_reset"] else "cluster start"
+    print(f"Statistics since {since}; database cache hit ratio {pct(database['cache_hit'])}.\n")
+    print(f"{'table':<26} {'size':>9} {'live':>9} {'dead':>5} {'bloat~':>6} {'HOT':>5} {'seq scans':>9} "
+          f"{'cache':>6}  last vacuum       last analyze")
+    for t in tables:
+        print(f"{t['name']:<26} {mb(t['size']):>9} {t['live']:>9} {pct(ratio(t['dead'], t['live'] + t['dead'])):>5} "
+              f"{pct(t['bloat_ratio']):>6} {pct(ratio(t['hot_updates'], t['updates'])):>5} {t['seq_scans']:>9} "
+              f"{pct(ratio(t['heap_hits'], t['heap_hits'] + t['heap_reads'])):>6}  "
+              f"{when(t['last_vacuum']):<17} {when(t['last_analyze'])}")
+
+    print(f"\n{'index':<40} {'table':<26} {'size':>9} {'scans':>9} {'bloat~':>6}")
+    for i in indexes:
+        print(f"{i['name']:<40} {i['table']:<26} {mb(i['size']):>9} {i['scans']:>9} {pct(i['bloat_ratio']):>6}")
+
+    print("\nNeeds attention:")
+    flagged = [("database", f) for f in database["findings"]]
+    flagged += [(f"table {t['name']}", f) for t in tables for f in t["findings"]]
+    flagged += [(f"index {i['name']}", f) for i in indexes for f in i["findings"]]
+    for subject, finding in flagged:
+        print(f"  {subject}: {finding}")
+    if not flagged:
+        print("  nothing")
+
+    if suggest:
+        statements = suggested_settings(tables)
+        print("\nSuggested settings:")
+        for sql in statements:
+            print(f"  {sql}")
+        if any("fillfactor" in t["settings"] for t in tables):
+            print("  -- fillfactor only applies to newly written pages; rewrite the table to apply it throughout.")
+        if not statements:
+            print("  none")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report bloat, churn and usage of the declared tables and indexes.")
+    parser.add_argument("--large-table-mb", type=int, default=DEFAULT_LARGE_TABLE_MB,
+                        help="tables at least this large are flagged for sequential scans")
+    parser.add_argument("--suggest", action="store_true", help="print per-table autovacuum/fillfactor settings")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+    database, tables, indexes = health(large_table_mb=args.large_table_mb)
+    if args.json:
+        report = {"database": database, "tables": tables, "indexes": indexes, "suggested": suggested_settings(tables)}
+        print(json.dumps(report, indent=2, default=str))
+    else:
+        print_report(database, tables, indexes, args.suggest)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,218 @@
+
+import argparse
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import psycopg2
+
+from create_db_updated import DB_CONFIG, declared_objects, index_name, index_table
+
+# Builds the declared indexes with CREATE INDEX CONCURRENTLY, so that adding
+# an index to a live table never blocks writes. create_schema() uses it for
+# missing indexes on tables that already hold rows; running it before
+# deploying a schema revision that adds indexes keeps that work off the boot.
+#
+# Partitioned tables do not support concurrent builds directly: the index is
+# created ON ONLY the parent (invalid until every partition has one), built
+# concurrently on each partition, and the partition indexes are attached.
+
+# Declared indexes that exist but are marked INVALID, e.g. left behind by an
+# interrupted or cancelled concurrent build.
+SQL_INVALID_INDEXES = """
+    SELECT c.relname
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE NOT i.indisvalid AND c.relkind = 'i' AND n.nspname = current_schema() AND c.relname = ANY(%s);
+"""
+
+# Partitions of a table that have no index attached to the given parent index.
+SQL_UNINDEXED_PARTITIONS = """
+    SELECT c.relname
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = to_regclass(%(table)s) AND c.relkind = 'r'
+      AND NOT EXISTS (
+          SELECT 1 FROM pg_inherits ii
+          JOIN pg_index x ON x.indexrelid = ii.inhrelid
+          WHERE ii.inhparent = to_regclass(%(index)s) AND x.indrelid = c.oid
+      )
+    ORDER BY c.relname;
+"""
+
+SQL_IS_PARTITIONED = "SELECT coalesce((SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)), false);"
+
+SQL_BUILD_PROGRESS = """
+    SELECT p.pid, p.index_relid::regclass::text, p.relid::regclass::text, p.phase,
+           p.blocks_done, p.blocks_total, p.tuples_done, p.tuples_total
+    FROM pg_stat_progress_create_index p
+    WHERE p.datname = current_database();
+"""
+
+LOCK_TIMEOUT = "5s"
+LOCK_RETRIES = 6
+LOCK_BACKOFF_SECONDS = 1.0
+DEFAULT_WORKERS = 4
+PROGRESS_INTERVAL_SECONDS = 2.0
+
+def concurrent_sql(sql):
+    """Rewrites a declared CREATE INDEX statement to build concurrently."""
+    return sql.replace("CREATE INDEX IF NOT EXISTS", "CREATE INDEX CONCURRENTLY IF NOT EXISTS", 1).replace(
+        "CREATE UNIQUE INDEX IF NOT EXISTS", "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS", 1)
+
+def partition_index_sql(sql, partition):
+    """Rewrites a declared CREATE INDEX statement for one partition of its table."""
+    name = index_name(sql)
+    return sql.replace(f" {name} ", f" {name}_{partition} ", 1).replace(
+        f" ON {index_table(sql)} ", f" ON {partition} ", 1)
+
+def group_by_table(statements):
+    """Groups index statements by table.
+
+    Concurrent builds on the same table wait for each other's SHARE UPDATE
+    EXCLUSIVE lock, so only builds on different tables are independent.
+    """
+    groups = {}
+    for sql in statements:
+        groups.setdefault(index_table(sql), []).append(sql)
+    return groups
+
+def find_invalid(cursor, names):
+    """Returns the subset of names that exist as INVALID indexes."""
+    cursor.execute(SQL_INVALID_INDEXES, (list(names),))
+    return [row[0] for row in cursor.fetchall()]
+
+def drop_invalid(cursor, name):
+    """Drops an INVALID leftover so the next build does not skip it via IF NOT EXISTS."""
+    print(f"[{name}] dropping INVALID leftover from a failed build")
+    cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+
+def build_index(cursor, sql):
+    """Builds one index concurrently, retrying with backoff when its lock is not granted."""
+    name = index_name(sql)
+    for attempt in range(1, LOCK_RETRIES + 1):
+        started = time.monotonic()
+        try:
+            cursor.execute(concurrent_sql(sql))
+            print(f"[{name}] built in {time.monotonic() - started:.1f}s")
+            return
+        except psycopg2.errors.LockNotAvailable:
+            # lock_timeout can also fire while the build waits for older
+            # transactions, after the index entry exists; clear it first.
+            if find_invalid(cursor, [name]):
+                drop_invalid(cursor, name)
+            if attempt == LOCK_RETRIES:
+                raise
+            delay = LOCK_BACKOFF_SECONDS * 2 ** (attempt - 1)
+            print(f"[{name}] lock not granted within {LOCK_TIMEOUT} (attempt {attempt}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+        except psycopg2.errors.UniqueViolation:
+            # A unique build that found duplicates leaves an INVALID index
+            # that still rejects new duplicates; drop it until they are merged.
+            drop_invalid(cursor, name)
+            raise
+
+def build_partitioned_index(cursor, sql):
+    """Builds a partitioned table's index one partition at a time, then attaches the pieces."""
+    name = index_name(sql)
+    table = index_table(sql)
+    # Catalog-only on the parent, so it only needs its lock briefly.
+    cursor.execute(sql.replace(f" ON {table} ", f" ON ONLY {table} ", 1))
+    cursor.execute(SQL_UNINDEXED_PARTITIONS, {"table": table, "index": name})
+    for (partition,) in cursor.fetchall():
+        partition_sql = partition_index_sql(sql, partition)
+        if find_invalid(cursor, [index_name(partition_sql)]):
+            drop_invalid(cursor, index_name(partition_sql))
+        build_index(cursor, partition_sql)
+        cursor.execute(f"ALTER INDEX {name} ATTACH PARTITION {index_name(partition_sql)};")
+    print(f"[{name}] attached on every partition of {table}")
+
+def build_table_indexes(table, statements, config=None):
+    """Builds every index for one table, sequentially, on a dedicated connection."""
+    conn = psycopg2.connect(**(config or DB_CONFIG))
+    conn.autocommit = True
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SET lock_timeout = '{LOCK_TIMEOUT}';")
+        for name in find_invalid(cursor, [index_name(sql) for sql in statements]):
+            drop_invalid(cursor, name)
+        cursor.execute(SQL_IS_PARTITIONED, (table,))
+        build = build_partitioned_index if cursor.fetchone()[0] else build_index
+        for sql in statements:
+            build(cursor, sql)
+        return table
+    finally:
+        cursor.close()
+        conn.close()
+
+def report_progress(stop, interval, config=None):
+    """Prints pg_stat_progress_create_index rows until stop is set."""
+    conn = psycopg2.connect(**(config or DB_CONFIG))
+    conn.autocommit = True
+    cursor = conn.cursor()
+    try:
+        while not stop.wait(interval):
+            cursor.execute(SQL_BUILD_PROGRESS)
+            for pid, index, table, phase, blocks_done, blocks_total, tuples_done, tuples_total in cursor.fetchall():
+                if blocks_total:
+                    detail = f"{100.0 * blocks_done / blocks_total:.0f}% of {blocks_total} blocks"
+                elif tuples_total:
+                    detail = f"{100.0 * tuples_done / tuples_total:.0f}% of {tuples_total} tuples"
+                else:
+                    detail = ""
+                print(f"  progress pid={pid} {index or '?'} on {table}: {phase} {detail}".rstrip())
+    finally:
+        cursor.close()
+        conn.close()
+
+def build_indexes(workers=DEFAULT_WORKERS, progress_interval=PROGRESS_INTERVAL_SECONDS, statements=None, config=None):
+    """Builds declared indexes concurrently on a bounded worker pool.
+
+    config holds connection parameters and defaults to DB_CONFIG.
+    """
+    if statements is None:
+        statements = [sql for kind, _name, sql in declared_objects() if kind == 'index']
+    groups = group_by_table(statements)
+    print(f"Building {sum(len(s) for s in groups.values())} indexes on {len(groups)} tables "
+          f"with up to {workers} workers...")
+
+    stop = threading.Event()
+    monitor = None
+    if progress_interval:
+        monitor = threading.Thread(target=report_progress, args=(stop, progress_interval, config), daemon=True)
+        monitor.start()
+
+    failures = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(build_table_indexes, table, sqls, config): table for table, sqls in groups.items()}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except psycopg2.Error as e:
+                    print(f"Index build on {futures[future]} failed: {e}")
+                    failures.append(futures[future])
+    finally:
+        stop.set()
+        if monitor:
+            monitor.join()
+
+    if failures:
+        raise RuntimeError(f"Index builds failed on: {', '.join(sorted(failures))}")
+    print("All indexes built.")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build declared indexes with CREATE INDEX CONCURRENTLY.")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="maximum number of parallel builds")
+    parser.add_argument(
+        "--progress-interval",
+        type=float,
+        default=PROGRESS_INTERVAL_SECONDS,
+        help="seconds between progress reports (0 disables them)",
+    )
+    args = parser.parse_args(argv)
+    build_indexes(workers=args.workers, progress_interval=args.progress_interval)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,241 @@
+
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime, timezone
+import psycopg2
+import psycopg2.extensions
+
+# Per-statement instrumentation for create_schema().
+#
+# A StatementRecorder hands create_schema() a cursor that times every
+# statement it runs and keeps its rows affected and outcome (ok, skipped as
+# an existing object, or failed with its SQLSTATE). While a statement runs,
+# a sampler thread on a second connection polls pg_stat_activity and
+# pg_locks for the schema session. Samples taken while the session waits on
+# a heavyweight lock are added to that statement's lock wait. The sampler
+# also records the lock requested and the pids holding it, so a deploy
+# blocked behind a long transaction shows who blocked it and for how long.
+# Lock wait is only as precise as the sampling interval.
+#
+# write_report() saves the run as JSON. write_metrics() saves it in the
+# Prometheus text format for node_exporter's textfile collector, so alerts
+# can fire on slow or blocked steps. Both files are replaced atomically.
+
+DEFAULT_SAMPLE_INTERVAL = 0.05
+METRIC_PREFIX = "plenaire_schema"
+
+# Errors apply_statements() treats as "already exists".
+DUPLICATE_CODES = ("42P07", "42710")
+
+SQL_SESSION_WAIT = """
+    SELECT a.wait_event_type, a.wait_event, pg_blocking_pids(a.pid),
+           (SELECT string_agg(DISTINCT concat_ws(' ', l.locktype, l.relation::regclass::text, l.mode), ', ')
+            FROM pg_locks l WHERE l.pid = a.pid AND NOT l.granted)
+    FROM pg_stat_activity a
+    WHERE a.pid = %s;
+"""
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """Cursor that reports every execute() to its recorder."""
+
+    recorder = None
+
+    def execute(self, query, vars=None):
+        if self.recorder is None:
+            return super().execute(query, vars)
+        record = self.recorder.begin(query)
+        try:
+            result = super().execute(query, vars)
+        except psycopg2.Error as e:
+            self.recorder.end(record, "skipped" if e.pgcode in DUPLICATE_CODES else "failed", error=e)
+            raise
+        except Exception as e:
+            self.recorder.end(record, "failed", error=e)
+            raise
+        self.recorder.end(record, "ok", rows=self.rowcount)
+        return result
+
+class StatementRecorder:
+    """Collects per-statement timings and lock waits for one create_schema() run."""
+
+    def __init__(self, objects=(), sample_interval=DEFAULT_SAMPLE_INTERVAL):
+        # Declared (kind, name, sql) triples, used to label statements.
+        self.labels = {sql.strip(): (kind, name) for kind, name, sql in objects}
+        self.sample_interval = sample_interval
+        self.records = []
+        self.run = {}
+        self._current = None
+        self._state = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def cursor(self, conn):
+        """Returns a cursor on conn whose statements are recorded."""
+        cursor = conn.cursor(cursor_factory=InstrumentedCursor)
+        cursor.recorder = self
+        return cursor
+
+    def start(self, config, conn, mode):
+        """Starts the run and the lock sampler watching conn's backend."""
+        self.run = {
+            "database": config.get("database"),
+            "host": config.get("host"),
+            "mode": mode,
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "sample_interval_s": self.sample_interval,
+        }
+        self._started = time.monotonic()
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample, args=(config, conn.get_backend_pid()), daemon=True)
+        self._sampler.start()
+
+    def finish(self, outcome, error=None):
+        """Stops the sampler and records the run's outcome."""
+        self._stop.set()
+        if self._sampler:
+            self._sampler.join()
+        self.run["duration_s"] = round(time.monotonic() - self._started, 6)
+        self.run["outcome"] = outcome
+        self.run["error"] = first_line(error)
+        self.run["finished_at"] = datetime.now(timezone.utc).isoformat()
+
+    def label(self, sql):
+        """Returns (kind, name) for a statement: its declared object, or the start of its text."""
+        text = sql.decode("utf-8") if isinstance(sql, bytes) else sql
+        if text.strip() in self.labels:
+            return self.labels[text.strip()]
+        return "query", " ".join(text.split())[:80]
+
+    def begin(self, sql):
+        kind, name = self.label(sql)
+        record = {
+            "index": len(self.records),
+            "kind": kind,
+            "name": name,
+            "offset_s": round(time.monotonic() - self._started, 6),
+            "wall_s": None,
+            "lock_wait_s": 0.0,
+            "waited_for": [],
+            "blocking_pids": [],
+            "rows": None,
+            "outcome": "running",
+            "sqlstate": None,
+            "error": None,
+        }
+        record["_started"] = time.monotonic()
+        with self._state:
+            self.records.append(record)
+            self._current = record
+        return record
+
+    def end(self, record, outcome, rows=None, error=None):
+        with self._state:
+            self._current = None
+            record["wall_s"] = round(time.monotonic() - record.pop("_started"), 6)
+            record["lock_wait_s"] = round(record["lock_wait_s"], 6)
+            # rowcount is -1 for statements that return no row count (DDL).
+            record["rows"] = rows if rows is not None and rows >= 0 else None
+            record["outcome"] = outcome
+            record["sqlstate"] = getattr(error, "pgcode", None)
+            record["error"] = first_line(error)
+
+    def _sample(self, config, pid):
+        """Polls the schema session's wait state until finish()."""
+        conn = psycopg2.connect(**config)
+        conn.autocommit = True
+        cursor = conn.cursor()
+        last = time.monotonic()
+        try:
+            while not self._stop.wait(self.sample_interval):
+                cursor.execute(SQL_SESSION_WAIT, (pid,))
+                row = cursor.fetchone()
+                now = time.monotonic()
+                elapsed, last = now - last, now
+                if row is None or row[0] != "Lock":
+                    continue
+                _type, event, blockers, waiting = row
+                with self._state:
+                    record = self._current
+                    if record is None:
+                        continue
+                    record["lock_wait_s"] += elapsed
+                    wait = waiting or event
+                    if wait not in record["waited_for"]:
+                        record["waited_for"].append(wait)
+                    record["blocking_pids"] = sorted(set(record["blocking_pids"]) | set(blockers or []))
+        finally:
+            cursor.close()
+            conn.close()
+
+    def summary(self):
+        """Returns the statement counts by outcome and the totals of wall time and lock wait."""
+        outcomes = {}
+        for record in self.records:
+            outcomes[record["outcome"]] = outcomes.get(record["outcome"], 0) + 1
+        return {
+            "statements": len(self.records),
+            "outcomes": outcomes,
+            "wall_s": round(sum(r["wall_s"] or 0 for r in self.records), 6),
+            "lock_wait_s": round(sum(r["lock_wait_s"] for r in self.records), 6),
+        }
+
+    def report(self):
+        """Returns the run as a JSON-serializable dict."""
+        return dict(self.run, summary=self.summary(), statements=self.records)
+
+    def slowest(self, count=5):
+        """Returns the count statements with the longest wall time."""
+        return sorted(self.records, key=lambda r: r["wall_s"] or 0, reverse=True)[:count]
+
+    def write_report(self, path):
+        write_atomically(path, json.dumps(self.report(), indent=2) + "\n")
+
+    def write_metrics(self, path):
+        """Writes the run as Prometheus gauges for the textfile collector."""
+        database = self.run.get("database")
+        lines = []
+
+        def gauge(name, help_text, samples):
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} gauge")
+            for labels, value in samples:
+                labels = dict({"database": database}, **labels)
+                rendered = ",".join(f'{key}="{escape_label(value)}"' for key, value in labels.items())
+                lines.append(f"{METRIC_PREFIX}_{name}{{{rendered}}} {value}")
+
+        summary = self.summary()
+        gauge("run_duration_seconds", "Duration of the last create_schema() run.",
+              [({"mode": self.run.get("mode")}, self.run.get("duration_s", 0))])
+        gauge("run_success", "1 if the last create_schema() run succeeded.",
+              [({"mode": self.run.get("mode")}, int(self.run.get("outcome") == "ok"))])
+        gauge("run_timestamp_seconds", "Unix time the last create_schema() run finished.",
+              [({}, round(time.time(), 3))])
+        gauge("run_lock_wait_seconds", "Sampled lock wait across the last run.", [({}, summary["lock_wait_s"])])
+        gauge("statements", "Statements in the last run by outcome.",
+              [({"outcome": outcome}, count) for outcome, count in sorted(summary["outcomes"].items())])
+        declared = [r for r in self.records if r["kind"] != "query"]
+        gauge("statement_duration_seconds", "Wall time of each declared statement in the last run.",
+              [({"kind": r["kind"], "name": r["name"], "outcome": r["outcome"]}, r["wall_s"] or 0) for r in declared])
+        gauge("statement_lock_wait_seconds", "Sampled lock wait of each declared statement in the last run.",
+              [({"kind": r["kind"], "name": r["name"]}, r["lock_wait_s"]) for r in declared])
+        write_atomically(path, "\n".join(lines) + "\n")
+
+def first_line(error):
+    """Returns the first line of an error message, or None."""
+    if error is None:
+        return None
+    text = str(error).strip()
+    return text.splitlines()[0] if text else type(error).__name__
+
+def escape_label(value):
+    """Escapes a Prometheus label value."""
+    return re.sub(r'(["\\])', r"\\\1", str(value)).replace("\n", r"\n")
+
+def write_atomically(path, text):
+    """Writes text to path through a temporary file, so readers never see it half written."""
+    with open(path + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,455 @@
+
+import argparse
+import re
+import sys
+import time
+import psycopg2
+
+from create_db_updated import DB_CONFIG, declared_objects
+from db_partitions import SQL_INDEX_CONSTRAINTS, SQL_TABLE_INDEXES, with_lock_retry
+
+# Storage layout analysis and compaction.
+#
+# Every column is stored at its type's alignment, so a BOOLEAN or INTEGER
+# declared before a TIMESTAMP or DOUBLE PRECISION is followed by padding in
+# every tuple. report samples each table, takes the stored size of every
+# value, and replays the heap's alignment rules over the sampled rows, both
+# in declaration order and in a proposed order (8-byte aligned columns first,
+# then 4, 2 and 1, then variable-length ones). It also narrows the columns in
+# SMALL_RANGE_COLUMNS when their values allow, and estimates the space saved
+# per million rows.
+#
+# rewrite applies the proposal to a live table without a long lock: it builds
+# a {table}_compact shadow, mirrors writes into it with a trigger, copies the
+# rows in keyset batches, builds the secondary indexes concurrently and swaps
+# the names in one short transaction. The old table is kept as {table}_legacy.
+
+# Columns whose values the application keeps small, and the narrower type
+# that holds them. Keys and counters are never narrowed.
+SMALL_RANGE_COLUMNS = {
+    ("reviews", "rating"): "smallint",
+    ("cart_items", "quantity"): "smallint",
+    ("order_items", "quantity"): "smallint",
+    ("users", "login_attempts"): "smallint",
+}
+
+TYPE_RANGES = {"smallint": 32767, "integer": 2147483647}
+# Fixed-length integers are aligned to their own length.
+TYPE_LENGTHS = {"smallint": 2, "integer": 4}
+ALIGNMENT = {"d": 8, "i": 4, "s": 2, "c": 1}
+
+HEAP_TUPLE_HEADER = 23
+LINE_POINTER = 4
+MAXALIGN = 8
+SHORT_VARLENA_MAX = 127
+DEFAULT_SAMPLE_ROWS = 10000
+DEFAULT_BATCH_SIZE = 5000
+
+SQL_TABLES = """
+    SELECT c.relname, greatest(c.reltuples, 0)::bigint, pg_table_size(c.oid)
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relkind = 'r' AND NOT c.relispartition
+      AND n.nspname = current_schema() AND c.relname = ANY(%s)
+    ORDER BY pg_table_size(c.oid) DESC;
+"""
+
+SQL_LAYOUT_COLUMNS = """
+    SELECT a.attname, format_type(a.atttypid, a.atttypmod), a.attlen, t.typalign, a.attnotnull,
+           a.attgenerated <> '', pg_get_expr(d.adbin, d.adrelid)
+    FROM pg_attribute a
+    JOIN pg_type t ON t.oid = a.atttypid
+    LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+    WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped
+    ORDER BY a.attnum;
+"""
+
+SQL_TABLE_CONSTRAINTS = """
+    SELECT conname, contype, pg_get_constraintdef(oid)
+    FROM pg_constraint
+    WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'c', 'f')
+    ORDER BY contype, conname;
+"""
+
+# Foreign keys on other tables that reference this one.
+SQL_REFERENCING_KEYS = """
+    SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid)
+    FROM pg_constraint
+    WHERE confrelid = %s::regclass AND contype = 'f' AND conrelid <> confrelid
+    ORDER BY conname;
+"""
+
+SQL_TABLE_TRIGGERS = """
+    SELECT tgname, pg_get_triggerdef(oid)
+    FROM pg_trigger
+    WHERE tgrelid = %s::regclass AND NOT tgisinternal
+    ORDER BY tgname;
+"""
+
+SQL_SECONDARY_INDEXES = """
+    SELECT c.relname, pg_get_indexdef(i.indexrelid)
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE i.indrelid = %s::regclass
+      AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = c.oid)
+    ORDER BY c.relname;
+"""
+
+SQL_ID_SEQUENCE = "SELECT pg_get_serial_sequence(%s, 'id');"
+
+class Column:
+    """One live column and what the proposed layout does with it."""
+
+    def __init__(self, name, type_, length, align, not_null, generated, default):
+        self.name = name
+        self.type = type_
+        self.length = length
+        self.align = ALIGNMENT[align]
+        self.not_null = not_null
+        self.generated = generated
+        self.default = default
+        self.new_type = type_
+        self.new_length = length
+        self.new_align = self.align
+
+    def narrow(self, type_):
+        self.new_type = type_
+        self.new_length = self.new_align = TYPE_LENGTHS[type_]
+
+    def stored_align(self, size, narrowed=False):
+        """Returns the alignment a value of this stored size gets: short varlenas are unaligned."""
+        if self.length == -1 and size <= SHORT_VARLENA_MAX:
+            return 1
+        return self.new_align if narrowed else self.align
+
+    def sort_key(self):
+        """Fixed-length columns by descending alignment, then variable-length ones."""
+        return (1, 0) if self.length < 0 else (0, -self.new_align)
+
+    def definition(self):
+        """Returns the column definition for the compacted table."""
+        parts = [self.name, self.new_type]
+        if self.generated:
+            parts.append(f"GENERATED ALWAYS AS ({self.default}) STORED")
+        elif self.default is not None:
+            parts.append(f"DEFAULT {self.default}")
+        if self.not_null:
+            parts.append("NOT NULL")
+        return " ".join(parts)
+
+def align_up(offset, align):
+    """Rounds offset up to a multiple of align."""
+    return (offset + align - 1) // align * align
+
+def connect():
+    """Opens a connection using DB_CONFIG."""
+    return psycopg2.connect(**DB_CONFIG)
+
+def declared_tables():
+    """Returns the names of every declared table."""
+    return [name for kind, name, _sql in declared_objects() if kind == 'table']
+
+def table_columns(cursor, table):
+    """Returns the live columns of table as Column objects."""
+    cursor.execute(SQL_LAYOUT_COLUMNS, (table,))
+    return [Column(*row) for row in cursor.fetchall()]
+
+def sample_sizes(cursor, table, columns, rows, sample_rows):
+    """Returns the stored size of every value (None for NULL) in a sample of rows."""
+    percent = min(100.0, 100.0 * sample_rows / max(rows, 1))
+    sizes = ", ".join(f"pg_column_size({c.name})" for c in columns)
+    cursor.execute(f"SELECT {sizes}, pg_column_size(t.*) FROM {table} t TABLESAMPLE BERNOULLI (%s) LIMIT %s;",
+                   (percent, sample_rows))
+    return cursor.fetchall()
+
+def tuple_size(columns, sizes, order, narrowed):
+    """Replays heap_fill_tuple's alignment for one row; returns (tuple bytes, padding bytes)."""
+    header = HEAP_TUPLE_HEADER
+    if any(size is None for size in sizes[:len(columns)]):
+        header += (len(columns) + 7) // 8
+    offset = padding = 0
+    for index in order:
+        size = sizes[index]
+        if size is None:
+            continue
+        column = columns[index]
+        if narrowed and column.new_type != column.type:
+            size = column.new_length
+        align = column.stored_align(size, narrowed)
+        aligned = align_up(offset, align)
+        padding += aligned - offset
+        offset = aligned + size
+    return align_up(align_up(header, MAXALIGN) + offset, MAXALIGN), padding
+
+def propose(cursor, table, columns):
+    """Narrows SMALL_RANGE_COLUMNS whose values fit and returns the proposed column order."""
+    for column in columns:
+        narrow = SMALL_RANGE_COLUMNS.get((table, column.name))
+        if narrow and column.type != narrow:
+            cursor.execute(f"SELECT max(abs({column.name}::bigint)) FROM {table};")
+            largest = cursor.fetchone()[0] or 0
+            if largest <= TYPE_RANGES[narrow]:
+                column.narrow(narrow)
+    return sorted(range(len(columns)), key=lambda index: columns[index].sort_key())
+
+def analyze_table(cursor, table, rows, sample_rows=DEFAULT_SAMPLE_ROWS):
+    """Returns the layout analysis of one table as a dict."""
+    columns = table_columns(cursor, table)
+    order = propose(cursor, table, columns)
+    sample = sample_sizes(cursor, table, columns, rows, sample_rows)
+    declared = list(range(len(columns)))
+    current = [tuple_size(columns, row, declared, False) for row in sample]
+    proposed = [tuple_size(columns, row, order, True) for row in sample]
+    count = max(len(sample), 1)
+    tuple_bytes = sum(size for size, _padding in current) / count
+    proposed_bytes = sum(size for size, _padding in proposed) / count
+    return {
+        "table": table,
+        "rows": rows,
+        "sampled": len(sample),
+        "measured": sum(row[-1] for row in sample) / count,
+        "tuple": tuple_bytes,
+        "padding": sum(padding for _size, padding in current) / count,
+        "proposed_tuple": proposed_bytes,
+        "proposed_padding": sum(padding for _size, padding in proposed) / count,
+        "saved": tuple_bytes - proposed_bytes,
+        "columns": columns,
+        "order": order,
+        "narrowed": [(c.name, c.type, c.new_type) for c in columns if c.new_type != c.type],
+        "reordered": order != declared,
+    }
+
+def report(tables=None, sample_rows=DEFAULT_SAMPLE_ROWS):
+    """Prints the layout analysis of each table, largest first; returns the analyses."""
+    conn = connect()
+    cursor = conn.cursor()
+    results = []
+    try:
+        cursor.execute(SQL_TABLES, (tables or declared_tables(),))
+        for table, rows, size in cursor.fetchall():
+            result = analyze_table(cursor, table, rows, sample_rows)
+            results.append(result)
+            saved = result["saved"]
+            print(f"\n{table}: ~{rows} rows, {size / 1024 / 1024:.1f} MB, {result['sampled']} sampled")
+            if not result["sampled"]:
+                print("  no rows to measure")
+                continue
+            print(f"  measured row {result['measured']:.1f} B; heap tuple {result['tuple']:.1f} B "
+                  f"+ {LINE_POINTER} B line pointer, {result['padding']:.1f} B of alignment padding")
+            if saved <= 0:
+                # Tuples are padded to a multiple of MAXALIGN, which can
+                # absorb the bytes a reorder or narrower type frees.
+                print("  layout is already compact")
+                continue
+            for name, old, new in result["narrowed"]:
+                print(f"  narrow {name}: {old} -> {new}")
+            if result["reordered"]:
+                print(f"  order: {', '.join(result['columns'][index].name for index in result['order'])}")
+            print(f"  proposed tuple {result['proposed_tuple']:.1f} B ({result['proposed_padding']:.1f} B padding): "
+                  f"saves {saved:.1f} B/row, {saved * 1000000 / 1024 / 1024:.1f} MB per million rows"
+                  f"{f', ~{saved * rows / 1024 / 1024:.1f} MB here' if rows else ''}")
+        conn.commit()
+        return results
+    finally:
+        cursor.close()
+        conn.close()
+
+def shadow_statements(cursor, table, shadow, columns, order):
+    """Returns the DDL creating the empty compacted shadow of table.
+
+    Primary key, unique and check constraints are created with it; unique
+    constraint names get a _compact suffix, renamed back during the swap.
+    """
+    definitions = [columns[index].definition() for index in order]
+    cursor.execute(SQL_TABLE_CONSTRAINTS, (table,))
+    for name, kind, definition in cursor.fetchall():
+        if kind in ('p', 'u'):
+            definitions.append(f"CONSTRAINT {name}_compact {definition}")
+        elif kind == 'c':
+            definitions.append(f"CONSTRAINT {name} {definition}")
+    return [f"CREATE TABLE {shadow} ({', '.join(definitions)});"]
+
+def mirror_statements(table, shadow, columns):
+    """Returns the trigger that replays writes on the live table into the shadow."""
+    stored = [c.name for c in columns if not c.generated]
+    return [
+        f"""
+        CREATE OR REPLACE FUNCTION {table}_layout_mirror() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                DELETE FROM {shadow} WHERE id = OLD.id;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO {shadow} ({', '.join(stored)}) VALUES ({', '.join(f'NEW.{name}' for name in stored)});
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        f"CREATE OR REPLACE TRIGGER trg_{table}_layout_mirror AFTER INSERT OR UPDATE OR DELETE ON {table} "
+        f"FOR EACH ROW EXECUTE FUNCTION {table}_layout_mirror();",
+    ]
+
+def copy_batches(conn, cursor, table, shadow, columns, batch_size, pause):
+    """Copies rows into the shadow in keyset batches, one commit per batch.
+
+    FOR UPDATE holds back concurrent writes to the batch's rows until it
+    commits, after which the mirror trigger replays them; rows the trigger
+    already copied are skipped by the primary key.
+    """
+    column_list = ", ".join(c.name for c in columns if not c.generated)
+    last_id = 0
+    copied = 0
+    started = time.monotonic()
+    while True:
+        cursor.execute(f"SELECT max(id) FROM (SELECT id FROM {table} WHERE id > %s ORDER BY id LIMIT %s) batch;",
+                       (last_id, batch_size))
+        batch_end = cursor.fetchone()[0]
+        if batch_end is None:
+            conn.rollback()
+            break
+        cursor.execute(
+            f"INSERT INTO {shadow} ({column_list}) "
+            f"SELECT {column_list} FROM {table} WHERE id > %s AND id <= %s ORDER BY id FOR UPDATE "
+            f"ON CONFLICT DO NOTHING;",
+            (last_id, batch_end),
+        )
+        copied += cursor.rowcount
+        conn.commit()
+        last_id = batch_end
+        print(f"[{table}] copied through id {last_id} ({copied} rows)")
+        if pause:
+            time.sleep(pause)
+    print(f"[{table}] copy complete: {copied} rows in {time.monotonic() - started:.1f}s")
+
+def build_shadow_indexes(conn, cursor, table, shadow):
+    """Builds the table's secondary indexes on the shadow concurrently, with a _compact suffix."""
+    cursor.execute(SQL_SECONDARY_INDEXES, (table,))
+    indexes = cursor.fetchall()
+    conn.commit()
+    conn.autocommit = True
+    try:
+        for name, definition in indexes:
+            sql = re.sub(rf"^CREATE (UNIQUE )?INDEX {name} ON (\w+\.)?{table} ",
+                         rf"CREATE \1INDEX CONCURRENTLY IF NOT EXISTS {name}_compact ON {shadow} ", definition)
+            started = time.monotonic()
+            cursor.execute(sql)
+            print(f"[{table}] built {name}_compact in {time.monotonic() - started:.1f}s")
+    finally:
+        conn.autocommit = False
+
+def swap_statements(cursor, table, shadow):
+    """Returns (statements putting the shadow in place, foreign keys to validate afterwards)."""
+    legacy = f"{table}_legacy"
+    cursor.execute(SQL_TABLE_TRIGGERS, (table,))
+    triggers = [definition for name, definition in cursor.fetchall() if name != f"trg_{table}_layout_mirror"]
+    cursor.execute(SQL_TABLE_CONSTRAINTS, (table,))
+    outgoing = [(name, definition) for name, kind, definition in cursor.fetchall() if kind == 'f']
+    cursor.execute(SQL_REFERENCING_KEYS, (table,))
+    incoming = cursor.fetchall()
+    cursor.execute(SQL_ID_SEQUENCE, (table,))
+    sequence = cursor.fetchone()[0]
+
+    statements = [
+        f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE;",
+        f"DROP TRIGGER trg_{table}_layout_mirror ON {table};",
+        f"DROP FUNCTION {table}_layout_mirror();",
+        f"ALTER TABLE {table} RENAME TO {legacy};",
+    ]
+    cursor.execute(SQL_INDEX_CONSTRAINTS, (table,))
+    for (name,) in cursor.fetchall():
+        statements.append(f"ALTER TABLE {legacy} RENAME CONSTRAINT {name} TO {name}_legacy;")
+    cursor.execute(SQL_TABLE_INDEXES, (table,))
+    for (name,) in cursor.fetchall():
+        statements.append(f"ALTER INDEX {name} RENAME TO {name}_legacy;")
+
+    statements.append(f"ALTER TABLE {shadow} RENAME TO {table};")
+    cursor.execute(SQL_INDEX_CONSTRAINTS, (shadow,))
+    for (name,) in cursor.fetchall():
+        statements.append(f"ALTER TABLE {table} RENAME CONSTRAINT {name} TO {name[:-len('_compact')]};")
+    cursor.execute(SQL_TABLE_INDEXES, (shadow,))
+    for (name,) in cursor.fetchall():
+        statements.append(f"ALTER INDEX {name} RENAME TO {name[:-len('_compact')]};")
+
+    # Foreign keys are added NOT VALID under the swap lock and validated
+    # afterwards, which only takes SHARE UPDATE EXCLUSIVE.
+    validate = []
+    for name, definition in outgoing:
+        statements.append(f"ALTER TABLE {table} ADD CONSTRAINT {name} {definition} NOT VALID;")
+        validate.append((table, name))
+    for referencing, name, definition in incoming:
+        statements.append(f"ALTER TABLE {referencing} DROP CONSTRAINT {name};")
+        statements.append(f"ALTER TABLE {referencing} ADD CONSTRAINT {name} {definition} NOT VALID;")
+        validate.append((referencing, name))
+    if sequence:
+        statements.append(f"ALTER SEQUENCE {sequence} OWNED BY {table}.id;")
+    # Triggers stay behind on the legacy table; recreate them on the new one.
+    statements.extend(f"{definition};" for definition in triggers)
+    return statements, validate
+
+def rewrite_table(table, batch_size=DEFAULT_BATCH_SIZE, pause=0.0):
+    """Rewrites table into the proposed layout without a long lock."""
+    shadow = f"{table}_compact"
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SQL_TABLES, ([table],))
+        row = cursor.fetchone()
+        if row is None:
+            raise RuntimeError(f"{table} is not a plain table in the current schema")
+        result = analyze_table(cursor, table, row[1])
+        columns, order = result["columns"], result["order"]
+        if "id" not in [c.name for c in columns]:
+            raise RuntimeError(f"{table} has no id column to copy by")
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (shadow,))
+        exists = cursor.fetchone()[0]
+        conn.commit()
+        if result["saved"] <= 0 and not exists:
+            print(f"[{table}] layout is already compact.")
+            return
+
+        if not exists:
+            print(f"[{table}] creating {shadow}: {', '.join(columns[index].definition() for index in order)}")
+            for sql in shadow_statements(cursor, table, shadow, columns, order):
+                cursor.execute(sql)
+            conn.commit()
+        # Installing the trigger needs a brief SHARE ROW EXCLUSIVE lock.
+        with_lock_retry(conn, cursor, table, mirror_statements(table, shadow, columns))
+        copy_batches(conn, cursor, table, shadow, columns, batch_size, pause)
+        build_shadow_indexes(conn, cursor, table, shadow)
+
+        print(f"[{table}] swapping {shadow} into place")
+        statements, validate = swap_statements(cursor, table, shadow)
+        conn.commit()
+        with_lock_retry(conn, cursor, table, statements)
+        for referencing, name in validate:
+            with_lock_retry(conn, cursor, name, [f"ALTER TABLE {referencing} VALIDATE CONSTRAINT {name};"])
+        conn.autocommit = True
+        cursor.execute(f"ANALYZE {table};")
+        print(f"[{table}] rewritten; the old table remains as {table}_legacy until you drop it.")
+    finally:
+        cursor.close()
+        conn.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyze and compact table storage layouts.")
+    actions = parser.add_subparsers(dest="action", required=True)
+
+    report_parser = actions.add_parser("report", help="measure padding and propose compact layouts")
+    report_parser.add_argument("--table", action="append", help="table to analyze (default every declared table)")
+    report_parser.add_argument("--sample-rows", type=int, default=DEFAULT_SAMPLE_ROWS)
+
+    rewrite_parser = actions.add_parser("rewrite", help="rewrite a table into the proposed layout online")
+    rewrite_parser.add_argument("table", nargs="+")
+    rewrite_parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    rewrite_parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+
+    args = parser.parse_args(argv)
+    if args.action == "report":
+        report(tables=args.table, sample_rows=args.sample_rows)
+    elif args.action == "rewrite":
+        for table in args.table:
+            rewrite_table(table, batch_size=args.batch_size, pause=args.pause)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,340 @@
+
+import argparse
+import base64
+import binascii
+import csv
+import json
+import re
+import sys
+import time
+import uuid
+from datetime import datetime
+import psycopg2
+
+from create_db_updated import DB_CONFIG, declared_objects
+from db_indexes import build_indexes
+from db_newsletter import open_text
+
+# Keyset-paginated reads and exports for admin listings.
+#
+# The admin listings (getAllOrders, getAllUsers, getAllReviews,
+# getAllEnquiries, getAllNewsletterSubscriptions) each load a whole table.
+# This module reads any declared table with id and created_at columns
+# instead in one of two ways:
+#
+#   fetch_page()  one page, newest first by default, continuing after an
+#                 opaque cursor token taken from the previous page. The
+#                 WHERE (created_at, id) < (token) condition starts an index
+#                 scan right at the token, so page 10,000 costs what page 1
+#                 does; OFFSET would read and discard every earlier row.
+#   iter_rows()   every row through a named (server-side) cursor that
+#                 fetches itersize rows per round trip. export_table()
+#                 streams them to CSV or NDJSON in constant memory, inside
+#                 one REPEATABLE READ READ ONLY transaction so the file is
+#                 a consistent snapshot.
+#
+# Both order by (created_at, id), which the declared *_created_id indexes
+# cover in either direction; id breaks ties between rows created in the
+# same microsecond. created_at is nullable, and a row comparison never
+# matches NULL, so rows without one are read as a separate segment ordered
+# by id, after the dated rows when newest first and before them when oldest
+# first. --since and --until only match dated rows.
+#
+# users.password is never read unless asked for by name with --columns.
+#
+# 'listing indexes' builds the keyset indexes concurrently on an existing
+# database, then drops idx_orders_created_at, which idx_orders_created_id
+# supersedes.
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+DEFAULT_ITERSIZE = 2000
+PROGRESS_EVERY = 100000
+
+# Columns left out unless requested by name.
+HIDDEN_COLUMNS = {"users": ("password",)}
+
+KEYSET_INDEXES = (
+    "idx_orders_created_id",
+    "idx_users_created_id",
+    "idx_reviews_created_id",
+    "idx_enquiries_created_id",
+    "idx_newsletter_subscriptions_created_id",
+)
+SUPERSEDED_INDEXES = ("idx_orders_created_at",)
+
+FORMATS = ("csv", "ndjson")
+
+SQL_TABLE_COLUMNS = """
+    SELECT attname FROM pg_attribute
+    WHERE attrelid = to_regclass(%s) AND attnum > 0 AND NOT attisdropped
+    ORDER BY attnum;
+"""
+
+# Valid indexes on each table that lead with (created_at, id).
+SQL_KEYSET_INDEXES = """
+    SELECT t.relname, c.relname
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    JOIN pg_class t ON t.oid = i.indrelid
+    WHERE t.relname = ANY(%s) AND i.indisvalid AND i.indpred IS NULL
+      AND i.indnatts >= 2
+      AND (SELECT attname FROM pg_attribute WHERE attrelid = t.oid AND attnum = i.indkey[0]) = 'created_at'
+      AND (SELECT attname FROM pg_attribute WHERE attrelid = t.oid AND attnum = i.indkey[1]) = 'id';
+"""
+
+SQL_ROW_ESTIMATES = """
+    SELECT relname, reltuples::bigint FROM pg_class WHERE relname = ANY(%s) AND relkind IN ('r', 'p');
+"""
+
+SQL_VALID_INDEXES = """
+    SELECT c.relname
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE i.indisvalid AND c.relname = ANY(%s);
+"""
+
+CREATED_AT_RE = re.compile(r"^\s*created_at\s+TIMESTAMP", re.IGNORECASE | re.MULTILINE)
+ID_RE = re.compile(r"^\s*id\s+\w+", re.IGNORECASE | re.MULTILINE)
+
+def connect():
+    """Opens a connection using DB_CONFIG."""
+    return psycopg2.connect(**DB_CONFIG)
+
+def listable_tables():
+    """Returns the declared tables that have id and created_at columns, in declaration order."""
+    return [name for kind, name, sql in declared_objects()
+            if kind == 'table' and "PARTITION OF" not in sql and CREATED_AT_RE.search(sql) and ID_RE.search(sql)]
+
+def select_columns(cursor, table, columns=None):
+    """Validates table and the requested columns; returns the columns to read."""
+    if table not in listable_tables():
+        raise RuntimeError(f"'{table}' is not a declared table with id and created_at columns; "
+                           f"choose one of: {', '.join(listable_tables())}")
+    cursor.execute(SQL_TABLE_COLUMNS, (table,))
+    available = [row[0] for row in cursor.fetchall()]
+    if not available:
+        raise RuntimeError(f"Table '{table}' does not exist in this database.")
+    if not columns:
+        return [name for name in available if name not in HIDDEN_COLUMNS.get(table, ())]
+    unknown = [name for name in columns if name not in available]
+    if unknown:
+        raise RuntimeError(f"Unknown columns of {table}: {', '.join(unknown)}")
+    return list(columns)
+
+def encode_token(created_at, row_id):
+    """Returns the opaque cursor token for the position after one row."""
+    key = [created_at.isoformat() if created_at is not None else None, str(row_id)]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip("=")
+
+def decode_token(token):
+    """Returns the (created_at, id) position encoded in a cursor token."""
+    try:
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        return (datetime.fromisoformat(created_at) if created_at is not None else None), row_id
+    except (binascii.Error, ValueError, TypeError) as e:
+        raise RuntimeError(f"Invalid cursor token: {token}") from e
+
+def segments(direction, after=None, since=None, until=None):
+    """Returns the segments ('dated', 'undated') still to read, in listing order."""
+    order = ["dated", "undated"] if direction == "desc" else ["undated", "dated"]
+    if since is not None or until is not None:
+        order.remove("undated")
+    if after is not None:
+        current = "dated" if after[0] is not None else "undated"
+        order = order[order.index(current):] if current in order else []
+    return order
+
+def segment_query(table, columns, segment, direction, after=None, since=None, until=None, limit=None):
+    """Returns (sql, params) reading one segment in listing order, after a position."""
+    direction = "DESC" if direction == "desc" else "ASC"
+    comparison = "<" if direction == "DESC" else ">"
+    conditions, params = [], []
+    if segment == "dated":
+        conditions.append("created_at IS NOT NULL")
+        if after is not None and after[0] is not None:
+            conditions.append(f"(created_at, id) {comparison} (%s, %s)")
+            params.extend(after)
+        if since is not None:
+            conditions.append("created_at >= %s")
+            params.append(since)
+        if until is not None:
+            conditions.append("created_at < %s")
+            params.append(until)
+        order = f"created_at {direction}, id {direction}"
+    else:
+        conditions.append("created_at IS NULL")
+        if after is not None and after[0] is None:
+            conditions.append(f"id {comparison} %s")
+            params.append(after[1])
+        order = f"id {direction}"
+    query = (f"SELECT created_at, id, {', '.join(columns)} FROM {table} "
+             f"WHERE {' AND '.join(conditions)} ORDER BY {order}")
+    if limit is not None:
+        query += " LIMIT %s"
+        params.append(limit)
+    return query, params
+
+def fetch_page(cursor, table, limit=DEFAULT_PAGE_SIZE, after=None, direction="desc", columns=None,
+               since=None, until=None):
+    """Returns (rows as dicts, token for the next page or None) for one page of a table."""
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise RuntimeError(f"Page size must be between 1 and {MAX_PAGE_SIZE}.")
+    columns = select_columns(cursor, table, columns)
+    position = decode_token(after) if after else None
+    rows = []
+    # One row more than the page, to know whether another page follows.
+    for segment in segments(direction, position, since, until):
+        query, params = segment_query(table, columns, segment, direction, position, since, until,
+                                      limit=limit + 1 - len(rows))
+        cursor.execute(query, params)
+        rows.extend(cursor.fetchall())
+        if len(rows) > limit:
+            break
+    page = rows[:limit]
+    next_token = encode_token(*page[-1][:2]) if len(rows) > limit else None
+    return [dict(zip(columns, row[2:])) for row in page], next_token
+
+def iter_rows(conn, table, columns, direction="asc", itersize=DEFAULT_ITERSIZE, since=None, until=None):
+    """Yields every row of a table as a tuple of columns, through named server-side cursors."""
+    for segment in segments(direction, None, since, until):
+        query, params = segment_query(table, columns, segment, direction, since=since, until=until)
+        cursor = conn.cursor(name=f"listing_{table}_{segment}_{uuid.uuid4().hex[:8]}")
+        cursor.itersize = itersize
+        try:
+            cursor.execute(query, params)
+            for row in cursor:
+                yield row[2:]
+        finally:
+            cursor.close()
+
+def export_table(table, path, fmt=None, columns=None, direction="asc", itersize=DEFAULT_ITERSIZE,
+                 since=None, until=None):
+    """Streams a table to CSV or NDJSON in constant memory; returns the number of rows written."""
+    fmt = fmt or ("ndjson" if re.search(r"\.(nd)?jsonl?(\.gz)?$", path) else "csv")
+    conn = connect()
+    conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    cursor = conn.cursor()
+    started = time.monotonic()
+    count = 0
+    try:
+        columns = select_columns(cursor, table, columns)
+        with open_text(path, "w") as f:
+            writer = csv.writer(f) if fmt == "csv" else None
+            if writer:
+                writer.writerow(columns)
+            for row in iter_rows(conn, table, columns, direction, itersize, since, until):
+                if writer:
+                    writer.writerow(row)
+                else:
+                    f.write(json.dumps(dict(zip(columns, row)), default=str) + "\n")
+                count += 1
+                if count % PROGRESS_EVERY == 0:
+                    print(f"  {count} rows...", file=sys.stderr)
+        conn.rollback()
+        print(f"Exported {count} {table} rows as {fmt} in {time.monotonic() - started:.1f}s", file=sys.stderr)
+        return count
+    finally:
+        cursor.close()
+        conn.close()
+
+def show_tables():
+    """Prints each listable table with its row estimate and keyset index."""
+    tables = listable_tables()
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SQL_ROW_ESTIMATES, (tables,))
+        estimates = dict(cursor.fetchall())
+        cursor.execute(SQL_KEYSET_INDEXES, (tables,))
+        indexes = {}
+        for table, index in cursor.fetchall():
+            indexes.setdefault(table, []).append(index)
+    finally:
+        cursor.close()
+        conn.close()
+    print(f"{'table':<28} {'rows (est.)':>12}  keyset index")
+    for table in tables:
+        if table not in estimates:
+            continue
+        index = ", ".join(sorted(indexes.get(table, []))) or "none (pages sort the table)"
+        print(f"{table:<28} {max(estimates[table], 0):>12}  {index}")
+
+def ensure_indexes(workers=2):
+    """Builds the keyset indexes concurrently, then drops the indexes they supersede."""
+    wanted = set(KEYSET_INDEXES)
+    statements = [sql for kind, name, sql in declared_objects() if kind == 'index' and name in wanted]
+    build_indexes(workers=workers, progress_interval=0, statements=statements)
+    conn = connect()
+    conn.autocommit = True
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SQL_VALID_INDEXES, (["idx_orders_created_id"],))
+        if not cursor.fetchall():
+            return
+        for name in SUPERSEDED_INDEXES:
+            cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+            print(f"Dropped {name} (if present)")
+    finally:
+        cursor.close()
+        conn.close()
+
+def column_list(value):
+    return [name.strip() for name in value.split(",") if name.strip()]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Keyset-paginated reads and streaming exports of declared tables.")
+    actions = parser.add_subparsers(dest="action", required=True)
+
+    actions.add_parser("tables", help="list the tables that can be paged, with their keyset indexes")
+
+    def add_filters(action_parser, default_direction):
+        action_parser.add_argument("table")
+        action_parser.add_argument("--columns", type=column_list, help="comma-separated columns (default all)")
+        order = action_parser.add_mutually_exclusive_group()
+        order.add_argument("--asc", dest="direction", action="store_const", const="asc", help="oldest first")
+        order.add_argument("--desc", dest="direction", action="store_const", const="desc", help="newest first")
+        action_parser.set_defaults(direction=default_direction)
+        action_parser.add_argument("--since", help="only rows created at or after this timestamp")
+        action_parser.add_argument("--until", help="only rows created before this timestamp")
+
+    page_parser = actions.add_parser("page", help="print one page of a table as NDJSON")
+    add_filters(page_parser, "desc")
+    page_parser.add_argument("--limit", type=int, default=DEFAULT_PAGE_SIZE, help="rows per page")
+    page_parser.add_argument("--after", help="cursor token printed with the previous page")
+
+    export_parser = actions.add_parser("export", help="stream a table to CSV or NDJSON")
+    add_filters(export_parser, "asc")
+    export_parser.add_argument("file", help="output file, .gz allowed, '-' for stdout")
+    export_parser.add_argument("--format", choices=FORMATS, help="default: ndjson for .ndjson/.jsonl files, else csv")
+    export_parser.add_argument("--itersize", type=int, default=DEFAULT_ITERSIZE,
+                               help="rows fetched from the server-side cursor per round trip")
+
+    indexes_parser = actions.add_parser("indexes", help="build the keyset indexes and drop superseded ones")
+    indexes_parser.add_argument("--workers", type=int, default=2, help="maximum number of parallel builds")
+
+    args = parser.parse_args(argv)
+    if args.action == "tables":
+        show_tables()
+    elif args.action == "page":
+        conn = connect()
+        cursor = conn.cursor()
+        try:
+            rows, next_token = fetch_page(cursor, args.table, limit=args.limit, after=args.after,
+                                          direction=args.direction, columns=args.columns,
+                                          since=args.since, until=args.until)
+            conn.rollback()
+        finally:
+            cursor.close()
+            conn.close()
+        for row in rows:
+            print(json.dumps(row, default=str))
+        print(f"next: {next_token}" if next_token else "next: (last page)", file=sys.stderr)
+    elif args.action == "export":
+        export_table(args.table, args.file, fmt=args.format, columns=args.columns, direction=args.direction,
+                     itersize=args.itersize, since=args.since, until=args.until)
+    else:
+        ensure_indexes(workers=args.workers)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,641 @@
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import sys
+import time
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+import psycopg2
+import psycopg2.extensions
+
+from create_db_updated import DB_CONFIG, schema_fingerprint
+from db_benchmark import percentile, setup_database
+
+# Concurrent checkout load generator.
+#
+# The query benchmark (db_benchmark.py) measures reads one statement at a
+# time, so it does not show what happens when many shoppers check out at
+# once. This module simulates them. Each shopper is an asyncio task that
+# loops through the storefront's checkout path until the run ends:
+#
+#   session   INSERT INTO sessions, as at login
+#   cart      the cart upsert and one cart_items upsert per line, as in
+#             server/storage.ts
+#   address   pick the shopper's default address, creating one if needed
+#   checkout  one transaction that inserts the order and its items,
+#             decrements each product's stock and clears the cart
+#
+# createOrder in server/storage.ts does not touch products.stock; the stock
+# decrement is added here to stand in for the row locks that stock
+# allocation (db_orders.py, db_stock.py) takes on hot products.
+#
+# Shoppers share a fixed pool of connections, as the application's requests
+# do, so thousands of them can run against an ordinary max_connections.
+# Each step takes a connection from the pool and returns it afterwards. By
+# default the simulated decrement locks products in cart line order, so two
+# checkouts can deadlock; --lock-order product locks them in id order
+# instead, which rules that out. --hot-share sends that share of cart lines
+# to a few hot products, which is where the contention comes from.
+#
+# Checkouts that fail with a deadlock (40P01) or serialization failure
+# (40001) are retried up to --retries times. While the load runs, a sampler
+# on its own connection polls pg_stat_activity and pg_locks for the load's
+# sessions. It counts wait events, and for sessions waiting on a lock it
+# counts the table and, when the statement names one, the row. The report
+# gives throughput, step latencies, errors by kind, the server's deadlock
+# count from pg_stat_database, the wait events, and the most contended
+# tables and rows. Step latencies include the wait for a pooled connection,
+# which is also reported on its own as "pool wait".
+#
+# The connections use psycopg2's asynchronous mode driven by the asyncio
+# event loop, so no other driver is needed. Asynchronous connections are
+# always in autocommit mode; the checkout opens its transaction explicitly.
+#
+# The run writes to the database: orders are numbered LOAD-<run>-<n>, and
+# 'load cleanup' deletes them. Run it against a scratch or test database
+# (see 'testdb acquire'), not production.
+
+APPLICATION_NAME = "plenaire-load"
+ORDER_PREFIX = "LOAD-"
+
+DEFAULT_SHOPPERS = 1000
+DEFAULT_CONNECTIONS = 50
+DEFAULT_DURATION = 30.0
+DEFAULT_MAX_ITEMS = 3
+DEFAULT_HOT_PRODUCTS = 5
+DEFAULT_HOT_SHARE = 0.3
+DEFAULT_RETRIES = 2
+DEFAULT_SAMPLE_INTERVAL = 0.1
+DEFAULT_STATEMENT_TIMEOUT_MS = 30000
+
+ISOLATION_LEVELS = {
+    "read-committed": "READ COMMITTED",
+    "repeatable-read": "REPEATABLE READ",
+    "serializable": "SERIALIZABLE",
+}
+
+STEPS = ("session", "cart", "address", "checkout")
+
+# SQLSTATEs counted by name; anything else is reported by its code.
+ERROR_NAMES = {
+    "40P01": "deadlock",
+    "40001": "serialization_failure",
+    "55P03": "lock_timeout",
+    "57014": "statement_timeout",
+}
+RETRYABLE = ("40P01", "40001")
+
+SQL_SHOPPERS = "SELECT id FROM users ORDER BY random() LIMIT %s;"
+
+SQL_PRODUCTS = "SELECT id FROM products WHERE stock > 0 ORDER BY id;"
+
+# The hot products: featured ones first, as the home page lists them.
+SQL_HOT_PRODUCTS = """
+    SELECT id FROM products WHERE stock > 0
+    ORDER BY featured DESC NULLS LAST, review_count DESC NULLS LAST, id
+    LIMIT %s;
+"""
+
+SQL_RESTOCK = "UPDATE products SET stock = %s, updated_at = now();"
+
+SQL_CREATE_SESSION = """
+    INSERT INTO sessions (user_id, expires_at) VALUES (%s, now() + interval '1 hour') RETURNING id;
+"""
+
+SQL_CREATE_CART = "INSERT INTO carts (user_id) VALUES (%s) ON CONFLICT (user_id) DO NOTHING RETURNING id;"
+
+SQL_GET_CART = "SELECT id FROM carts WHERE user_id = %s;"
+
+SQL_ADD_TO_CART = """
+    INSERT INTO cart_items (cart_id, product_id, quantity) VALUES (%s, %s, %s)
+    ON CONFLICT (cart_id, product_id)
+    DO UPDATE SET quantity = cart_items.quantity + excluded.quantity, updated_at = now();
+"""
+
+SQL_GET_ADDRESS = """
+    SELECT id FROM addresses WHERE user_id = %s ORDER BY is_default DESC NULLS LAST, id LIMIT 1;
+"""
+
+SQL_CREATE_ADDRESS = """
+    INSERT INTO addresses (user_id, address_line1, city, state, postal_code, country, is_default)
+    VALUES (%s, 'Load test', 'Paris', 'IDF', '75001', 'FR', true)
+    RETURNING id;
+"""
+
+SQL_CART_LINES = """
+    SELECT i.product_id, i.quantity, p.price
+    FROM cart_items i JOIN products p ON p.id = i.product_id
+    WHERE i.cart_id = %s
+    ORDER BY {order};
+"""
+
+SQL_CREATE_ORDER = """
+    INSERT INTO orders (user_id, order_number, total, shipping_address_id, billing_address_id)
+    VALUES (%s, %s, %s, %s, %s)
+    RETURNING id;
+"""
+
+SQL_ADD_ORDER_ITEM = "INSERT INTO order_items (order_id, product_id, quantity, price) VALUES (%s, %s, %s, %s);"
+
+SQL_DECREMENT_STOCK = """
+    UPDATE products SET stock = stock - %s, updated_at = now() WHERE id = %s AND stock >= %s;
+"""
+
+SQL_CLEAR_CART = "DELETE FROM cart_items WHERE cart_id = %s;"
+
+# Every load session but the sampler's own, with the lock it waits for.
+SQL_SAMPLE = """
+    SELECT a.wait_event_type, a.wait_event, a.query,
+           (SELECT l.relation::regclass::text FROM pg_locks l
+            WHERE l.pid = a.pid AND NOT l.granted AND l.relation IS NOT NULL LIMIT 1)
+    FROM pg_stat_activity a
+    WHERE a.application_name = %s AND a.state = 'active' AND a.pid <> pg_backend_pid();
+"""
+
+SQL_DATABASE_STATS = """
+    SELECT deadlocks, xact_commit, xact_rollback, conflicts
+    FROM pg_stat_database WHERE datname = current_database();
+"""
+
+SQL_CLEANUP = "DELETE FROM orders WHERE order_number LIKE %s;"
+
+# The table a statement writes to, and the row when it names one by id.
+TARGET_RE = re.compile(r"^\s*(?:UPDATE|INSERT\s+INTO|DELETE\s+FROM)\s+([\w.]+)", re.IGNORECASE)
+ROW_RE = re.compile(r"\bWHERE\s+id\s*=\s*(\d+)", re.IGNORECASE)
+
+class CheckoutFailed(Exception):
+    """A checkout that could not complete, with the reason counted in the report."""
+
+class RunOver(Exception):
+    """Raised to a shopper asking for a connection after the run's deadline."""
+
+async def wait_ready(conn):
+    """Polls an asynchronous connection until its pending operation completes."""
+    loop = asyncio.get_running_loop()
+    fd = conn.fileno()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        ready = loop.create_future()
+
+        def wake():
+            if not ready.done():
+                ready.set_result(None)
+
+        if state == psycopg2.extensions.POLL_READ:
+            loop.add_reader(fd, wake)
+            remove = loop.remove_reader
+        elif state == psycopg2.extensions.POLL_WRITE:
+            loop.add_writer(fd, wake)
+            remove = loop.remove_writer
+        else:
+            raise psycopg2.OperationalError(f"unexpected poll state {state}")
+        try:
+            await ready
+        finally:
+            remove(fd)
+
+class AsyncConnection:
+    """An asynchronous psycopg2 connection driven by the asyncio event loop."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = None
+
+    @classmethod
+    async def open(cls, config, statement_timeout_ms=None):
+        options = f"-c statement_timeout={int(statement_timeout_ms)}" if statement_timeout_ms else None
+        conn = psycopg2.connect(async_=1, application_name=APPLICATION_NAME, options=options, **config)
+        await wait_ready(conn)
+        self = cls(conn)
+        self.cursor = conn.cursor()
+        return self
+
+    async def execute(self, sql, params=None):
+        """Runs one statement and returns the cursor holding its result."""
+        self.cursor.execute(sql, params)
+        await wait_ready(self.conn)
+        return self.cursor
+
+    async def fetchone(self, sql, params=None):
+        return (await self.execute(sql, params)).fetchone()
+
+    async def fetchall(self, sql, params=None):
+        return (await self.execute(sql, params)).fetchall()
+
+    def close(self):
+        self.conn.close()
+
+class ConnectionPool:
+    """A fixed set of connections handed out to shoppers one step at a time.
+
+    Connections go to waiting shoppers in arrival order. (An asyncio.Queue
+    would let a shopper that just released a connection take it straight
+    back for its next step, starving the others.)
+    """
+
+    def __init__(self, config, size, statement_timeout_ms=None):
+        self.config = config
+        self.size = size
+        self.statement_timeout_ms = statement_timeout_ms
+        self.idle = deque()
+        self.waiters = deque()
+        self.wait_ms = []
+        self.deadline = None
+
+    async def open(self):
+        for _ in range(self.size):
+            self.idle.append(await AsyncConnection.open(self.config, self.statement_timeout_ms))
+
+    async def acquire(self):
+        if self.idle and not self.waiters:
+            return self.idle.popleft()
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        return await waiter
+
+    def release(self, conn):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(conn)
+                return
+        self.idle.append(conn)
+
+    @asynccontextmanager
+    async def connection(self):
+        started = time.perf_counter()
+        conn = await self.acquire()
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            # Shoppers still queued when the run ends are dropped rather than
+            # served, so the run stops on time however far behind it fell.
+            self.release(conn)
+            raise RunOver()
+        self.wait_ms.append((time.perf_counter() - started) * 1000.0)
+        try:
+            yield conn
+        finally:
+            if conn.conn.closed:
+                # Lost to a server or network error; replace it.
+                conn = await AsyncConnection.open(self.config, self.statement_timeout_ms)
+            self.release(conn)
+
+    def close(self):
+        while self.idle:
+            self.idle.popleft().close()
+
+class LoadRun:
+    """Settings, shared state and counters of one load run."""
+
+    def __init__(self, run_id, users, products, hot_products, max_items=DEFAULT_MAX_ITEMS, hot_share=DEFAULT_HOT_SHARE,
+                 isolation="read-committed", lock_order="cart", retries=DEFAULT_RETRIES, think_ms=0, seed_value=1):
+        self.run_id = run_id
+        self.users = users
+        self.products = products
+        self.hot_products = hot_products
+        self.max_items = max_items
+        self.hot_share = hot_share
+        self.isolation = ISOLATION_LEVELS[isolation]
+        self.lines_sql = SQL_CART_LINES.format(order="i.product_id" if lock_order == "product" else "i.id")
+        self.retries = retries
+        self.think_ms = think_ms
+        self.rng = random.Random(seed_value)
+        self.orders = 0
+        self.latencies = {step: [] for step in STEPS}
+        self.outcomes = Counter()
+        self.errors = Counter()
+        self.retried = 0
+        self.pool_wait_ms = []
+
+    def next_order_number(self):
+        self.orders += 1
+        return f"{ORDER_PREFIX}{self.run_id}-{self.orders}"
+
+    def pick_product(self):
+        if self.hot_products and self.rng.random() < self.hot_share:
+            return self.rng.choice(self.hot_products)
+        return self.rng.choice(self.products)
+
+    def count_error(self, error):
+        self.errors[ERROR_NAMES.get(error.pgcode, error.pgcode or type(error).__name__)] += 1
+
+async def timed(run, step, operation):
+    started = time.perf_counter()
+    result = await operation
+    run.latencies[step].append((time.perf_counter() - started) * 1000.0)
+    return result
+
+async def think(run):
+    if run.think_ms:
+        await asyncio.sleep(run.rng.expovariate(1000.0 / run.think_ms))
+
+async def create_session(pool, user_id):
+    async with pool.connection() as conn:
+        return (await conn.fetchone(SQL_CREATE_SESSION, (user_id,)))[0]
+
+async def fill_cart(run, pool, user_id):
+    """Upserts the user's cart and adds one to max_items lines; returns the cart id."""
+    async with pool.connection() as conn:
+        row = await conn.fetchone(SQL_CREATE_CART, (user_id,))
+        cart_id = row[0] if row else (await conn.fetchone(SQL_GET_CART, (user_id,)))[0]
+        for _ in range(run.rng.randint(1, run.max_items)):
+            await conn.execute(SQL_ADD_TO_CART, (cart_id, run.pick_product(), run.rng.randint(1, 2)))
+    return cart_id
+
+async def select_address(pool, user_id):
+    async with pool.connection() as conn:
+        row = await conn.fetchone(SQL_GET_ADDRESS, (user_id,))
+        return row[0] if row else (await conn.fetchone(SQL_CREATE_ADDRESS, (user_id,)))[0]
+
+async def checkout(run, pool, user_id, cart_id, address_id):
+    """Places the order in one transaction, retrying deadlocks and serialization failures."""
+    for attempt in range(run.retries + 1):
+        async with pool.connection() as conn:
+            try:
+                await conn.execute(f"BEGIN ISOLATION LEVEL {run.isolation};")
+                lines = await conn.fetchall(run.lines_sql, (cart_id,))
+                if not lines:
+                    raise CheckoutFailed("empty_cart")
+                total = sum(quantity * price for _, quantity, price in lines)
+                order_id = (await conn.fetchone(SQL_CREATE_ORDER, (user_id, run.next_order_number(), total,
+                                                                   address_id, address_id)))[0]
+                for product_id, quantity, price in lines:
+                    await conn.execute(SQL_ADD_ORDER_ITEM, (order_id, product_id, quantity, price))
+                    if (await conn.execute(SQL_DECREMENT_STOCK, (quantity, product_id, quantity))).rowcount == 0:
+                        raise CheckoutFailed("out_of_stock")
+                await conn.execute(SQL_CLEAR_CART, (cart_id,))
+                await conn.execute("COMMIT;")
+                return "ok"
+            except CheckoutFailed as e:
+                await conn.execute("ROLLBACK;")
+                if str(e) == "out_of_stock":
+                    # The shopper gives up on the cart, as they would on the site.
+                    await conn.execute(SQL_CLEAR_CART, (cart_id,))
+                return str(e)
+            except psycopg2.Error as e:
+                run.count_error(e)
+                if not conn.conn.closed:
+                    await conn.execute("ROLLBACK;")
+                if e.pgcode not in RETRYABLE or attempt == run.retries:
+                    return "failed"
+        run.retried += 1
+        await asyncio.sleep(run.rng.uniform(0, 0.01 * (attempt + 1)))
+    return "failed"
+
+async def shopper(run, pool, user_id, deadline):
+    """Checks out again and again until deadline."""
+    await asyncio.sleep(run.rng.uniform(0, 0.5))
+    while time.monotonic() < deadline:
+        try:
+            await timed(run, "session", create_session(pool, user_id))
+            await think(run)
+            cart_id = await timed(run, "cart", fill_cart(run, pool, user_id))
+            await think(run)
+            address_id = await timed(run, "address", select_address(pool, user_id))
+            await think(run)
+            run.outcomes[await timed(run, "checkout", checkout(run, pool, user_id, cart_id, address_id))] += 1
+        except RunOver:
+            return
+        except psycopg2.Error as e:
+            # A failure outside checkout, e.g. a statement timeout in the cart upsert.
+            run.count_error(e)
+            run.outcomes["failed"] += 1
+
+class ContentionSampler:
+    """Samples the wait events and lock waits of the load's sessions."""
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.active = 0
+        self.peak_waiting = 0
+        self.wait_events = Counter()
+        self.tables = Counter()
+        self.rows = Counter()
+
+    async def run(self, conn, stop):
+        while not stop.is_set():
+            rows = await conn.fetchall(SQL_SAMPLE, (APPLICATION_NAME,))
+            self.record(rows)
+            try:
+                await asyncio.wait_for(stop.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def record(self, rows):
+        self.samples += 1
+        self.active += len(rows)
+        waiting = 0
+        for wait_type, event, query, relation in rows:
+            self.wait_events[f"{wait_type}:{event}" if wait_type else "CPU"] += 1
+            if wait_type != "Lock":
+                continue
+            waiting += 1
+            target = TARGET_RE.match(query or "")
+            table = relation or (target.group(1) if target else f"<{event} lock>")
+            self.tables[table] += 1
+            row = ROW_RE.search(query or "")
+            if row:
+                self.rows[f"{table} id={row.group(1)}"] += 1
+        self.peak_waiting = max(self.peak_waiting, waiting)
+
+    def report(self, top=10):
+        def shares(counter):
+            return [(name, count, count / self.active * 100.0 if self.active else 0.0)
+                    for name, count in counter.most_common(top)]
+        return {
+            "samples": self.samples,
+            "mean_active_sessions": self.active / self.samples if self.samples else 0.0,
+            "peak_lock_waiting_sessions": self.peak_waiting,
+            "wait_events": shares(self.wait_events),
+            "contended_tables": shares(self.tables),
+            "contended_rows": shares(self.rows),
+        }
+
+def latency_summary(values):
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 50),
+        "p95_ms": percentile(values, 95),
+        "p99_ms": percentile(values, 99),
+        "max_ms": values[-1] if values else None,
+    }
+
+async def load_products(conn, hot_products):
+    products = [row[0] for row in await conn.fetchall(SQL_PRODUCTS)]
+    hot = [row[0] for row in await conn.fetchall(SQL_HOT_PRODUCTS, (hot_products,))] if hot_products else []
+    if not products:
+        raise RuntimeError("No products in stock; seed the database or pass --restock.")
+    return products, hot
+
+async def run_load_async(shoppers, connections, duration, config, restock, hot_products, sample_interval,
+                         statement_timeout_ms, **settings):
+    control = await AsyncConnection.open(config)
+    pool = ConnectionPool(config, connections, statement_timeout_ms)
+    try:
+        if restock is not None:
+            await control.execute(SQL_RESTOCK, (restock,))
+        products, hot = await load_products(control, hot_products)
+        users = [row[0] for row in await control.fetchall(SQL_SHOPPERS, (shoppers,))]
+        if not users:
+            raise RuntimeError("No users to shop as; seed the database first.")
+        run = LoadRun(datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S"), users, products, hot, **settings)
+        await pool.open()
+        before = await control.fetchone(SQL_DATABASE_STATS)
+
+        sampler = ContentionSampler(sample_interval)
+        stop = asyncio.Event()
+        sampling = asyncio.ensure_future(sampler.run(control, stop))
+        started = time.monotonic()
+        pool.deadline = started + duration
+        # More shoppers than users share accounts, and so carts.
+        await asyncio.gather(*(shopper(run, pool, users[n % len(users)], pool.deadline) for n in range(shoppers)))
+        elapsed = time.monotonic() - started
+        run.pool_wait_ms = pool.wait_ms
+        stop.set()
+        await sampling
+
+        after = await control.fetchone(SQL_DATABASE_STATS)
+    finally:
+        pool.close()
+        control.close()
+    return run, sampler, elapsed, dict(zip(("deadlocks", "commits", "rollbacks", "conflicts"),
+                                           (b - a for a, b in zip(before, after))))
+
+def run_load(shoppers=DEFAULT_SHOPPERS, connections=DEFAULT_CONNECTIONS, duration=DEFAULT_DURATION,
+             max_items=DEFAULT_MAX_ITEMS, hot_products=DEFAULT_HOT_PRODUCTS, hot_share=DEFAULT_HOT_SHARE,
+             isolation="read-committed", lock_order="cart", retries=DEFAULT_RETRIES, think_ms=0,
+             restock=None, sample_interval=DEFAULT_SAMPLE_INTERVAL, statement_timeout_ms=DEFAULT_STATEMENT_TIMEOUT_MS,
+             seed_value=1, label=None, output=None, setup=False, scale=1.0, yes_truncate=False, config=None):
+    """Runs the checkout load, prints its report and returns (and optionally writes) the result document."""
+    config = config or DB_CONFIG
+    if setup:
+        setup_database(scale, seed_value, yes_truncate=yes_truncate, config=config)
+    print(f"Running {shoppers} shoppers over {connections} connections for {duration:.0f}s "
+          f"({isolation}, {lock_order} lock order, {hot_share:.0%} of lines on {hot_products} hot products)...")
+    run, sampler, elapsed, server = asyncio.run(run_load_async(
+        shoppers, connections, duration, config, restock, hot_products, sample_interval, statement_timeout_ms,
+        max_items=max_items, hot_share=hot_share, isolation=isolation, lock_order=lock_order, retries=retries,
+        think_ms=think_ms, seed_value=seed_value))
+
+    document = {
+        "label": label,
+        "recorded_at": datetime.now(timezone.utc).isoformat(),
+        "run_id": run.run_id,
+        "declared_fingerprint": schema_fingerprint(),
+        "settings": {
+            "shoppers": shoppers, "connections": connections, "duration": duration, "max_items": max_items,
+            "hot_products": hot_products, "hot_share": hot_share, "isolation": isolation, "lock_order": lock_order,
+            "retries": retries, "think_ms": think_ms, "seed": seed_value,
+        },
+        "elapsed_s": elapsed,
+        "checkouts_per_s": run.outcomes["ok"] / elapsed if elapsed else 0.0,
+        "outcomes": dict(run.outcomes),
+        "errors": dict(run.errors),
+        "retries": run.retried,
+        "server": server,
+        "latency": {step: latency_summary(run.latencies[step]) for step in STEPS},
+        "pool_wait": latency_summary(run.pool_wait_ms),
+        "contention": sampler.report(),
+    }
+    print_report(document)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(document, f, indent=2, default=str)
+        print(f"Results written to {output}")
+    return document
+
+def print_report(document):
+    outcomes, errors = document["outcomes"], document["errors"]
+    print(f"\nCheckouts: {outcomes.get('ok', 0)} in {document['elapsed_s']:.1f}s "
+          f"({document['checkouts_per_s']:.1f}/s); " +
+          ", ".join(f"{count} {name.replace('_', ' ')}" for name, count in sorted(outcomes.items()) if name != "ok"))
+    print(f"Deadlocks: {errors.get('deadlock', 0)} (server counted {document['server']['deadlocks']}), "
+          f"serialization failures: {errors.get('serialization_failure', 0)}, retries: {document['retries']}")
+    other = {name: count for name, count in errors.items() if name not in ("deadlock", "serialization_failure")}
+    if other:
+        print("Other errors: " + ", ".join(f"{name} {count}" for name, count in sorted(other.items())))
+
+    print(f"\n{'step':<10} {'count':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for step, summary in list(document["latency"].items()) + [("pool wait", document["pool_wait"])]:
+        if not summary["count"]:
+            continue
+        print(f"{step:<10} {summary['count']:>8} {summary['p50_ms']:>9.2f} {summary['p95_ms']:>9.2f} "
+              f"{summary['p99_ms']:>9.2f} {summary['max_ms']:>9.2f}")
+
+    contention = document["contention"]
+    print(f"\n{contention['samples']} samples, {contention['mean_active_sessions']:.1f} active sessions on average, "
+          f"at most {contention['peak_lock_waiting_sessions']} waiting on locks at once")
+    for title, key in (("Wait events", "wait_events"), ("Most contended tables", "contended_tables"),
+                       ("Most contended rows", "contended_rows")):
+        if contention[key]:
+            print(f"{title} (share of sampled active sessions):")
+            for name, count, share in contention[key]:
+                print(f"  {name:<40} {count:>7} {share:6.1f}%")
+
+def cleanup(config=None):
+    """Deletes the orders (and their items) placed by load runs; returns how many."""
+    conn = psycopg2.connect(**(config or DB_CONFIG))
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SQL_CLEANUP, (ORDER_PREFIX + "%",))
+        deleted = cursor.rowcount
+        conn.commit()
+        print(f"Deleted {deleted} load test orders.")
+        return deleted
+    finally:
+        cursor.close()
+        conn.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate concurrent checkouts and profile lock contention.")
+    actions = parser.add_subparsers(dest="action", required=True)
+
+    run_parser = actions.add_parser("run", help="run the checkout load")
+    run_parser.add_argument("--shoppers", type=int, default=DEFAULT_SHOPPERS, help="concurrent simulated shoppers")
+    run_parser.add_argument("--connections", type=int, default=DEFAULT_CONNECTIONS, help="connection pool size")
+    run_parser.add_argument("--duration", type=float, default=DEFAULT_DURATION, help="seconds to run")
+    run_parser.add_argument("--max-items", type=int, default=DEFAULT_MAX_ITEMS, help="most lines added per cart")
+    run_parser.add_argument("--hot-products", type=int, default=DEFAULT_HOT_PRODUCTS,
+                            help="number of hot (featured) products")
+    run_parser.add_argument("--hot-share", type=float, default=DEFAULT_HOT_SHARE,
+                            help="share of cart lines that go to a hot product")
+    run_parser.add_argument("--isolation", choices=sorted(ISOLATION_LEVELS), default="read-committed")
+    run_parser.add_argument("--lock-order", choices=("cart", "product"), default="cart",
+                            help="decrement stock in cart line order or product id order")
+    run_parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES,
+                            help="retries of a checkout after a deadlock or serialization failure")
+    run_parser.add_argument("--think-ms", type=float, default=0, help="mean pause between a shopper's steps")
+    run_parser.add_argument("--restock", type=int, help="set every product's stock to this before running")
+    run_parser.add_argument("--sample-interval", type=float, default=DEFAULT_SAMPLE_INTERVAL,
+                            help="seconds between contention samples")
+    run_parser.add_argument("--statement-timeout", type=int, default=DEFAULT_STATEMENT_TIMEOUT_MS,
+                            help="statement_timeout of the load's connections in ms (0 for none)")
+    run_parser.add_argument("--seed", type=int, default=1)
+    run_parser.add_argument("--label", help="name for this run")
+    run_parser.add_argument("--output", help="write the results as JSON to this file")
+    run_parser.add_argument("--setup", action="store_true", help="create the schema and reseed before running")
+    run_parser.add_argument("--scale", type=float, default=1.0, help="scale factor for --setup")
+    run_parser.add_argument("--yes-truncate", action="store_true", help="confirm that --setup may empty the seeded tables")
+
+    actions.add_parser("cleanup", help="delete the orders placed by load runs")
+
+    args = parser.parse_args(argv)
+    if args.action == "run":
+        run_load(shoppers=args.shoppers, connections=args.connections, duration=args.duration,
+                 max_items=args.max_items, hot_products=args.hot_products, hot_share=args.hot_share,
+                 isolation=args.isolation, lock_order=args.lock_order, retries=args.retries, think_ms=args.think_ms,
+                 restock=args.restock, sample_interval=args.sample_interval,
+                 statement_timeout_ms=args.statement_timeout, seed_value=args.seed, label=args.label,
+                 output=args.output, setup=args.setup, scale=args.scale, yes_truncate=args.yes_truncate)
+    else:
+        cleanup()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
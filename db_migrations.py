@@ -0,0 +1,339 @@
+
+import argparse
+import hashlib
+import re
+import sys
+import time
+import psycopg2
+
+from create_db_updated import DB_CONFIG, apply_catalog_diff, missing_objects
+from db_indexes import build_indexes
+
+# Ordered schema migrations.
+#
+# SQL_CREATE_TABLES describes the target schema for a fresh database, but
+# CREATE TABLE IF NOT EXISTS never alters a table that already exists. Any
+# change to an existing table is therefore made twice: once in the declared
+# lists in create_db_updated.py, and once here as an idempotent migration, so
+# that databases built from an older revision catch up.
+#
+# migrate() runs in phases so that declared objects can depend on columns a
+# migration adds: missing enums and tables are created first, then pending
+# migrations run, then missing foreign keys and triggers are added, and
+# finally missing indexes are built concurrently.
+#
+# Steps run in order. A migration whose steps are all transactional is applied
+# in one transaction together with its history row; steps that cannot run in
+# a transaction (CREATE INDEX CONCURRENTLY, VALIDATE on huge tables split into
+# their own step) run in autocommit and must be safe to repeat.
+MIGRATIONS = [
+    {
+        "version": 1,
+        "name": "account lockout and captcha columns",
+        "steps": [
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS login_attempts INTEGER NULL DEFAULT 0;",
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS lock_until TIMESTAMP WITH TIME ZONE NULL;",
+            "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS captcha_text TEXT NULL;",
+        ],
+    },
+    {
+        "version": 2,
+        "name": "weighted product search vector",
+        "steps": [
+            "ALTER TABLE products ADD COLUMN IF NOT EXISTS search_vector TSVECTOR NULL;",
+            # Replaced by idx_products_search_vector; searchProducts never matched it.
+            "DROP INDEX CONCURRENTLY IF EXISTS idx_products_name_search;",
+        ],
+    },
+    {
+        "version": 3,
+        "name": "review aggregate columns",
+        "steps": [
+            "ALTER TABLE products ADD COLUMN IF NOT EXISTS rating_sum INTEGER NULL DEFAULT 0;",
+            "ALTER TABLE products ADD COLUMN IF NOT EXISTS rating_avg DOUBLE PRECISION NULL;",
+        ],
+    },
+    {
+        "version": 4,
+        "name": "order review hold columns",
+        "steps": [
+            # Set by the order workers (db_orders.py) for orders short of stock.
+            "ALTER TABLE orders ADD COLUMN IF NOT EXISTS held_at TIMESTAMP WITH TIME ZONE NULL;",
+            "ALTER TABLE orders ADD COLUMN IF NOT EXISTS hold_reason TEXT NULL;",
+        ],
+    },
+]
+
+# Tables large enough that a step holding a write-blocking lock for the length
+# of a scan or rewrite would stall checkout.
+LARGE_TABLES = ("orders", "order_items")
+
+SQL_CREATE_HISTORY_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        checksum TEXT NOT NULL,
+        duration_ms INTEGER NOT NULL,
+        applied_at TIMESTAMP WITH TIME ZONE NULL DEFAULT now()
+    );
+"""
+
+SQL_RECORD_MIGRATION = """
+    INSERT INTO schema_migrations (version, name, checksum, duration_ms)
+    VALUES (%s, %s, %s, %s);
+"""
+
+# Used by create_schema() for migrations a fresh database did not need; two
+# processes creating the same fresh database may both record them.
+SQL_RECORD_SKIPPED_MIGRATION = """
+    INSERT INTO schema_migrations (version, name, checksum, duration_ms)
+    VALUES (%s, %s, %s, 0)
+    ON CONFLICT (version) DO NOTHING;
+"""
+
+# Lock modes that conflict with the ROW EXCLUSIVE lock taken by INSERT,
+# UPDATE and DELETE, i.e. the ones that block writers while held.
+WRITE_BLOCKING_LOCKS = ("SHARE", "SHARE ROW EXCLUSIVE", "EXCLUSIVE", "ACCESS EXCLUSIVE")
+
+# Defaults whose value must be computed per row, forcing a table rewrite
+# when used in ADD COLUMN.
+VOLATILE_DEFAULTS = ("gen_random_uuid(", "random(", "clock_timestamp(", "nextval(")
+
+# lock_timeout for each step, and how often a step that times out waiting
+# for its lock is retried before the migration gives up.
+LOCK_TIMEOUT = "2s"
+LOCK_RETRIES = 5
+LOCK_BACKOFF_SECONDS = 0.5
+
+def normalize(sql):
+    """Collapses whitespace so formatting changes do not alter checksums."""
+    return " ".join(sql.split())
+
+def migration_checksum(migration):
+    """Returns a SHA-256 checksum over the normalized steps of a migration."""
+    digest = hashlib.sha256()
+    for sql in migration["steps"]:
+        digest.update(normalize(sql).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def step_table(sql):
+    """Returns the table a step operates on, or None when it cannot be told."""
+    match = re.search(
+        r"\b(?:ALTER TABLE|ON|INTO|UPDATE|DELETE FROM)\s+(?:ONLY\s+)?(?:IF EXISTS\s+)?(\w+)",
+        sql,
+        re.IGNORECASE,
+    )
+    return match.group(1) if match else None
+
+def classify_step(sql):
+    """Classifies a step by the lock it takes and how long it holds it.
+
+    Returns (lock_mode, impact, transactional) where impact is one of
+    "brief" (catalog-only change), "scan" (lock held while every row is read)
+    or "rewrite" (lock held while the table is rewritten).
+    """
+    text = normalize(sql).upper()
+    if text.startswith("CREATE INDEX CONCURRENTLY") or text.startswith("CREATE UNIQUE INDEX CONCURRENTLY"):
+        return "SHARE UPDATE EXCLUSIVE", "scan", False
+    if text.startswith("DROP INDEX CONCURRENTLY") or text.startswith("REINDEX INDEX CONCURRENTLY"):
+        return "SHARE UPDATE EXCLUSIVE", "brief", False
+    if text.startswith("CREATE INDEX") or text.startswith("CREATE UNIQUE INDEX"):
+        return "SHARE", "scan", True
+    if text.startswith("CREATE TABLE") or text.startswith("CREATE TYPE") or text.startswith("DO "):
+        return "NONE", "brief", True
+    if text.startswith("CREATE OR REPLACE FUNCTION") or text.startswith("CREATE EXTENSION"):
+        return "NONE", "brief", True
+    if text.startswith(("INSERT", "UPDATE", "DELETE")):
+        return "ROW EXCLUSIVE", "scan", True
+    if text.startswith("ALTER TABLE"):
+        if "VALIDATE CONSTRAINT" in text:
+            return "SHARE UPDATE EXCLUSIVE", "scan", True
+        if "ADD CONSTRAINT" in text and "FOREIGN KEY" in text:
+            return "SHARE ROW EXCLUSIVE", "brief" if "NOT VALID" in text else "scan", True
+        if "ADD CONSTRAINT" in text:
+            if "NOT VALID" in text or "USING INDEX" in text:
+                return "ACCESS EXCLUSIVE", "brief", True
+            return "ACCESS EXCLUSIVE", "scan", True
+        if "ADD COLUMN" in text:
+            if "GENERATED ALWAYS" in text or any(fn.upper() in text for fn in VOLATILE_DEFAULTS):
+                return "ACCESS EXCLUSIVE", "rewrite", True
+            return "ACCESS EXCLUSIVE", "brief", True
+        if " TYPE " in text:
+            return "ACCESS EXCLUSIVE", "rewrite", True
+        if "SET NOT NULL" in text:
+            return "ACCESS EXCLUSIVE", "scan", True
+        return "ACCESS EXCLUSIVE", "brief", True
+    if text.startswith("DROP"):
+        return "ACCESS EXCLUSIVE", "brief", True
+    return "ACCESS EXCLUSIVE", "unknown", True
+
+def is_online(sql):
+    """Returns True when a step does not block writers for longer than a catalog update."""
+    lock, impact, _transactional = classify_step(sql)
+    return lock not in WRITE_BLOCKING_LOCKS or impact == "brief"
+
+def fetch_history(cursor):
+    """Returns {version: (name, checksum)} for every recorded migration."""
+    cursor.execute("SELECT to_regclass('schema_migrations');")
+    if cursor.fetchone()[0] is None:
+        return {}
+    cursor.execute("SELECT version, name, checksum FROM schema_migrations ORDER BY version;")
+    return {version: (name, checksum) for version, name, checksum in cursor.fetchall()}
+
+def pending_migrations(history):
+    """Returns migrations not yet applied, after verifying applied checksums."""
+    pending = []
+    for migration in sorted(MIGRATIONS, key=lambda m: m["version"]):
+        recorded = history.get(migration["version"])
+        if recorded is None:
+            pending.append(migration)
+        elif recorded[1] != migration_checksum(migration):
+            raise RuntimeError(
+                f"Migration {migration['version']} ({migration['name']}) was changed after it was applied: "
+                f"recorded checksum {recorded[1][:12]}, declared {migration_checksum(migration)[:12]}."
+            )
+    return pending
+
+def print_plan(pending):
+    """Prints each pending step with the lock it takes."""
+    if not pending:
+        print("No pending migrations.")
+        return
+    for migration in pending:
+        print(f"\n{migration['version']:04d} {migration['name']} ({migration_checksum(migration)[:12]})")
+        for sql in migration["steps"]:
+            lock, impact, transactional = classify_step(sql)
+            table = step_table(sql) or "-"
+            flags = []
+            if not transactional:
+                flags.append("autocommit")
+            if not is_online(sql):
+                flags.append("BLOCKS WRITES on large table" if table in LARGE_TABLES else "blocks writes")
+            print(f"  [{lock} / {impact}] {table}: {normalize(sql)[:90]}")
+            if flags:
+                print(f"      {', '.join(flags)}")
+
+def blocking_steps(pending):
+    """Returns steps that would block writes on one of LARGE_TABLES for a scan or rewrite."""
+    return [
+        (migration, sql)
+        for migration in pending
+        for sql in migration["steps"]
+        if step_table(sql) in LARGE_TABLES and not is_online(sql)
+    ]
+
+def execute_with_lock_timeout(conn, cursor, sql):
+    """Runs one step under lock_timeout, retrying with backoff when the lock is not granted."""
+    for attempt in range(1, LOCK_RETRIES + 1):
+        try:
+            if conn.autocommit:
+                cursor.execute(f"SET lock_timeout = '{LOCK_TIMEOUT}';")
+            else:
+                cursor.execute("SAVEPOINT migration_step;")
+                cursor.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}';")
+            cursor.execute(sql)
+            if not conn.autocommit:
+                cursor.execute("RELEASE SAVEPOINT migration_step;")
+            return
+        except psycopg2.errors.LockNotAvailable:
+            if not conn.autocommit:
+                cursor.execute("ROLLBACK TO SAVEPOINT migration_step;")
+            if attempt == LOCK_RETRIES:
+                raise
+            delay = LOCK_BACKOFF_SECONDS * 2 ** (attempt - 1)
+            print(f"    Lock not granted within {LOCK_TIMEOUT}, retrying in {delay:.1f}s...")
+            time.sleep(delay)
+
+def apply_migration(conn, cursor, migration):
+    """Applies one migration and records it in schema_migrations."""
+    started = time.monotonic()
+    transactional = all(classify_step(sql)[2] for sql in migration["steps"])
+    conn.autocommit = not transactional
+    try:
+        for sql in migration["steps"]:
+            print(f"  {normalize(sql)[:100]}")
+            execute_with_lock_timeout(conn, cursor, sql)
+        duration_ms = int((time.monotonic() - started) * 1000)
+        cursor.execute(SQL_RECORD_MIGRATION, (
+            migration["version"], migration["name"], migration_checksum(migration), duration_ms,
+        ))
+        if transactional:
+            conn.commit()
+    finally:
+        conn.autocommit = False
+    return duration_ms
+
+def migrate(plan_only=False, allow_blocking=False):
+    """Brings the database up to the declared schema and applies pending migrations."""
+    conn = None
+    cursor = None
+    try:
+        print(f"Connecting to database '{DB_CONFIG['database']}' on {DB_CONFIG['host']}...")
+        conn = psycopg2.connect(**DB_CONFIG)
+        cursor = conn.cursor()
+
+        history = fetch_history(cursor)
+        pending = pending_migrations(history)
+        conn.commit()
+
+        if plan_only:
+            print_plan(pending)
+            return pending
+
+        blocking = blocking_steps(pending)
+        if blocking and not allow_blocking:
+            for migration, sql in blocking:
+                print(f"Blocking step in {migration['version']:04d}: {normalize(sql)[:100]}")
+            raise RuntimeError("Refusing to run write-blocking steps on large tables; pass --allow-blocking to override.")
+
+        apply_catalog_diff(conn, cursor, kinds=("enum", "table"))
+        cursor.execute(SQL_CREATE_HISTORY_TABLE)
+        conn.commit()
+
+        for migration in pending:
+            print(f"\nApplying {migration['version']:04d} {migration['name']}...")
+            duration_ms = apply_migration(conn, cursor, migration)
+            print(f"Applied {migration['version']:04d} in {duration_ms} ms.")
+        if not pending:
+            print("\nNo pending migrations.")
+
+        apply_catalog_diff(conn, cursor, kinds=("foreign_key", "trigger"))
+        conn.commit()
+
+        indexes = [sql for _kind, _name, sql in missing_objects(cursor, kinds=("index",))]
+        conn.commit()
+        if indexes:
+            build_indexes(statements=indexes, progress_interval=0)
+
+        # Everything is in place now; this records the schema fingerprint.
+        apply_catalog_diff(conn, cursor)
+        conn.commit()
+        return pending
+
+    except psycopg2.Error as e:
+        print(f"\nDatabase error: {e}")
+        if conn:
+            conn.rollback()
+        print("Migration failed. The current migration was rolled back.")
+        raise
+
+    finally:
+        if cursor:
+            cursor.close()
+        if conn:
+            conn.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply versioned schema migrations.")
+    parser.add_argument("--plan", action="store_true", help="print pending steps and their locks without applying them")
+    parser.add_argument(
+        "--allow-blocking",
+        action="store_true",
+        help=f"allow steps that block writes on {', '.join(LARGE_TABLES)} for a scan or rewrite",
+    )
+    args = parser.parse_args(argv)
+    migrate(plan_only=args.plan, allow_blocking=args.allow_blocking)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
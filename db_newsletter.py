@@ -0,0 +1,222 @@
+
+import argparse
+import csv
+import gzip
+import io
+import re
+import sys
+import time
+import psycopg2
+
+from create_db_updated import DB_CONFIG
+from db_seed import CopyStream
+
+# Bulk newsletter subscriber import and export.
+#
+# import streams a CSV (optionally gzipped) row by row. Each address is
+# trimmed, lowercased and validated, and the valid ones are sent through
+# COPY into a temporary staging table, so memory use does not depend on the
+# file's size. One INSERT ... SELECT then merges the staging table, in file
+# order, into newsletter_subscriptions. Addresses repeated in the file are
+# inserted once, and addresses already subscribed are skipped, including
+# legacy rows that differ only in case. The merge first runs as a plain
+# INSERT, which is much cheaper per row than speculative insertion. If a
+# signup for one of the addresses commits meanwhile, the merge reruns with
+# ON CONFLICT (email) DO NOTHING. The whole import is one transaction, and
+# --dry-run rolls it back after counting. Rejected rows can be written to a
+# CSV with their line number and reason.
+#
+# export streams the table out through COPY TO as CSV.
+
+EMAIL_COLUMN = "email"
+MAX_EMAIL_LENGTH = 254
+MAX_LOCAL_LENGTH = 64
+
+EMAIL_RE = re.compile(
+    r"^[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*"
+    r"@(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z][a-z0-9-]{0,61}[a-z0-9]$"
+)
+
+SQL_CREATE_STAGING = """
+    CREATE TEMPORARY TABLE newsletter_staging (
+        line BIGINT NOT NULL,
+        email TEXT NOT NULL
+    ) ON COMMIT DROP;
+"""
+
+# Each distinct address once, at the position it first appears in the file.
+SQL_MERGE = """
+    INSERT INTO newsletter_subscriptions (email)
+    SELECT s.email
+    FROM (SELECT email, min(line) AS line FROM newsletter_staging GROUP BY email) s
+    WHERE NOT EXISTS (SELECT 1 FROM newsletter_subscriptions n WHERE lower(n.email) = s.email)
+    ORDER BY s.line
+"""
+
+SQL_DISTINCT_STAGED = "SELECT count(DISTINCT email) FROM newsletter_staging;"
+
+SQL_EXPORT = """
+    SELECT email, created_at FROM newsletter_subscriptions
+    WHERE %(since)s::timestamptz IS NULL OR created_at >= %(since)s::timestamptz
+    ORDER BY id
+"""
+
+def connect():
+    """Opens a connection using DB_CONFIG."""
+    return psycopg2.connect(**DB_CONFIG)
+
+def open_text(path, mode):
+    """Opens path as text, through gzip for .gz files and stdin/stdout for '-'."""
+    if path == "-":
+        return io.TextIOWrapper((sys.stdin if "r" in mode else sys.stdout).buffer, encoding="utf-8", newline="")
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8", newline="")
+    return open(path, mode, encoding="utf-8", newline="")
+
+def normalize_email(value):
+    """Returns (normalized address, None) or (None, reason) for one raw CSV value."""
+    email = value.strip().strip("<>\"'").strip().lower()
+    if email.startswith("mailto:"):
+        email = email[len("mailto:"):]
+    if not email:
+        return None, "empty"
+    if len(email) > MAX_EMAIL_LENGTH or len(email.split("@")[0]) > MAX_LOCAL_LENGTH:
+        return None, "too long"
+    if not EMAIL_RE.match(email):
+        return None, "invalid address"
+    return email, None
+
+def read_emails(f, column=None, has_header=None):
+    """Yields (line number, raw value) for the email column of a CSV file.
+
+    The column is the one named column (default "email") when the first row
+    is a header containing it, otherwise the 0-based index column, or the
+    first column.
+    """
+    reader = csv.reader(f)
+    first = next(reader, None)
+    if first is None:
+        return
+    names = [name.strip().lower() for name in first]
+    wanted = (column or EMAIL_COLUMN).lower()
+    index = 0
+    if has_header is not False and wanted in names:
+        index = names.index(wanted)
+    elif column is not None and column.isdigit():
+        index = int(column)
+    elif column is not None:
+        raise RuntimeError(f"Column '{column}' not found in the header: {', '.join(first)}")
+    if has_header is None:
+        has_header = wanted in names
+    if not has_header:
+        yield 1, first[index] if index < len(first) else ""
+    for row in reader:
+        yield reader.line_num, row[index] if index < len(row) else ""
+
+def valid_rows(rows, counts, rejects=None):
+    """Yields (line, email) for the valid rows, counting and optionally recording the rejects."""
+    for line, value in rows:
+        counts["read"] += 1
+        email, reason = normalize_email(value)
+        if email is None:
+            counts["rejected"] += 1
+            if rejects is not None:
+                rejects.writerow([line, value, reason])
+            continue
+        yield line, email
+
+def import_subscribers(path, column=None, has_header=None, rejects_path=None, dry_run=False):
+    """Imports a CSV of addresses; returns the counts of read, rejected, staged and inserted rows."""
+    counts = {"read": 0, "rejected": 0}
+    rejects_file = open(rejects_path, "w", newline="", encoding="utf-8") if rejects_path else None
+    rejects = csv.writer(rejects_file) if rejects_file else None
+    if rejects:
+        rejects.writerow(["line", "value", "reason"])
+    conn = connect()
+    cursor = conn.cursor()
+    started = time.monotonic()
+    try:
+        with open_text(path, "r") as f:
+            cursor.execute(SQL_CREATE_STAGING)
+            stream = CopyStream(valid_rows(read_emails(f, column, has_header), counts, rejects))
+            cursor.copy_expert("COPY newsletter_staging (line, email) FROM STDIN", stream)
+        counts["staged"] = stream.count
+        staged_at = time.monotonic()
+        print(f"Staged {counts['staged']} valid addresses of {counts['read']} rows "
+              f"({counts['rejected']} rejected) in {staged_at - started:.1f}s")
+
+        cursor.execute("ANALYZE newsletter_staging;")
+        cursor.execute(SQL_DISTINCT_STAGED)
+        distinct = cursor.fetchone()[0]
+        cursor.execute("SAVEPOINT merge;")
+        try:
+            cursor.execute(SQL_MERGE)
+        except psycopg2.errors.UniqueViolation:
+            # A signup for a staged address committed after the existence check.
+            cursor.execute("ROLLBACK TO SAVEPOINT merge;")
+            cursor.execute(SQL_MERGE + " ON CONFLICT (email) DO NOTHING")
+        counts["inserted"] = cursor.rowcount
+        counts["duplicates_in_file"] = counts["staged"] - distinct
+        counts["already_subscribed"] = distinct - counts["inserted"]
+        if dry_run:
+            conn.rollback()
+        else:
+            conn.commit()
+        print(f"{'Would insert' if dry_run else 'Inserted'} {counts['inserted']} subscribers in "
+              f"{time.monotonic() - staged_at:.1f}s; {counts['already_subscribed']} already subscribed, "
+              f"{counts['duplicates_in_file']} repeated in the file.")
+        return counts
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+        if rejects_file:
+            rejects_file.close()
+            print(f"Rejected rows written to {rejects_path}")
+
+def export_subscribers(path, since=None):
+    """Streams the subscribers to a CSV file; returns the number of rows written."""
+    conn = connect()
+    cursor = conn.cursor()
+    started = time.monotonic()
+    try:
+        query = cursor.mogrify(SQL_EXPORT, {"since": since}).decode()
+        with open_text(path, "w") as f:
+            cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", f)
+        rows = cursor.rowcount
+        conn.rollback()
+        print(f"Exported {rows} subscribers in {time.monotonic() - started:.1f}s", file=sys.stderr)
+        return rows
+    finally:
+        cursor.close()
+        conn.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import and export newsletter subscribers.")
+    actions = parser.add_subparsers(dest="action", required=True)
+
+    import_parser = actions.add_parser("import", help="merge a CSV of addresses into newsletter_subscriptions")
+    import_parser.add_argument("file", help="CSV file, .gz allowed, '-' for stdin")
+    import_parser.add_argument("--column", help="name (in the header) or 0-based index of the email column")
+    header = import_parser.add_mutually_exclusive_group()
+    header.add_argument("--header", dest="has_header", action="store_true", default=None,
+                        help="the first row is a header (default: detected)")
+    header.add_argument("--no-header", dest="has_header", action="store_false")
+    import_parser.add_argument("--rejects", help="write rejected rows to this CSV")
+    import_parser.add_argument("--dry-run", action="store_true", help="count, then roll back")
+
+    export_parser = actions.add_parser("export", help="stream subscribers to CSV with COPY TO")
+    export_parser.add_argument("file", help="CSV file, .gz allowed, '-' for stdout")
+    export_parser.add_argument("--since", help="only subscribers created at or after this timestamp")
+
+    args = parser.parse_args(argv)
+    if args.action == "import":
+        import_subscribers(args.file, column=args.column, has_header=args.has_header,
+                           rejects_path=args.rejects, dry_run=args.dry_run)
+    elif args.action == "export":
+        export_subscribers(args.file, since=args.since)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
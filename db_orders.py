@@ -0,0 +1,273 @@
+
+import argparse
+import select
+import sys
+import time
+from multiprocessing import Process, Queue
+import psycopg2
+
+from create_db_updated import DB_CONFIG
+
+# Order processing workers.
+#
+# Each worker process claims a batch of pending orders with FOR UPDATE SKIP
+# LOCKED, so concurrent workers never see the same order, allocates stock
+# for each order all-or-nothing, and advances it to 'processing'. An order
+# with a short item stays pending, held for review (held_at and hold_reason
+# are set), unless --cancel-short is given; even then orders already paid
+# are only held. 'release' puts held orders back in the queue. Workers sleep on LISTEN
+# orders_pending, which trg_orders_notify_pending (create_db_updated.py)
+# signals whenever orders are inserted; the poll interval only covers missed
+# notifications.
+
+CHANNEL = "orders_pending"
+DEFAULT_WORKERS = 4
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_POLL_INTERVAL = 30.0
+
+# Orders without items yet are left pending: their items are still being
+# written by a non-transactional client. Held orders wait for 'release'.
+SQL_CLAIM_BATCH = """
+    SELECT o.id FROM orders o
+    WHERE o.status = 'pending'
+      AND EXISTS (SELECT 1 FROM order_items i WHERE i.order_id = o.id)
+      AND o.held_at IS NULL
+    ORDER BY o.created_at, o.id
+    LIMIT %s
+    FOR UPDATE OF o SKIP LOCKED;
+"""
+
+# Every product the batch needs is locked up front in id order, so workers
+# contending for the same products queue instead of deadlocking.
+SQL_LOCK_PRODUCTS = """
+    SELECT id FROM products
+    WHERE id IN (SELECT i.product_id FROM order_items i WHERE i.order_id = ANY(%s) {unreserved})
+    ORDER BY id
+    FOR NO KEY UPDATE;
+"""
+
+# With the stock_ledger schema profile, lines whose stock the checkout
+# already committed through commit_stock() are neither locked nor allocated
+# again; db_stock.py folds those reservations into products.stock.
+SQL_UNRESERVED_LINES = """
+    AND NOT EXISTS (
+        SELECT 1 FROM stock_reservations r
+        WHERE r.order_id = i.order_id AND r.product_id = i.product_id AND r.status = 'committed'
+    )
+"""
+
+# Allocates one order's stock and sets its status in a single statement. The
+# decrement only runs when every line can be filled; a missing product or a
+# short line holds the order, or cancels it when cancel_short is set and it
+# has not been paid.
+SQL_PROCESS_ORDER = """
+    WITH need AS (
+        SELECT i.product_id, sum(i.quantity) AS quantity
+        FROM order_items i WHERE i.order_id = %(order_id)s {unreserved}
+        GROUP BY i.product_id
+    ),
+    short AS (
+        SELECT need.product_id
+        FROM need LEFT JOIN products p ON p.id = need.product_id
+        WHERE coalesce(p.stock, 0) < need.quantity
+    ),
+    allocated AS (
+        UPDATE products p
+        SET stock = p.stock - need.quantity
+        FROM need
+        WHERE p.id = need.product_id AND NOT EXISTS (SELECT 1 FROM short)
+        RETURNING p.id
+    ),
+    outcome AS (
+        SELECT s.products,
+               s.products IS NOT NULL AND %(cancel_short)s AND o.payment_status IS DISTINCT FROM 'completed' AS cancel
+        FROM orders o, (SELECT string_agg(product_id::text, ', ' ORDER BY product_id) AS products FROM short) s
+        WHERE o.id = %(order_id)s
+    )
+    UPDATE orders o
+    SET status = CASE WHEN s.products IS NULL THEN 'processing'::order_status
+                      WHEN s.cancel THEN 'cancelled'::order_status
+                      ELSE o.status END,
+        notes = CASE WHEN s.cancel
+                     THEN concat_ws(E'\\n', o.notes, 'Cancelled: insufficient stock for product(s) ' || s.products)
+                     ELSE o.notes END,
+        held_at = CASE WHEN s.products IS NULL OR s.cancel THEN NULL ELSE now() END,
+        hold_reason = CASE WHEN s.products IS NULL OR s.cancel THEN NULL
+                           ELSE 'insufficient stock for product(s) ' || s.products END,
+        updated_at = now()
+    FROM outcome s
+    WHERE o.id = %(order_id)s
+    RETURNING o.status;
+"""
+
+SQL_BACKLOG = """
+    SELECT count(*), min(created_at), count(*) FILTER (WHERE NOT EXISTS (
+        SELECT 1 FROM order_items i WHERE i.order_id = o.id)),
+        count(*) FILTER (WHERE held_at IS NOT NULL)
+    FROM orders o WHERE status = 'pending';
+"""
+
+# Clears the hold so workers claim the orders again.
+SQL_RELEASE_HELD = """
+    UPDATE orders
+    SET held_at = NULL, hold_reason = NULL, updated_at = now()
+    WHERE status = 'pending' AND held_at IS NOT NULL
+      AND (%(order_ids)s IS NULL OR id = ANY(%(order_ids)s));
+"""
+
+def connect():
+    """Opens a connection using DB_CONFIG."""
+    return psycopg2.connect(**DB_CONFIG)
+
+def allocation_statements(cursor):
+    """Returns the product lock and order processing statements for this database."""
+    cursor.execute("SELECT to_regclass('stock_reservations') IS NOT NULL;")
+    unreserved = SQL_UNRESERVED_LINES if cursor.fetchone()[0] else ""
+    cursor.connection.rollback()
+    return SQL_LOCK_PRODUCTS.format(unreserved=unreserved), SQL_PROCESS_ORDER.format(unreserved=unreserved)
+
+def process_batch(conn, cursor, batch_size, statements, cancel_short=False):
+    """Claims and processes one batch in one transaction; returns (processed, short)."""
+    lock_products, process_order = statements
+    cursor.execute(SQL_CLAIM_BATCH, (batch_size,))
+    order_ids = [row[0] for row in cursor.fetchall()]
+    if not order_ids:
+        conn.rollback()
+        return 0, 0
+    cursor.execute(lock_products, (order_ids,))
+    short = 0
+    for order_id in order_ids:
+        cursor.execute(process_order, {"order_id": order_id, "cancel_short": cancel_short})
+        if cursor.fetchone()[0] != 'processing':
+            short += 1
+    conn.commit()
+    return len(order_ids), short
+
+def drain(conn, cursor, batch_size, statements, cancel_short=False):
+    """Processes batches until no claimable order is left; returns (processed, short)."""
+    processed = short = 0
+    while True:
+        done, missing = process_batch(conn, cursor, batch_size, statements, cancel_short)
+        processed += done
+        short += missing
+        if done < batch_size:
+            return processed, short
+
+def wait_for_orders(conn, timeout):
+    """Blocks until a notification arrives on the channel or timeout passes."""
+    if not conn.notifies and select.select([conn], [], [], timeout) != ([], [], []):
+        conn.poll()
+    conn.notifies.clear()
+
+def run_worker(worker_id, batch_size, poll_interval, once, cancel_short, results):
+    """Worker process loop: drain, then sleep until notified."""
+    conn = connect()
+    cursor = conn.cursor()
+    processed = short = 0
+    started = time.monotonic()
+    try:
+        conn.autocommit = True
+        cursor.execute(f"LISTEN {CHANNEL};")
+        conn.autocommit = False
+        statements = allocation_statements(cursor)
+        while True:
+            done, missing = drain(conn, cursor, batch_size, statements, cancel_short)
+            processed += done
+            short += missing
+            if done:
+                print(f"[worker {worker_id}] processed {done} orders ({missing} short of stock), {processed} in total")
+            if once:
+                break
+            wait_for_orders(conn, poll_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        results.put((worker_id, processed, short, time.monotonic() - started))
+        cursor.close()
+        conn.close()
+
+def run_pool(workers=DEFAULT_WORKERS, batch_size=DEFAULT_BATCH_SIZE, poll_interval=DEFAULT_POLL_INTERVAL, once=False,
+             cancel_short=False):
+    """Runs worker processes until interrupted (or, with once, until the backlog is drained).
+
+    Orders short of stock are held for review; with cancel_short, those not
+    yet paid are cancelled instead.
+    """
+    print(f"Starting {workers} order worker(s) with batches of {batch_size}"
+          f"{' (drain once)' if once else f', listening on {CHANNEL}'}...")
+    results = Queue()
+    pool = [Process(target=run_worker, args=(n, batch_size, poll_interval, once, cancel_short, results)) for n in range(workers)]
+    started = time.monotonic()
+    for process in pool:
+        process.start()
+    try:
+        for process in pool:
+            process.join()
+    except KeyboardInterrupt:
+        for process in pool:
+            process.join()
+    elapsed = time.monotonic() - started
+    totals = [results.get() for _ in pool]
+    processed = sum(t[1] for t in totals)
+    short = sum(t[2] for t in totals)
+    print(f"{processed} orders processed ({short} short of stock) in {elapsed:.1f}s, "
+          f"{processed / elapsed if elapsed else 0:.0f} orders/s")
+    return processed
+
+def backlog():
+    """Returns (pending orders, oldest pending created_at, pending orders without items, held orders)."""
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SQL_BACKLOG)
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+        conn.close()
+
+def release(order_ids=None):
+    """Puts held orders (all, or those in order_ids) back in the queue; returns how many."""
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SQL_RELEASE_HELD, {"order_ids": order_ids or None})
+        released = cursor.rowcount
+        cursor.execute(f"NOTIFY {CHANNEL};")
+        conn.commit()
+        return released
+    finally:
+        cursor.close()
+        conn.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Process pending orders with a pool of workers.")
+    actions = parser.add_subparsers(dest="action", required=True)
+
+    run_parser = actions.add_parser("run", help="start the worker pool")
+    run_parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    run_parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="orders claimed per transaction")
+    run_parser.add_argument("--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL,
+                            help="seconds to wait for a notification before checking anyway")
+    run_parser.add_argument("--once", action="store_true", help="drain the current backlog and exit")
+    run_parser.add_argument("--cancel-short", action="store_true",
+                            help="cancel unpaid orders short of stock instead of holding them for review")
+
+    actions.add_parser("backlog", help="show pending orders")
+
+    release_parser = actions.add_parser("release", help="queue held orders again, e.g. after restocking")
+    release_parser.add_argument("order_ids", nargs="*", type=int, help="orders to release (default: all held)")
+
+    args = parser.parse_args(argv)
+    if args.action == "run":
+        run_pool(workers=args.workers, batch_size=args.batch_size, poll_interval=args.poll_interval, once=args.once,
+                 cancel_short=args.cancel_short)
+    elif args.action == "backlog":
+        pending, oldest, without_items, held = backlog()
+        print(f"{pending} pending orders{f', oldest from {oldest.isoformat()}' if oldest else ''}"
+              f"{f', {without_items} without items' if without_items else ''}"
+              f"{f', {held} held for review' if held else ''}.")
+    elif args.action == "release":
+        print(f"Released {release(args.order_ids)} held order(s).")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
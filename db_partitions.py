@@ -0,0 +1,430 @@
+
+import argparse
+import re
+import sys
+import time
+from datetime import date, datetime, timezone
+import psycopg2
+
+from create_db_updated import DB_CONFIG, SCHEMA_PROFILES, declared_objects, table_name, trigger_table
+from db_indexes import index_table
+
+# Monthly range partitions for orders and order_items.
+#
+# The "partitioned_orders" schema profile (create_db_updated.py) declares both
+# tables PARTITION BY RANGE (created_at) with a DEFAULT partition. This module
+# keeps partitions named {table}_pYYYY_MM created ahead of time, detaches or
+# drops old months, attaches prepared tables as partitions without a long
+# validation lock, and converts an existing unpartitioned table online.
+
+PARTITIONED_TABLES = ("orders", "order_items")
+PROFILE = "partitioned_orders"
+
+SQL_PARTITIONS = """
+    SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = to_regclass(%s)
+    ORDER BY c.relname;
+"""
+
+SQL_IS_PARTITIONED = "SELECT coalesce((SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)), false);"
+
+SQL_TABLE_COLUMNS = """
+    SELECT column_name FROM information_schema.columns
+    WHERE table_schema = current_schema() AND table_name = %s
+    ORDER BY ordinal_position;
+"""
+
+# Constraints backed by an index share the index namespace, so they must be
+# renamed along with the table during the swap.
+SQL_INDEX_CONSTRAINTS = """
+    SELECT conname FROM pg_constraint
+    WHERE conrelid = to_regclass(%s) AND contype IN ('p', 'u')
+    ORDER BY conname;
+"""
+
+SQL_TABLE_INDEXES = """
+    SELECT c.relname FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE i.indrelid = to_regclass(%s)
+      AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = c.oid)
+    ORDER BY c.relname;
+"""
+
+PARTITION_NAME = re.compile(r"^(?P<table>\w+)_p(?P<year>\d{4})_(?P<month>\d{2})$")
+
+LOCK_TIMEOUT = "2s"
+LOCK_RETRIES = 10
+LOCK_BACKOFF_SECONDS = 0.5
+DEFAULT_MONTHS_AHEAD = 3
+DEFAULT_BATCH_SIZE = 5000
+
+# Legacy rows may have a NULL created_at; they are filed under the epoch in
+# the DEFAULT partition. The expression must give the same key for the same
+# row version in the batched copy and in the mirror trigger.
+CREATED_AT_KEY = "coalesce({prefix}created_at, timestamptz 'epoch')"
+
+def connect():
+    """Opens a connection using DB_CONFIG."""
+    return psycopg2.connect(**DB_CONFIG)
+
+def add_months(month, count):
+    """Returns the first day of the month count months after month."""
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+def month_start(value):
+    """Returns the first day of value's month."""
+    return date(value.year, value.month, 1)
+
+def partition_name(table, month):
+    """Returns the partition name for table and the month starting at month."""
+    return f"{table}_p{month.year:04d}_{month.month:02d}"
+
+def partition_bounds(month):
+    """Returns the FOR VALUES clause for one month."""
+    return f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+
+def default_partition(table):
+    """Returns the name of table's DEFAULT partition."""
+    return f"{table}_default"
+
+def with_lock_retry(conn, cursor, label, statements):
+    """Runs statements in one transaction under lock_timeout, retrying with backoff."""
+    for attempt in range(1, LOCK_RETRIES + 1):
+        try:
+            cursor.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}';")
+            for sql in statements:
+                cursor.execute(sql)
+            conn.commit()
+            return
+        except psycopg2.errors.LockNotAvailable:
+            conn.rollback()
+            if attempt == LOCK_RETRIES:
+                raise
+            delay = LOCK_BACKOFF_SECONDS * 2 ** (attempt - 1)
+            print(f"[{label}] lock not granted within {LOCK_TIMEOUT} (attempt {attempt}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def require_partitioned(cursor, table):
+    """Raises unless table exists and is partitioned."""
+    cursor.execute(SQL_IS_PARTITIONED, (table,))
+    if not cursor.fetchone()[0]:
+        raise RuntimeError(f"{table} is not partitioned; run 'partitions convert' first")
+
+def existing_partitions(cursor, table):
+    """Returns {name: bound expression} for table's partitions."""
+    cursor.execute(SQL_PARTITIONS, (table,))
+    return dict(cursor.fetchall())
+
+def create_partition(conn, cursor, table, month):
+    """Creates one monthly partition, moving matching rows out of DEFAULT if needed."""
+    name = partition_name(table, month)
+    default = default_partition(table)
+    lower, upper = month.isoformat(), add_months(month, 1).isoformat()
+    try:
+        with_lock_retry(conn, cursor, name, [f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} {partition_bounds(month)};"])
+        print(f"Created {name}")
+        return
+    except psycopg2.errors.CheckViolation:
+        conn.rollback()
+    # Rows for this month already landed in DEFAULT: build the partition as a
+    # plain table, move the rows across and attach it, all in one transaction.
+    with_lock_retry(conn, cursor, name, [
+        f"LOCK TABLE {default} IN ACCESS EXCLUSIVE MODE;",
+        f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS);",
+        f"WITH moved AS (DELETE FROM {default} WHERE created_at >= '{lower}' AND created_at < '{upper}' RETURNING *) "
+        f"INSERT INTO {name} SELECT * FROM moved;",
+        f"ALTER TABLE {name} ADD CONSTRAINT {name}_bounds CHECK (created_at >= '{lower}' AND created_at < '{upper}');",
+        f"ALTER TABLE {table} ATTACH PARTITION {name} {partition_bounds(month)};",
+        f"ALTER TABLE {name} DROP CONSTRAINT {name}_bounds;",
+    ])
+    print(f"Created {name} and moved its rows out of {default}")
+
+def ensure_partitions(months_ahead=DEFAULT_MONTHS_AHEAD, months_back=0, tables=PARTITIONED_TABLES):
+    """Creates monthly partitions from months_back ago through months_ahead from now."""
+    conn = connect()
+    cursor = conn.cursor()
+    current = month_start(datetime.now(timezone.utc))
+    try:
+        for table in tables:
+            require_partitioned(cursor, table)
+            present = existing_partitions(cursor, table)
+            conn.commit()
+            for offset in range(-months_back, months_ahead + 1):
+                month = add_months(current, offset)
+                if partition_name(table, month) not in present:
+                    create_partition(conn, cursor, table, month)
+        print("Partitions are in place.")
+    finally:
+        cursor.close()
+        conn.close()
+
+def partitions_before(cursor, table, cutoff):
+    """Returns the managed monthly partitions of table that end on or before cutoff."""
+    months = []
+    for name in existing_partitions(cursor, table):
+        match = PARTITION_NAME.match(name)
+        if match and match.group("table") == table:
+            month = date(int(match.group("year")), int(match.group("month")), 1)
+            if add_months(month, 1) <= cutoff:
+                months.append(name)
+    return months
+
+def detach_partitions(older_than_months, drop=False, tables=PARTITIONED_TABLES):
+    """Detaches (and optionally drops) monthly partitions older than the given age."""
+    cutoff = add_months(month_start(datetime.now(timezone.utc)), -older_than_months)
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        for table in tables:
+            require_partitioned(cursor, table)
+            names = partitions_before(cursor, table, cutoff)
+            has_default = default_partition(table) in existing_partitions(cursor, table)
+            conn.commit()
+            for name in names:
+                if has_default:
+                    # DETACH CONCURRENTLY is refused while a DEFAULT partition
+                    # exists, so take the brief lock with a timeout instead.
+                    with_lock_retry(conn, cursor, name, [f"ALTER TABLE {table} DETACH PARTITION {name};"])
+                else:
+                    conn.autocommit = True
+                    cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {name} CONCURRENTLY;")
+                    conn.autocommit = False
+                print(f"Detached {name}")
+                if drop:
+                    cursor.execute(f"DROP TABLE {name};")
+                    conn.commit()
+                    print(f"Dropped {name}")
+        print(f"Partitions ending before {cutoff.isoformat()} are detached.")
+    finally:
+        cursor.close()
+        conn.close()
+
+def attach_partition(table, source, month):
+    """Attaches a prepared table as table's partition for month.
+
+    The range is first proven by a CHECK constraint validated under SHARE
+    UPDATE EXCLUSIVE, so ATTACH PARTITION can skip its own scan.
+    """
+    lower, upper = month.isoformat(), add_months(month, 1).isoformat()
+    check = f"{source}_bounds"
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        require_partitioned(cursor, table)
+        conn.commit()
+        with_lock_retry(conn, cursor, source, [
+            f"ALTER TABLE {source} ADD CONSTRAINT {check} CHECK (created_at >= '{lower}' AND created_at < '{upper}') NOT VALID;",
+        ])
+        with_lock_retry(conn, cursor, source, [f"ALTER TABLE {source} VALIDATE CONSTRAINT {check};"])
+        with_lock_retry(conn, cursor, source, [
+            f"ALTER TABLE {table} ATTACH PARTITION {source} {partition_bounds(month)};",
+            f"ALTER TABLE {source} DROP CONSTRAINT {check};",
+        ])
+        print(f"Attached {source} to {table} for {lower}")
+    finally:
+        cursor.close()
+        conn.close()
+
+def profile_table_sql(table):
+    """Returns the partitioned CREATE TABLE statement the profile declares for table."""
+    for kind, sql in SCHEMA_PROFILES[PROFILE]["replace"]:
+        if kind == 'table' and table_name(sql) == table:
+            return sql
+    raise KeyError(table)
+
+def shadow_statements(table, shadow, first_month, last_month):
+    """Returns the DDL creating the empty partitioned shadow of table.
+
+    Partitions get their final names straight away; indexes get a _p suffix
+    and are renamed during the swap. The id column keeps drawing from the
+    legacy sequence so ids stay unique across the switch.
+    """
+    sql = profile_table_sql(table)
+    sql = sql.replace(f"CREATE TABLE IF NOT EXISTS {table} (", f"CREATE TABLE {shadow} (", 1)
+    sql = sql.replace("id SERIAL NOT NULL", f"id INTEGER NOT NULL DEFAULT nextval('{table}_id_seq')", 1)
+    statements = [sql, f"CREATE TABLE {default_partition(table)} PARTITION OF {shadow} DEFAULT;"]
+    month = first_month
+    while month <= last_month:
+        statements.append(f"CREATE TABLE {partition_name(table, month)} PARTITION OF {shadow} {partition_bounds(month)};")
+        month = add_months(month, 1)
+
+    objects = declared_objects(profiles=[PROFILE])
+    for kind, name, sql in objects:
+        if kind == 'index' and index_table(sql) == table:
+            statements.append(sql.replace(f" {name} ", f" {name}_p ", 1).replace(f" ON {table} ", f" ON {shadow} ", 1))
+        elif kind == 'foreign_key' and sql.split("ALTER TABLE ")[1].split()[0] == table:
+            statements.append(sql.replace(f"ALTER TABLE {table} ", f"ALTER TABLE {shadow} ", 1))
+    return statements
+
+def mirror_statements(table, shadow, columns):
+    """Returns the trigger that replays writes on the legacy table into the shadow."""
+    column_list = ", ".join(columns)
+    values = ", ".join(CREATED_AT_KEY.format(prefix="NEW.") if c == "created_at" else f"NEW.{c}" for c in columns)
+    return [
+        f"""
+        CREATE OR REPLACE FUNCTION {table}_partition_mirror() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                DELETE FROM {shadow} WHERE id = OLD.id;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO {shadow} ({column_list}) VALUES ({values});
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        f"CREATE OR REPLACE TRIGGER trg_{table}_partition_mirror AFTER INSERT OR UPDATE OR DELETE ON {table} "
+        f"FOR EACH ROW EXECUTE FUNCTION {table}_partition_mirror();",
+    ]
+
+def copy_batches(conn, cursor, table, shadow, columns, batch_size, pause):
+    """Copies legacy rows into the shadow in keyset batches, one commit per batch.
+
+    FOR UPDATE holds back concurrent writes to the batch's rows until it
+    commits, after which the mirror trigger replays them; rows the trigger
+    already copied are skipped by the primary key.
+    """
+    column_list = ", ".join(columns)
+    values = ", ".join(CREATED_AT_KEY.format(prefix="") if c == "created_at" else c for c in columns)
+    last_id = 0
+    copied = 0
+    started = time.monotonic()
+    while True:
+        cursor.execute(f"SELECT max(id) FROM (SELECT id FROM {table} WHERE id > %s ORDER BY id LIMIT %s) batch;",
+                       (last_id, batch_size))
+        batch_end = cursor.fetchone()[0]
+        if batch_end is None:
+            break
+        cursor.execute(
+            f"INSERT INTO {shadow} ({column_list}) "
+            f"SELECT {values} FROM {table} WHERE id > %s AND id <= %s ORDER BY id FOR UPDATE "
+            f"ON CONFLICT DO NOTHING;",
+            (last_id, batch_end),
+        )
+        copied += cursor.rowcount
+        conn.commit()
+        last_id = batch_end
+        print(f"[{table}] copied through id {last_id} ({copied} rows)")
+        if pause:
+            time.sleep(pause)
+    print(f"[{table}] copy complete: {copied} rows in {time.monotonic() - started:.1f}s")
+
+def swap_statements(cursor, table, shadow):
+    """Returns the statements that put the shadow in place of the legacy table."""
+    legacy = f"{table}_legacy"
+    statements = [
+        f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE;",
+        f"DROP TRIGGER trg_{table}_partition_mirror ON {table};",
+        f"DROP FUNCTION {table}_partition_mirror();",
+        f"ALTER TABLE {table} RENAME TO {legacy};",
+    ]
+    cursor.execute(SQL_INDEX_CONSTRAINTS, (table,))
+    for (name,) in cursor.fetchall():
+        statements.append(f"ALTER TABLE {legacy} RENAME CONSTRAINT {name} TO {name.replace(table, legacy, 1)};")
+    cursor.execute(SQL_TABLE_INDEXES, (table,))
+    for (name,) in cursor.fetchall():
+        statements.append(f"ALTER INDEX {name} RENAME TO {name}_legacy;")
+
+    statements.append(f"ALTER TABLE {shadow} RENAME TO {table};")
+    cursor.execute(SQL_INDEX_CONSTRAINTS, (shadow,))
+    for (name,) in cursor.fetchall():
+        statements.append(f"ALTER TABLE {table} RENAME CONSTRAINT {name} TO {name.replace(shadow, table, 1)};")
+    cursor.execute(SQL_TABLE_INDEXES, (shadow,))
+    for (name,) in cursor.fetchall():
+        if name.endswith("_p"):
+            statements.append(f"ALTER INDEX {name} RENAME TO {name[:-2]};")
+
+    # The profile drops the one foreign key a partitioned orders cannot serve.
+    for kind, name in SCHEMA_PROFILES[PROFILE]["drop"]:
+        if kind == 'foreign_key':
+            statements.append(f"ALTER TABLE IF EXISTS order_items DROP CONSTRAINT IF EXISTS {name};")
+    statements.append(f"ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id;")
+    # Declared triggers stay behind on the legacy table; recreate them.
+    for kind, _name, sql in declared_objects(profiles=[PROFILE]):
+        if kind == 'trigger' and trigger_table(sql) == table:
+            statements.append(sql)
+    return statements
+
+def convert_table(table, batch_size=DEFAULT_BATCH_SIZE, pause=0.0, months_ahead=DEFAULT_MONTHS_AHEAD):
+    """Converts an unpartitioned table to the partitioned layout without a long lock.
+
+    Creates an empty partitioned shadow, mirrors live writes into it with a
+    trigger, copies existing rows in batches, then swaps names in one short
+    transaction. The old table is kept as {table}_legacy.
+    """
+    shadow = f"{table}_partitioned"
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SQL_IS_PARTITIONED, (table,))
+        if cursor.fetchone()[0]:
+            print(f"{table} is already partitioned.")
+            return
+        cursor.execute(f"SELECT min(created_at) FROM {table};")
+        oldest = cursor.fetchone()[0]
+        cursor.execute(SQL_TABLE_COLUMNS, (table,))
+        columns = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+
+        current = month_start(datetime.now(timezone.utc))
+        first_month = month_start(oldest) if oldest else current
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (shadow,))
+        if not cursor.fetchone()[0]:
+            print(f"[{table}] creating partitioned shadow {shadow} from {first_month.isoformat()}")
+            for sql in shadow_statements(table, shadow, first_month, add_months(current, months_ahead)):
+                cursor.execute(sql)
+            conn.commit()
+        # Installing the trigger needs a brief SHARE ROW EXCLUSIVE lock.
+        with_lock_retry(conn, cursor, table, mirror_statements(table, shadow, columns))
+        copy_batches(conn, cursor, table, shadow, columns, batch_size, pause)
+
+        print(f"[{table}] swapping {shadow} into place")
+        with_lock_retry(conn, cursor, table, swap_statements(cursor, table, shadow))
+        conn.commit()
+        print(f"[{table}] converted; the old table remains as {table}_legacy until you drop it.")
+    finally:
+        cursor.close()
+        conn.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage monthly partitions of orders and order_items.")
+    actions = parser.add_subparsers(dest="action", required=True)
+
+    ensure_parser = actions.add_parser("ensure", help="pre-create monthly partitions")
+    ensure_parser.add_argument("--months-ahead", type=int, default=DEFAULT_MONTHS_AHEAD)
+    ensure_parser.add_argument("--months-back", type=int, default=0)
+    ensure_parser.add_argument("--table", action="append", choices=PARTITIONED_TABLES, help="table to manage (default both)")
+
+    detach_parser = actions.add_parser("detach", help="detach monthly partitions older than a given age")
+    detach_parser.add_argument("--older-than-months", type=int, required=True)
+    detach_parser.add_argument("--drop", action="store_true", help="drop each partition after detaching it")
+    detach_parser.add_argument("--table", action="append", choices=PARTITIONED_TABLES, help="table to manage (default both)")
+
+    attach_parser = actions.add_parser("attach", help="attach a prepared table as a monthly partition")
+    attach_parser.add_argument("table", choices=PARTITIONED_TABLES)
+    attach_parser.add_argument("source", help="table to attach")
+    attach_parser.add_argument("month", help="month the table holds, as YYYY-MM")
+
+    convert_parser = actions.add_parser("convert", help="convert existing tables to the partitioned layout online")
+    convert_parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    convert_parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    convert_parser.add_argument("--months-ahead", type=int, default=DEFAULT_MONTHS_AHEAD)
+    convert_parser.add_argument("--table", action="append", choices=PARTITIONED_TABLES, help="table to convert (default both)")
+
+    args = parser.parse_args(argv)
+    if args.action == "ensure":
+        ensure_partitions(months_ahead=args.months_ahead, months_back=args.months_back, tables=args.table or PARTITIONED_TABLES)
+    elif args.action == "detach":
+        detach_partitions(args.older_than_months, drop=args.drop, tables=args.table or PARTITIONED_TABLES)
+    elif args.action == "attach":
+        attach_partition(args.table, args.source, datetime.strptime(args.month, "%Y-%m").date())
+    elif args.action == "convert":
+        for table in args.table or PARTITIONED_TABLES:
+            convert_table(table, batch_size=args.batch_size, pause=args.pause, months_ahead=args.months_ahead)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,556 @@
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import time
+import psycopg2
+import psycopg2.extensions
+
+from create_db_updated import DB_CONFIG, create_schema, missing_objects, schema_fingerprint
+
+# Read replica provisioning, verification and routing.
+#
+# Reporting and search only read, so they can run on a replica and leave
+# the primary to checkout. This module sets up a replica of the database in
+# DB_CONFIG in one of two modes:
+#
+#   streaming  a physical standby: pg_basebackup with a replication slot,
+#              then the copy is started as a hot standby. It holds every
+#              table and is read-only.
+#   logical    an ordinary database whose schema create_schema() applies
+#              from the declaration. It subscribes to a publication of
+#              the read-heavy tables (PUBLISHED_TABLES), and only those are
+#              kept current; the other tables exist but stay empty. The
+#              primary needs wal_level = logical.
+#
+# With --data-dir, 'replica provision' also creates and starts the replica
+# cluster on --port using the PostgreSQL binaries (--bin-dir, or found on
+# PATH). That makes two clusters on one host enough for a local test. As
+# root, pass --run-as with the account that owns the primary's cluster,
+# since initdb and pg_ctl refuse to run as root. Without --data-dir, the
+# logical mode uses an already running server at DATABASE_REPLICA_HOST and
+# DATABASE_REPLICA_PORT.
+#
+# 'replica verify' waits for the replica to replay the primary's current
+# WAL position. It then checks the replica's schema against the
+# declaration and compares the published tables' row counts (on a quiet
+# primary). 'replica lag' reports replay lag in bytes and seconds from
+# pg_stat_replication, and the WAL the slot retains. With --check it exits
+# non-zero when the replica is disconnected or over the thresholds.
+#
+# Readers can use 'replica dsn', a libpq multi-host connection string that
+# prefers the replica and falls back to the primary when the replica is
+# down. read_config() instead returns the replica's connection parameters
+# only while its lag is within bounds, and the primary's otherwise.
+
+REPLICA_CONFIG = {
+    "database": os.getenv("DATABASE_REPLICA_NAME", DB_CONFIG["database"]),
+    "user": os.getenv("DATABASE_REPLICA_USER", DB_CONFIG["user"]),
+    "password": os.getenv("DATABASE_REPLICA_PASSWORD", DB_CONFIG["password"]),
+    "host": os.getenv("DATABASE_REPLICA_HOST", DB_CONFIG["host"]),
+    "port": os.getenv("DATABASE_REPLICA_PORT", "5433"),
+}
+
+# Names the slot, the subscription and the standby's cluster_name, which
+# is also what the replica shows as in pg_stat_replication.
+REPLICA_NAME = os.getenv("DATABASE_REPLICA_SLOT", "plenaire_replica")
+PUBLICATION = "plenaire_read"
+PUBLISHED_TABLES = ("products", "categories", "orders", "order_items", "reviews")
+MAINTENANCE_DB = os.getenv("DATABASE_MAINTENANCE_DB", "postgres")
+MODES = ("streaming", "logical")
+
+DEFAULT_MAX_LAG_SECONDS = 30.0
+DEFAULT_MAX_LAG_BYTES = 64 * 1024 * 1024
+DEFAULT_TIMEOUT = 120.0
+POLL_INTERVAL = 0.5
+
+SQL_SLOT_EXISTS = "SELECT active FROM pg_replication_slots WHERE slot_name = %s;"
+
+SQL_CURRENT_LSN = "SELECT pg_current_wal_lsn();"
+
+SQL_PRIMARY_LAG = """
+    SELECT r.state,
+           pg_wal_lsn_diff(pg_current_wal_lsn(), r.replay_lsn)::bigint,
+           coalesce(extract(epoch FROM r.replay_lag), 0)::float,
+           pg_wal_lsn_diff(%s::pg_lsn, r.replay_lsn) <= 0
+    FROM pg_stat_replication r
+    WHERE r.application_name = %s
+    ORDER BY r.backend_start DESC
+    LIMIT 1;
+"""
+
+SQL_SLOT_RETAINED = """
+    SELECT active, pg_wal_lsn_diff(pg_current_wal_lsn(), restart_lsn)::bigint
+    FROM pg_replication_slots WHERE slot_name = %s;
+"""
+
+# Streaming: how far behind the standby's replay is. An idle primary leaves
+# the last replay timestamp old, so a fully replayed standby reports 0.
+SQL_STANDBY_DELAY = """
+    SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END::float;
+"""
+
+SQL_SUBSCRIPTION = """
+    SELECT s.subenabled, st.pid IS NOT NULL, extract(epoch FROM now() - st.last_msg_receipt_time)::float
+    FROM pg_subscription s
+    LEFT JOIN pg_stat_subscription st ON st.subid = s.oid AND st.relid IS NULL
+    WHERE s.subname = %s;
+"""
+
+SQL_UNSYNCED_TABLES = """
+    SELECT r.srrelid::regclass::text, r.srsubstate
+    FROM pg_subscription_rel r JOIN pg_subscription s ON s.oid = r.srsubid
+    WHERE s.subname = %s AND r.srsubstate <> 'r'
+    ORDER BY 1;
+"""
+
+SQL_STORED_FINGERPRINT = "SELECT value FROM schema_metadata WHERE key = 'schema_fingerprint';"
+
+def connect(config):
+    """Opens an autocommit connection with the given parameters."""
+    conn = psycopg2.connect(**config)
+    conn.autocommit = True
+    return conn
+
+def conninfo(config):
+    """Returns config as a libpq connection string."""
+    return psycopg2.extensions.make_dsn(**{key: value for key, value in config.items() if value not in (None, "")})
+
+def binary(name, bin_dir=None):
+    """Returns the path of a PostgreSQL program."""
+    if bin_dir:
+        return os.path.join(bin_dir, name)
+    found = shutil.which(name)
+    if found:
+        return found
+    pg_config = shutil.which("pg_config")
+    if pg_config:
+        candidate = os.path.join(subprocess.check_output([pg_config, "--bindir"], text=True).strip(), name)
+        if os.path.exists(candidate):
+            return candidate
+    raise RuntimeError(f"{name} not found; pass --bin-dir with the PostgreSQL binaries.")
+
+def run(command, run_as=None):
+    """Runs a PostgreSQL program, as run_as when given."""
+    prefix = ["runuser", "-u", run_as, "--"] if run_as else []
+    env = dict(os.environ, PGPASSWORD=DB_CONFIG["password"]) if DB_CONFIG["password"] else None
+    print("  $ " + " ".join(command))
+    subprocess.run(prefix + command, check=True, env=env)
+
+def configure_cluster(data_dir, port, settings=()):
+    """Appends the replica's port, cluster_name and settings to postgresql.auto.conf."""
+    lines = [f"port = {int(port)}", f"cluster_name = '{REPLICA_NAME}'"] + list(settings)
+    with open(os.path.join(data_dir, "postgresql.auto.conf"), "a") as f:
+        f.write("\n# Added by db_replica.py\n" + "\n".join(lines) + "\n")
+
+def start_cluster(data_dir, bin_dir=None, run_as=None):
+    run([binary("pg_ctl", bin_dir), "-D", data_dir, "-l", os.path.join(data_dir, "replica.log"),
+         "-w", "-t", "120", "start"], run_as)
+
+def cluster_running(data_dir, bin_dir=None, run_as=None):
+    prefix = ["runuser", "-u", run_as, "--"] if run_as else []
+    return subprocess.run(prefix + [binary("pg_ctl", bin_dir), "-D", data_dir, "status"],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+def prepare_data_dir(data_dir, run_as=None):
+    if os.path.isdir(data_dir) and os.listdir(data_dir):
+        raise RuntimeError(f"{data_dir} is not empty; tear the old replica down or choose another --data-dir.")
+    os.makedirs(data_dir, mode=0o700, exist_ok=True)
+    if run_as:
+        shutil.chown(data_dir, user=run_as, group=run_as)
+
+def provision_streaming(data_dir, port, bin_dir=None, run_as=None):
+    """Copies the primary with pg_basebackup and starts the copy as a hot standby."""
+    if not data_dir:
+        raise RuntimeError("The streaming mode needs --data-dir for the standby's copy.")
+    prepare_data_dir(data_dir, run_as)
+    conn = connect(DB_CONFIG)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SQL_SLOT_EXISTS, (REPLICA_NAME,))
+        if cursor.fetchone() is None:
+            # Reserving WAL right away keeps everything the backup's end
+            # position needs until the standby connects.
+            cursor.execute("SELECT pg_create_physical_replication_slot(%s, true);", (REPLICA_NAME,))
+            print(f"Created physical replication slot {REPLICA_NAME}")
+    finally:
+        cursor.close()
+        conn.close()
+
+    run([binary("pg_basebackup", bin_dir), "-D", data_dir, "-h", DB_CONFIG["host"], "-p", str(DB_CONFIG["port"]),
+         "-U", DB_CONFIG["user"], "-X", "stream", "-S", REPLICA_NAME, "-R", "-c", "fast"], run_as)
+    # hot_standby_feedback keeps the primary from vacuuming away rows that
+    # long reports on the standby still read.
+    configure_cluster(data_dir, port, ["hot_standby = on", "hot_standby_feedback = on"])
+    start_cluster(data_dir, bin_dir, run_as)
+
+def provision_logical(data_dir=None, port=None, bin_dir=None, run_as=None):
+    """Creates the declared schema on the replica and subscribes it to the read-heavy tables."""
+    if data_dir:
+        if not os.path.exists(os.path.join(data_dir, "PG_VERSION")):
+            prepare_data_dir(data_dir, run_as)
+            run([binary("initdb", bin_dir), "-D", data_dir, "-U", REPLICA_CONFIG["user"], "--auth", "trust",
+                 "-E", "UTF8", "--locale", "C"], run_as)
+            configure_cluster(data_dir, port)
+        if not cluster_running(data_dir, bin_dir, run_as):
+            start_cluster(data_dir, bin_dir, run_as)
+
+    primary = connect(DB_CONFIG)
+    primary_cursor = primary.cursor()
+    try:
+        primary_cursor.execute("SHOW wal_level;")
+        if primary_cursor.fetchone()[0] != "logical":
+            raise RuntimeError("The logical mode needs wal_level = logical on the primary (a restart applies it).")
+
+        maintenance = connect(dict(REPLICA_CONFIG, database=MAINTENANCE_DB))
+        try:
+            cursor = maintenance.cursor()
+            cursor.execute("SELECT 1 FROM pg_database WHERE datname = %s;", (REPLICA_CONFIG["database"],))
+            if cursor.fetchone() is None:
+                cursor.execute(f'CREATE DATABASE "{REPLICA_CONFIG["database"]}";')
+                print(f"Created database {REPLICA_CONFIG['database']} on the replica")
+        finally:
+            maintenance.close()
+
+        create_schema(mode="diff", config=REPLICA_CONFIG)
+
+        primary_cursor.execute("SELECT 1 FROM pg_publication WHERE pubname = %s;", (PUBLICATION,))
+        if primary_cursor.fetchone() is None:
+            # Changes to partitions of a partitioned orders table are
+            # published as changes to orders itself.
+            primary_cursor.execute(f"CREATE PUBLICATION {PUBLICATION} FOR TABLE {', '.join(PUBLISHED_TABLES)} "
+                                   f"WITH (publish_via_partition_root = true);")
+            print(f"Created publication {PUBLICATION} for {', '.join(PUBLISHED_TABLES)}")
+    finally:
+        primary_cursor.close()
+        primary.close()
+
+    replica = connect(REPLICA_CONFIG)
+    cursor = replica.cursor()
+    try:
+        cursor.execute("SELECT 1 FROM pg_subscription WHERE subname = %s;", (REPLICA_NAME,))
+        if cursor.fetchone() is None:
+            cursor.execute(f"CREATE SUBSCRIPTION {REPLICA_NAME} CONNECTION %s PUBLICATION {PUBLICATION} "
+                           f"WITH (copy_data = true);", (conninfo(DB_CONFIG),))
+            print(f"Created subscription {REPLICA_NAME}; the initial copy runs in the background")
+    finally:
+        cursor.close()
+        replica.close()
+
+def provision(mode, data_dir=None, port=None, bin_dir=None, run_as=None, timeout=DEFAULT_TIMEOUT):
+    """Sets up the replica in the given mode and waits for it to catch up."""
+    port = port or REPLICA_CONFIG["port"]
+    if str(port) != str(REPLICA_CONFIG["port"]):
+        raise RuntimeError(f"--port {port} differs from DATABASE_REPLICA_PORT ({REPLICA_CONFIG['port']}).")
+    print(f"Provisioning a {mode} replica on port {port}...")
+    if mode == "streaming":
+        provision_streaming(data_dir, port, bin_dir, run_as)
+    else:
+        provision_logical(data_dir, port, bin_dir, run_as)
+    print(f"Replica caught up in {catch_up(timeout):.1f}s")
+
+def replica_mode(cursor):
+    """Returns 'streaming' for a standby, 'logical' for a subscriber, or None."""
+    cursor.execute("SELECT pg_is_in_recovery();")
+    if cursor.fetchone()[0]:
+        return "streaming"
+    cursor.execute(SQL_SUBSCRIPTION, (REPLICA_NAME,))
+    return "logical" if cursor.fetchone() else None
+
+def catch_up(timeout=DEFAULT_TIMEOUT):
+    """Waits until the replica has replayed the primary's current WAL position; returns the seconds taken."""
+    started = time.monotonic()
+    primary = connect(DB_CONFIG)
+    replica = connect(REPLICA_CONFIG)
+    try:
+        primary_cursor, replica_cursor = primary.cursor(), replica.cursor()
+        logical = replica_mode(replica_cursor) == "logical"
+        while logical:
+            # The initial copy of each table must finish before the apply
+            # worker's position means the table is current.
+            replica_cursor.execute(SQL_UNSYNCED_TABLES, (REPLICA_NAME,))
+            pending = replica_cursor.fetchall()
+            if not pending:
+                break
+            if time.monotonic() - started > timeout:
+                raise RuntimeError(f"Initial copy unfinished after {timeout:.0f}s: "
+                                   + ", ".join(f"{table} ({state})" for table, state in pending))
+            time.sleep(POLL_INTERVAL)
+        primary_cursor.execute(SQL_CURRENT_LSN)
+        target = primary_cursor.fetchone()[0]
+        while True:
+            primary_cursor.execute(SQL_PRIMARY_LAG, (target, REPLICA_NAME))
+            row = primary_cursor.fetchone()
+            if row and row[3]:
+                return time.monotonic() - started
+            if time.monotonic() - started > timeout:
+                raise RuntimeError(f"Replica did not replay {target} within {timeout:.0f}s"
+                                   + ("" if row else " (it is not connected to the primary)"))
+            time.sleep(POLL_INTERVAL)
+    finally:
+        primary.close()
+        replica.close()
+
+def lag_status():
+    """Returns the replica's connection state and lag as seen from both servers."""
+    status = {"connected": False, "state": None, "replay_bytes": None, "replay_lag_s": None,
+              "slot_active": None, "slot_retained_bytes": None, "reachable": False, "mode": None,
+              "replica_delay_s": None}
+    primary = connect(DB_CONFIG)
+    try:
+        cursor = primary.cursor()
+        cursor.execute(SQL_CURRENT_LSN)
+        cursor.execute(SQL_PRIMARY_LAG, (cursor.fetchone()[0], REPLICA_NAME))
+        row = cursor.fetchone()
+        if row:
+            status.update(connected=True, state=row[0], replay_bytes=max(row[1] or 0, 0), replay_lag_s=row[2])
+        cursor.execute(SQL_SLOT_RETAINED, (REPLICA_NAME,))
+        row = cursor.fetchone()
+        if row:
+            status.update(slot_active=row[0], slot_retained_bytes=row[1])
+    finally:
+        primary.close()
+    try:
+        replica = connect(dict(REPLICA_CONFIG, connect_timeout=5))
+    except psycopg2.OperationalError:
+        return status
+    try:
+        cursor = replica.cursor()
+        status.update(reachable=True, mode=replica_mode(cursor))
+        if status["mode"] == "streaming":
+            cursor.execute(SQL_STANDBY_DELAY)
+            status["replica_delay_s"] = cursor.fetchone()[0]
+        elif status["mode"] == "logical":
+            cursor.execute(SQL_SUBSCRIPTION, (REPLICA_NAME,))
+            _enabled, _running, since_message = cursor.fetchone()
+            status["replica_delay_s"] = since_message
+    finally:
+        replica.close()
+    return status
+
+def healthy(status, max_lag_seconds=DEFAULT_MAX_LAG_SECONDS, max_lag_bytes=DEFAULT_MAX_LAG_BYTES):
+    """Returns (ok, reason) for a lag_status() result."""
+    if not status["reachable"]:
+        return False, "replica unreachable"
+    if not status["connected"]:
+        return False, "replica not connected to the primary"
+    if status["state"] != "streaming":
+        return False, f"replication state is {status['state']}"
+    if status["replay_bytes"] > max_lag_bytes:
+        return False, f"{status['replay_bytes']} bytes behind (limit {max_lag_bytes})"
+    if status["replay_lag_s"] > max_lag_seconds:
+        return False, f"{status['replay_lag_s']:.1f}s behind (limit {max_lag_seconds:.0f}s)"
+    return True, "ok"
+
+def read_config(max_lag_seconds=DEFAULT_MAX_LAG_SECONDS, max_lag_bytes=DEFAULT_MAX_LAG_BYTES):
+    """Returns the replica's connection parameters while it is within the lag bounds, else the primary's.
+
+    Each call checks the lag, so long-running readers should call it once
+    per job rather than per query.
+    """
+    ok, reason = healthy(lag_status(), max_lag_seconds, max_lag_bytes)
+    if not ok:
+        print(f"Reading from the primary: {reason}", file=sys.stderr)
+        return DB_CONFIG
+    return REPLICA_CONFIG
+
+def routing_dsn(mode=None):
+    """Returns a libpq connection string that prefers the replica and falls back to the primary.
+
+    A standby is chosen by role (target_session_attrs=prefer-standby, libpq
+    14 and later). A logical replica is an ordinary server, so it is chosen
+    by being listed first. Both servers must share the database name and
+    credentials; otherwise only the replica is named.
+    """
+    shared = ("database", "user", "password")
+    if any(REPLICA_CONFIG[key] != DB_CONFIG[key] for key in shared):
+        return conninfo(REPLICA_CONFIG)
+    attrs = "prefer-standby" if mode == "streaming" and psycopg2.extensions.libpq_version() >= 140000 else "any"
+    return conninfo(dict(
+        {key: DB_CONFIG[key] for key in shared},
+        host=f"{REPLICA_CONFIG['host']},{DB_CONFIG['host']}",
+        port=f"{REPLICA_CONFIG['port']},{DB_CONFIG['port']}",
+        target_session_attrs=attrs,
+        connect_timeout=5,
+    ))
+
+def table_counts(config, tables):
+    conn = connect(config)
+    try:
+        cursor = conn.cursor()
+        counts = {}
+        for table in tables:
+            cursor.execute(f"SELECT count(*) FROM {table};")
+            counts[table] = cursor.fetchone()[0]
+        return counts
+    finally:
+        conn.close()
+
+def verify(timeout=DEFAULT_TIMEOUT):
+    """Checks that the replica is current, has the declared schema and holds the primary's rows."""
+    failures = []
+    replica = connect(REPLICA_CONFIG)
+    try:
+        cursor = replica.cursor()
+        mode = replica_mode(cursor)
+        if mode is None:
+            raise RuntimeError(f"{REPLICA_CONFIG['host']}:{REPLICA_CONFIG['port']} is neither a standby "
+                               f"nor subscribed as {REPLICA_NAME}.")
+        print(f"Replica mode: {mode}")
+        missing = missing_objects(cursor)
+        cursor.execute(SQL_STORED_FINGERPRINT)
+        row = cursor.fetchone()
+        if missing:
+            hint = " (a standby mirrors the primary: apply the schema there)" if mode == "streaming" else ""
+            failures.append(f"{len(missing)} declared objects missing, e.g. {missing[0][1]}{hint}")
+        elif not row or row[0] != schema_fingerprint():
+            failures.append("stored schema fingerprint differs from the declaration")
+        else:
+            print("Schema: matches the declaration")
+    finally:
+        replica.close()
+
+    print(f"Caught up with the primary in {catch_up(timeout):.1f}s")
+    primary_counts = table_counts(DB_CONFIG, PUBLISHED_TABLES)
+    replica_counts = table_counts(REPLICA_CONFIG, PUBLISHED_TABLES)
+    for table in PUBLISHED_TABLES:
+        same = primary_counts[table] == replica_counts[table]
+        print(f"  {table:<14} primary {primary_counts[table]:>10}  replica {replica_counts[table]:>10}"
+              f"{'' if same else '  DIFFERS'}")
+        if not same:
+            failures.append(f"{table} row counts differ")
+
+    ok, reason = healthy(lag_status())
+    if not ok:
+        failures.append(reason)
+    if failures:
+        raise RuntimeError("Replica verification failed: " + "; ".join(failures))
+    print("Replica verified.")
+
+def show_lag(check=False, max_lag_seconds=DEFAULT_MAX_LAG_SECONDS, max_lag_bytes=DEFAULT_MAX_LAG_BYTES):
+    """Prints the replica's lag; returns whether it is healthy."""
+    status = lag_status()
+    ok, reason = healthy(status, max_lag_seconds, max_lag_bytes)
+
+    def size(value):
+        return "n/a" if value is None else f"{value / 1024:.1f} kB"
+
+    print(f"replica {REPLICA_CONFIG['host']}:{REPLICA_CONFIG['port']} ({status['mode'] or 'unknown mode'}): "
+          f"{'reachable' if status['reachable'] else 'unreachable'}, "
+          f"{'connected (' + status['state'] + ')' if status['connected'] else 'not connected'} to the primary")
+    if status["connected"]:
+        print(f"  replay lag: {size(status['replay_bytes'])}, {status['replay_lag_s']:.3f}s")
+    if status["replica_delay_s"] is not None:
+        label = "replay delay" if status["mode"] == "streaming" else "since last message"
+        print(f"  {label} on the replica: {status['replica_delay_s']:.1f}s")
+    if status["slot_retained_bytes"] is not None:
+        print(f"  slot {REPLICA_NAME}: {'active' if status['slot_active'] else 'INACTIVE'}, "
+              f"retaining {size(status['slot_retained_bytes'])} of WAL")
+    print(f"  status: {reason}")
+    if check and not ok:
+        sys.exit(1)
+    return ok
+
+def teardown(data_dir=None, remove=False, bin_dir=None, run_as=None):
+    """Drops the subscription, publication and slot, and stops (and optionally deletes) the replica."""
+    try:
+        replica = connect(dict(REPLICA_CONFIG, connect_timeout=5))
+    except psycopg2.OperationalError:
+        replica = None
+    if replica:
+        try:
+            cursor = replica.cursor()
+            if replica_mode(cursor) == "logical":
+                # Also drops the subscription's slot on the primary.
+                cursor.execute(f"DROP SUBSCRIPTION {REPLICA_NAME};")
+                print(f"Dropped subscription {REPLICA_NAME}")
+        finally:
+            replica.close()
+
+    if data_dir and cluster_running(data_dir, bin_dir, run_as):
+        run([binary("pg_ctl", bin_dir), "-D", data_dir, "-m", "fast", "-w", "stop"], run_as)
+
+    primary = connect(DB_CONFIG)
+    try:
+        cursor = primary.cursor()
+        cursor.execute(f"DROP PUBLICATION IF EXISTS {PUBLICATION};")
+        cursor.execute(SQL_SLOT_EXISTS, (REPLICA_NAME,))
+        row = cursor.fetchone()
+        if row and row[0]:
+            print(f"Slot {REPLICA_NAME} is still in use; stop the replica and run teardown again.")
+        elif row:
+            cursor.execute("SELECT pg_drop_replication_slot(%s);", (REPLICA_NAME,))
+            print(f"Dropped replication slot {REPLICA_NAME}")
+    finally:
+        primary.close()
+
+    if data_dir and remove:
+        if not os.path.exists(os.path.join(data_dir, "PG_VERSION")):
+            raise RuntimeError(f"{data_dir} does not look like a PostgreSQL data directory; not removing it.")
+        shutil.rmtree(data_dir)
+        print(f"Removed {data_dir}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Provision, verify and route to a read replica.")
+    actions = parser.add_subparsers(dest="action", required=True)
+
+    def add_cluster_options(action_parser):
+        action_parser.add_argument("--data-dir", help="data directory of a local replica cluster")
+        action_parser.add_argument("--bin-dir", default=os.getenv("PG_BIN_DIR"),
+                                   help="directory with pg_ctl, initdb and pg_basebackup (default: PATH)")
+        action_parser.add_argument("--run-as", help="run the PostgreSQL programs as this OS user")
+
+    provision_parser = actions.add_parser("provision", help="set up the replica and wait for it to catch up")
+    provision_parser.add_argument("mode", choices=MODES)
+    add_cluster_options(provision_parser)
+    provision_parser.add_argument("--port", default=REPLICA_CONFIG["port"], help="port of a local replica cluster")
+    provision_parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="seconds to wait")
+
+    verify_parser = actions.add_parser("verify", help="check the replica's schema, position and rows")
+    verify_parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="seconds to wait")
+
+    lag_parser = actions.add_parser("lag", help="report replication lag")
+    lag_parser.add_argument("--check", action="store_true", help="exit 1 when the replica is unhealthy")
+    lag_parser.add_argument("--max-lag-seconds", type=float, default=DEFAULT_MAX_LAG_SECONDS)
+    lag_parser.add_argument("--max-lag-bytes", type=int, default=DEFAULT_MAX_LAG_BYTES)
+    lag_parser.add_argument("--watch", type=float, metavar="SECONDS", help="repeat every SECONDS")
+
+    actions.add_parser("dsn", help="print the connection string for replica reads")
+
+    teardown_parser = actions.add_parser("teardown", help="remove the replica")
+    add_cluster_options(teardown_parser)
+    teardown_parser.add_argument("--remove", action="store_true", help="also delete --data-dir")
+
+    args = parser.parse_args(argv)
+    if args.action == "provision":
+        provision(args.mode, data_dir=args.data_dir, port=args.port, bin_dir=args.bin_dir, run_as=args.run_as,
+                  timeout=args.timeout)
+    elif args.action == "verify":
+        verify(timeout=args.timeout)
+    elif args.action == "lag":
+        while True:
+            ok = show_lag(check=args.check and not args.watch, max_lag_seconds=args.max_lag_seconds,
+                          max_lag_bytes=args.max_lag_bytes)
+            if not args.watch:
+                break
+            time.sleep(args.watch)
+        if args.check and not ok:
+            sys.exit(1)
+    elif args.action == "dsn":
+        try:
+            replica = connect(dict(REPLICA_CONFIG, connect_timeout=5))
+            try:
+                mode = replica_mode(replica.cursor())
+            finally:
+                replica.close()
+        except psycopg2.OperationalError:
+            mode = None
+        print(routing_dsn(mode))
+    else:
+        teardown(data_dir=args.data_dir, remove=args.remove, bin_dir=args.bin_dir, run_as=args.run_as)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,316 @@
+
+import argparse
+import os
+import sys
+import time
+from datetime import date, timedelta
+import psycopg2
+
+from create_db_updated import DB_CONFIG
+
+# Sales reporting summaries.
+#
+# sales_daily, sales_daily_product, sales_daily_category and
+# sales_daily_status (declared in create_db_updated.py) hold one row per
+# reporting day, so dashboard queries read O(days) rows instead of scanning
+# orders and order_items. The refresh finds the days touched since the last
+# watermark (orders by created_at/updated_at, order items by created_at) and
+# recomputes just those days; backfill recomputes every day in batches.
+#
+# Order deletes and product category changes leave no watermark trail; run
+# backfill (optionally with --since) after either.
+
+WATERMARK = "sales"
+REPORT_TIMEZONE = os.getenv("REPORT_TIMEZONE", "UTC")
+
+# Rows committed shortly after a refresh started can carry timestamps older
+# than its watermark; each refresh rescans this much history to catch them.
+SAFETY_LAG = "5 minutes"
+
+DEFAULT_INTERVAL = 60.0
+DEFAULT_BACKFILL_DAYS = 31
+
+# One advisory lock serializes refreshes and backfills.
+SQL_TRY_LOCK = "SELECT pg_try_advisory_xact_lock(hashtext('plenaire_reporting'));"
+SQL_SESSION_LOCK = "SELECT pg_advisory_lock(hashtext('plenaire_reporting'));"
+SQL_SESSION_UNLOCK = "SELECT pg_advisory_unlock(hashtext('plenaire_reporting'));"
+
+SQL_WATERMARK = "SELECT watermark FROM reporting_watermarks WHERE name = %s;"
+SQL_STORE_WATERMARK = """
+    INSERT INTO reporting_watermarks (name, watermark, refreshed_at) VALUES (%s, %s, now())
+    ON CONFLICT (name) DO UPDATE SET watermark = EXCLUDED.watermark, refreshed_at = EXCLUDED.refreshed_at;
+"""
+
+# One branch per change signal, so each is an index scan (idx_orders_created_id,
+# idx_orders_updated_at, idx_order_items_created_at plus the orders key).
+SQL_DIRTY_DAYS = """
+    SELECT (created_at AT TIME ZONE %(tz)s)::date FROM orders WHERE created_at > %(since)s
+    UNION
+    SELECT (created_at AT TIME ZONE %(tz)s)::date FROM orders WHERE updated_at > %(since)s AND created_at IS NOT NULL
+    UNION
+    SELECT (o.created_at AT TIME ZONE %(tz)s)::date
+    FROM order_items i
+    JOIN orders o ON o.id = i.order_id
+    WHERE i.created_at > %(since)s AND o.created_at IS NOT NULL
+    ORDER BY 1;
+"""
+
+SQL_DAY_RANGE = "SELECT min((created_at AT TIME ZONE %(tz)s)::date), max((created_at AT TIME ZONE %(tz)s)::date) FROM orders;"
+
+# Recomputes every summary for the days first..last (inclusive). The scope
+# tables are built once from an index range scan on orders.created_at.
+SQL_RECOMPUTE = """
+    DROP TABLE IF EXISTS sales_scope_orders, sales_scope_items;
+
+    CREATE TEMP TABLE sales_scope_orders ON COMMIT DROP AS
+    SELECT o.id, o.user_id, o.total,
+           coalesce(o.status, 'pending') AS status,
+           coalesce(o.payment_status, 'pending') AS payment_status,
+           (o.created_at AT TIME ZONE %(tz)s)::date AS day
+    FROM orders o
+    WHERE o.created_at >= (%(first)s::date::timestamp AT TIME ZONE %(tz)s)
+      AND o.created_at < ((%(last)s::date + 1)::timestamp AT TIME ZONE %(tz)s);
+
+    CREATE TEMP TABLE sales_scope_items ON COMMIT DROP AS
+    SELECT s.day, i.order_id, i.product_id, coalesce(p.category_id, 0) AS category_id,
+           i.quantity, i.price * i.quantity AS revenue
+    FROM sales_scope_orders s
+    JOIN order_items i ON i.order_id = s.id
+    LEFT JOIN products p ON p.id = i.product_id;
+
+    DELETE FROM sales_daily WHERE day BETWEEN %(first)s AND %(last)s;
+    DELETE FROM sales_daily_product WHERE day BETWEEN %(first)s AND %(last)s;
+    DELETE FROM sales_daily_category WHERE day BETWEEN %(first)s AND %(last)s;
+    DELETE FROM sales_daily_status WHERE day BETWEEN %(first)s AND %(last)s;
+
+    INSERT INTO sales_daily (day, order_count, customer_count, revenue, units)
+    SELECT s.day, count(*), count(DISTINCT s.user_id), sum(s.total), coalesce(sum(u.units), 0)
+    FROM sales_scope_orders s
+    LEFT JOIN (SELECT order_id, sum(quantity) AS units FROM sales_scope_items GROUP BY order_id) u
+           ON u.order_id = s.id
+    GROUP BY s.day;
+
+    INSERT INTO sales_daily_product (day, product_id, units, revenue)
+    SELECT day, product_id, sum(quantity), sum(revenue) FROM sales_scope_items GROUP BY day, product_id;
+
+    INSERT INTO sales_daily_category (day, category_id, units, revenue)
+    SELECT day, category_id, sum(quantity), sum(revenue) FROM sales_scope_items GROUP BY day, category_id;
+
+    INSERT INTO sales_daily_status (day, status, payment_status, order_count, revenue)
+    SELECT day, status, payment_status, count(*), sum(total) FROM sales_scope_orders GROUP BY day, status, payment_status;
+"""
+
+# Dashboard queries: every one reads the summaries for the requested days only.
+SQL_REPORT_DAILY = """
+    SELECT d::date, coalesce(s.order_count, 0), coalesce(s.revenue, 0), coalesce(s.units, 0)
+    FROM generate_series(%(first)s::date, %(last)s::date, interval '1 day') d
+    LEFT JOIN sales_daily s ON s.day = d::date
+    ORDER BY 1;
+"""
+
+SQL_REPORT_TOP_PRODUCTS = """
+    SELECT s.product_id, coalesce(p.name, '(deleted)'), sum(s.units), sum(s.revenue) AS revenue
+    FROM sales_daily_product s
+    LEFT JOIN products p ON p.id = s.product_id
+    WHERE s.day BETWEEN %(first)s AND %(last)s
+    GROUP BY s.product_id, p.name
+    ORDER BY revenue DESC
+    LIMIT %(limit)s;
+"""
+
+SQL_REPORT_CATEGORIES = """
+    SELECT coalesce(c.name, 'Uncategorized'), sum(s.units), sum(s.revenue) AS revenue
+    FROM sales_daily_category s
+    LEFT JOIN categories c ON c.id = s.category_id
+    WHERE s.day BETWEEN %(first)s AND %(last)s
+    GROUP BY c.name
+    ORDER BY revenue DESC;
+"""
+
+SQL_REPORT_STATUSES = """
+    SELECT status, payment_status, sum(order_count), sum(revenue)
+    FROM sales_daily_status
+    WHERE day BETWEEN %(first)s AND %(last)s
+    GROUP BY status, payment_status
+    ORDER BY status, payment_status;
+"""
+
+def connect():
+    """Opens a connection using DB_CONFIG."""
+    return psycopg2.connect(**DB_CONFIG)
+
+def day_runs(days):
+    """Groups sorted dates into (first, last) runs of consecutive days."""
+    runs = []
+    for day in days:
+        if runs and day == runs[-1][1] + timedelta(days=1):
+            runs[-1][1] = day
+        else:
+            runs.append([day, day])
+    return [tuple(run) for run in runs]
+
+def recompute(cursor, first, last):
+    """Rebuilds the summaries for days first..last in the current transaction."""
+    cursor.execute(SQL_RECOMPUTE, {"tz": REPORT_TIMEZONE, "first": first, "last": last})
+
+def refresh():
+    """Recomputes the days changed since the stored watermark.
+
+    Returns the number of days refreshed, or None when another refresh or a
+    backfill holds the reporting lock.
+    """
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SQL_TRY_LOCK)
+        if not cursor.fetchone()[0]:
+            print("Another refresh is running, skipping.")
+            conn.rollback()
+            return None
+        cursor.execute(SQL_WATERMARK, (WATERMARK,))
+        row = cursor.fetchone()
+        if row is None:
+            conn.rollback()
+            print("No watermark yet; running a full backfill.")
+            return backfill()
+        # now() is the transaction start, so anything committed later is
+        # newer than the stored watermark.
+        cursor.execute("SELECT now(), %s::timestamptz - %s::interval;", (row[0], SAFETY_LAG))
+        started, since = cursor.fetchone()
+        cursor.execute(SQL_DIRTY_DAYS, {"tz": REPORT_TIMEZONE, "since": since})
+        days = [r[0] for r in cursor.fetchall()]
+        for first, last in day_runs(days):
+            recompute(cursor, first, last)
+        cursor.execute(SQL_STORE_WATERMARK, (WATERMARK, started))
+        conn.commit()
+        print(f"Refreshed {len(days)} day(s) changed since {since.isoformat()}.")
+        return len(days)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+def backfill(since=None, days_per_batch=DEFAULT_BACKFILL_DAYS):
+    """Recomputes every day with orders (or every day from since), one committed batch at a time."""
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SQL_SESSION_LOCK)
+        # Changes made while the backfill runs are picked up by the next refresh.
+        cursor.execute("SELECT now();")
+        started = cursor.fetchone()[0]
+        cursor.execute(SQL_DAY_RANGE, {"tz": REPORT_TIMEZONE})
+        first, last = cursor.fetchone()
+        conn.commit()
+        if last is None:
+            print("No orders to backfill.")
+            return 0
+        if since is not None and since > first:
+            first = since
+        day = first
+        batches = 0
+        while day <= last:
+            batch_last = min(day + timedelta(days=days_per_batch - 1), last)
+            recompute(cursor, day, batch_last)
+            conn.commit()
+            batches += 1
+            print(f"Backfilled {day.isoformat()} .. {batch_last.isoformat()}")
+            day = batch_last + timedelta(days=1)
+        if since is None:
+            # Drop summaries for days that no longer have any orders.
+            cursor.execute("DELETE FROM sales_daily WHERE day < %s OR day > %s;", (first, last))
+            cursor.execute("DELETE FROM sales_daily_product WHERE day < %s OR day > %s;", (first, last))
+            cursor.execute("DELETE FROM sales_daily_category WHERE day < %s OR day > %s;", (first, last))
+            cursor.execute("DELETE FROM sales_daily_status WHERE day < %s OR day > %s;", (first, last))
+        cursor.execute(SQL_STORE_WATERMARK, (WATERMARK, started))
+        conn.commit()
+        print(f"Backfill complete: {batches} batch(es); watermark set to {started.isoformat()}.")
+        return batches
+    finally:
+        conn.rollback()
+        cursor.execute(SQL_SESSION_UNLOCK)
+        cursor.close()
+        conn.close()
+
+def run_worker(interval=DEFAULT_INTERVAL):
+    """Refreshes the summaries every interval seconds until interrupted."""
+    print(f"Refreshing sales summaries every {interval:.0f}s (Ctrl+C to stop)...")
+    try:
+        while True:
+            started = time.monotonic()
+            try:
+                refresh()
+            except psycopg2.OperationalError as e:
+                print(f"Refresh failed, will retry: {str(e).strip().splitlines()[0]}")
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        print("Stopped.")
+
+def report(days=30, limit=5):
+    """Prints the dashboard figures for the last days days from the summaries."""
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT (now() AT TIME ZONE %s)::date;", (REPORT_TIMEZONE,))
+        last = cursor.fetchone()[0]
+        params = {"first": last - timedelta(days=days - 1), "last": last, "limit": limit}
+
+        cursor.execute(SQL_REPORT_DAILY, params)
+        rows = cursor.fetchall()
+        revenue = sum(r[2] for r in rows)
+        orders = sum(r[1] for r in rows)
+        print(f"Last {days} days: {orders} orders, revenue {revenue:.2f}, "
+              f"average order {revenue / orders if orders else 0:.2f}")
+        for day, count, day_revenue, units in rows:
+            print(f"  {day.isoformat()}  {count:>6} orders  {units:>7} units  {day_revenue:>12.2f}")
+
+        cursor.execute(SQL_REPORT_TOP_PRODUCTS, params)
+        print("\nTop products:")
+        for product_id, name, units, product_revenue in cursor.fetchall():
+            print(f"  {product_id:>8}  {name[:40]:<40} {units:>7} units  {product_revenue:>12.2f}")
+
+        cursor.execute(SQL_REPORT_CATEGORIES, params)
+        print("\nBy category:")
+        for name, units, category_revenue in cursor.fetchall():
+            print(f"  {name[:40]:<40} {units:>7} units  {category_revenue:>12.2f}")
+
+        cursor.execute(SQL_REPORT_STATUSES, params)
+        print("\nBy status:")
+        for status, payment_status, count, status_revenue in cursor.fetchall():
+            print(f"  {status:<12} {payment_status:<10} {count:>6} orders  {status_revenue:>12.2f}")
+    finally:
+        cursor.close()
+        conn.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain and query the sales reporting summaries.")
+    actions = parser.add_subparsers(dest="action", required=True)
+
+    actions.add_parser("refresh", help="recompute the days changed since the last refresh")
+
+    worker_parser = actions.add_parser("worker", help="refresh continuously")
+    worker_parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL, help="seconds between refreshes")
+
+    backfill_parser = actions.add_parser("backfill", help="recompute every day from raw orders")
+    backfill_parser.add_argument("--since", type=date.fromisoformat,
+                                 help="only recompute days from this date (YYYY-MM-DD)")
+    backfill_parser.add_argument("--days-per-batch", type=int, default=DEFAULT_BACKFILL_DAYS)
+
+    report_parser = actions.add_parser("report", help="print the dashboard figures from the summaries")
+    report_parser.add_argument("--days", type=int, default=30)
+    report_parser.add_argument("--limit", type=int, default=5, help="number of top products")
+
+    args = parser.parse_args(argv)
+    if args.action == "refresh":
+        refresh()
+    elif args.action == "worker":
+        run_worker(args.interval)
+    elif args.action == "backfill":
+        backfill(since=args.since, days_per_batch=args.days_per_batch)
+    elif args.action == "report":
+        report(days=args.days, limit=args.limit)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,126 @@
+
+import argparse
+import sys
+import time
+import psycopg2
+
+from create_db_updated import DB_CONFIG
+
+# Product review aggregates.
+#
+# products.review_count, rating_sum and rating_avg are kept current by
+# trg_reviews_aggregate (declared in create_db_updated.py), which applies the
+# delta of every review insert, update and delete. This module recomputes the
+# aggregates from reviews for rows that predate the trigger or have drifted,
+# and reports products whose stored aggregates disagree with reviews.
+
+# Locks the batch's products rows before aggregating. A review committed
+# earlier is then visible to the aggregate, and one still in flight has its
+# trigger wait for the lock and apply its delta on top of the recomputed
+# value, so no review is counted twice or lost.
+SQL_LOCK_BATCH = """
+    SELECT max(id) FROM (
+        SELECT id FROM products WHERE id > %s ORDER BY id LIMIT %s FOR NO KEY UPDATE
+    ) batch;
+"""
+
+SQL_BACKFILL_BATCH = """
+    WITH totals AS (
+        SELECT p.id, count(r.id)::integer AS review_count, coalesce(sum(r.rating), 0)::integer AS rating_sum
+        FROM products p
+        LEFT JOIN reviews r ON r.product_id = p.id
+        WHERE p.id > %s AND p.id <= %s
+        GROUP BY p.id
+    )
+    UPDATE products p
+    SET review_count = t.review_count,
+        rating_sum = t.rating_sum,
+        rating_avg = t.rating_sum::double precision / nullif(t.review_count, 0)
+    FROM totals t
+    WHERE p.id = t.id
+      AND (p.review_count, p.rating_sum, p.rating_avg)
+          IS DISTINCT FROM (t.review_count, t.rating_sum, t.rating_sum::double precision / nullif(t.review_count, 0))
+    RETURNING p.id;
+"""
+
+SQL_DRIFT = """
+    SELECT p.id, p.review_count, p.rating_sum, count(r.id), coalesce(sum(r.rating), 0)
+    FROM products p
+    LEFT JOIN reviews r ON r.product_id = p.id
+    GROUP BY p.id
+    HAVING coalesce(p.review_count, 0) <> count(r.id) OR coalesce(p.rating_sum, 0) <> coalesce(sum(r.rating), 0)
+    ORDER BY p.id
+    LIMIT %s;
+"""
+
+DEFAULT_BATCH_SIZE = 1000
+
+def connect():
+    """Opens a connection using DB_CONFIG."""
+    return psycopg2.connect(**DB_CONFIG)
+
+def backfill(batch_size=DEFAULT_BATCH_SIZE, pause=0.0, start_after=0):
+    """Recomputes review aggregates for every product, one committed batch at a time.
+
+    Safe to interrupt: rerun with start_after set to the last reported id, or
+    from 0, since rows that are already correct are not rewritten.
+    """
+    conn = connect()
+    cursor = conn.cursor()
+    last_id = start_after
+    updated = 0
+    started = time.monotonic()
+    try:
+        while True:
+            cursor.execute(SQL_LOCK_BATCH, (last_id, batch_size))
+            batch_end = cursor.fetchone()[0]
+            if batch_end is None:
+                conn.rollback()
+                break
+            cursor.execute(SQL_BACKFILL_BATCH, (last_id, batch_end))
+            updated += cursor.rowcount
+            conn.commit()
+            last_id = batch_end
+            print(f"Backfilled through id {last_id} ({updated} rows updated)")
+            if pause:
+                time.sleep(pause)
+    finally:
+        cursor.close()
+        conn.close()
+    print(f"Backfill complete: {updated} rows updated in {time.monotonic() - started:.1f}s.")
+    return updated
+
+def check(limit=20):
+    """Returns (id, stored count, stored sum, actual count, actual sum) for drifted products."""
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SQL_DRIFT, (limit,))
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+        conn.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain product review aggregates.")
+    actions = parser.add_subparsers(dest="action", required=True)
+
+    backfill_parser = actions.add_parser("backfill", help="recompute review aggregates in batches")
+    backfill_parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    backfill_parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    backfill_parser.add_argument("--start-after", type=int, default=0, help="resume after this product id")
+
+    check_parser = actions.add_parser("check", help="list products whose aggregates disagree with reviews")
+    check_parser.add_argument("--limit", type=int, default=20)
+
+    args = parser.parse_args(argv)
+    if args.action == "backfill":
+        backfill(batch_size=args.batch_size, pause=args.pause, start_after=args.start_after)
+    elif args.action == "check":
+        rows = check(args.limit)
+        for product_id, stored_count, stored_sum, actual_count, actual_sum in rows:
+            print(f"{product_id:>8}  stored {stored_count}/{stored_sum}  actual {actual_count}/{actual_sum}")
+        print(f"{len(rows)} product(s) drifted{' (limit reached)' if len(rows) == args.limit else ''}.")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
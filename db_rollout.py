@@ -0,0 +1,181 @@
+
+import argparse
+import io
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import psycopg2
+from psycopg2.extensions import parse_dsn
+
+from create_db_updated import APPLY_MODES, create_schema, missing_objects, schema_fingerprint
+
+# Schema rollout across many databases.
+#
+# create_schema() applies the declared schema to the one database in
+# DB_CONFIG. rollout runs it against every database in a list of DSNs, a
+# bounded number at a time, and prints one summary line per database with
+# its outcome, duration and drift: the declared objects that were missing
+# before the run and any still missing after it. Each database's own log is
+# captured and shown for failures (or for all with --verbose).
+#
+# DSNs are libpq connection strings or postgresql:// URIs, read from
+# --dsn-file (one per line, # comments allowed), from DATABASE_DSNS
+# (separated by newlines or semicolons), and from any DATABASE_DSN_<NAME>
+# variables.
+
+DSNS_ENV = "DATABASE_DSNS"
+DSN_ENV_PREFIX = "DATABASE_DSN_"
+DEFAULT_CONCURRENCY = 8
+
+SQL_STORED_FINGERPRINT = "SELECT value FROM schema_metadata WHERE key = 'schema_fingerprint';"
+
+class ThreadOutput(io.TextIOBase):
+    """sys.stdout replacement that sends each registered thread's output to its own buffer."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffers = {}
+
+    def capture(self):
+        """Starts capturing the calling thread's output; returns its buffer."""
+        buffer = io.StringIO()
+        self.buffers[threading.get_ident()] = buffer
+        return buffer
+
+    def write(self, text):
+        return self.buffers.get(threading.get_ident(), self.stream).write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+def dsn_config(dsn):
+    """Returns create_schema() connection parameters for a DSN."""
+    config = parse_dsn(dsn)
+    if "dbname" in config:
+        config["database"] = config.pop("dbname")
+    return config
+
+def dsn_label(dsn):
+    """Returns host/database for a DSN, without its credentials."""
+    config = dsn_config(dsn)
+    return f"{config.get('host', 'localhost')}:{config.get('port', '5432')}/{config.get('database', '?')}"
+
+def load_dsns(path=None):
+    """Returns the target DSNs from the file and environment, in order and without duplicates."""
+    dsns = []
+    if path:
+        with open(path) as f:
+            dsns += [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+    dsns += [dsn.strip() for dsn in re.split(r"[;\n]", os.getenv(DSNS_ENV, "")) if dsn.strip()]
+    dsns += [os.environ[key].strip() for key in sorted(os.environ) if key.startswith(DSN_ENV_PREFIX)]
+    return list(dict.fromkeys(dsns))
+
+def inspect(config, fingerprint):
+    """Returns (missing declared objects, whether the stored fingerprint is current)."""
+    conn = psycopg2.connect(**config)
+    cursor = conn.cursor()
+    try:
+        missing = missing_objects(cursor)
+        cursor.execute("SELECT to_regclass('schema_metadata') IS NOT NULL;")
+        if not cursor.fetchone()[0]:
+            return missing, False
+        cursor.execute(SQL_STORED_FINGERPRINT)
+        row = cursor.fetchone()
+        return missing, row is not None and row[0] == fingerprint
+    finally:
+        cursor.close()
+        conn.close()
+
+def summarize_missing(missing):
+    """Returns e.g. "2 index, 1 trigger" for a list of missing objects."""
+    counts = {}
+    for kind, _name, _sql in missing:
+        counts[kind] = counts.get(kind, 0) + 1
+    return ", ".join(f"{count} {kind}" for kind, count in counts.items()) or "none"
+
+def roll_out_one(output, dsn, mode, fingerprint, check_only):
+    """Applies the schema to one database; returns its summary dict."""
+    log = output.capture()
+    result = {"dsn": dsn_label(dsn), "outcome": "failed", "before": [], "after": [], "error": None}
+    started = time.monotonic()
+    try:
+        config = dsn_config(dsn)
+        result["before"], current = inspect(config, fingerprint)
+        if check_only:
+            result["outcome"] = "in sync" if current and not result["before"] else "drifted"
+        elif current and not result["before"]:
+            result["outcome"] = "up to date"
+        else:
+            # The catalogs were just read, so a stale-but-matching fingerprint
+            # must not hide the drift found there.
+            create_schema(mode="diff" if mode == "fingerprint" and result["before"] else mode, config=config)
+            result["after"], current = inspect(config, fingerprint)
+            result["outcome"] = "applied" if current and not result["after"] else "incomplete"
+    except Exception as e:
+        result["error"] = str(e).strip().splitlines()[0] if str(e).strip() else type(e).__name__
+    finally:
+        result["duration"] = time.monotonic() - started
+        result["log"] = log.getvalue()
+        output.buffers.pop(threading.get_ident(), None)
+    return result
+
+def rollout(dsns, mode="fingerprint", concurrency=DEFAULT_CONCURRENCY, check_only=False, verbose=False):
+    """Applies the schema to every database in dsns, concurrency at a time; returns the summaries."""
+    if not dsns:
+        raise RuntimeError(f"No databases given; pass --dsn-file or set {DSNS_ENV} or {DSN_ENV_PREFIX}<NAME>.")
+    fingerprint = schema_fingerprint()
+    print(f"{'Checking' if check_only else 'Rolling out'} schema {fingerprint[:12]} on {len(dsns)} databases, "
+          f"{concurrency} at a time...")
+    output = ThreadOutput(sys.stdout)
+    sys.stdout = output
+    results = []
+    started = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = [pool.submit(roll_out_one, output, dsn, mode, fingerprint, check_only) for dsn in dsns]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                output.stream.write(f"  [{len(results)}/{len(dsns)}] {result['dsn']}: {result['outcome']}\n")
+    finally:
+        sys.stdout = output.stream
+    elapsed = time.monotonic() - started
+
+    results.sort(key=lambda r: r["dsn"])
+    width = max(len(r["dsn"]) for r in results)
+    print(f"\n{'database':<{width}}  {'outcome':<11} {'seconds':>8}  drift before -> after")
+    for r in results:
+        print(f"{r['dsn']:<{width}}  {r['outcome']:<11} {r['duration']:>8.2f}  "
+              f"{summarize_missing(r['before'])} -> {summarize_missing(r['after'])}")
+    for r in results:
+        if r["outcome"] in ("failed", "incomplete") or verbose:
+            print(f"\n--- {r['dsn']}")
+            if r["error"]:
+                print(f"error: {r['error']}")
+            if r["log"].strip():
+                print(r["log"].rstrip())
+
+    failed = [r for r in results if r["outcome"] in ("failed", "incomplete")]
+    serial = sum(r["duration"] for r in results)
+    print(f"\n{len(results) - len(failed)} of {len(results)} databases succeeded in {elapsed:.1f}s "
+          f"({serial:.1f}s of work).")
+    if failed:
+        raise RuntimeError(f"Rollout failed on {len(failed)} database(s): {', '.join(r['dsn'] for r in failed)}")
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply the schema to many databases concurrently.")
+    parser.add_argument("--dsn-file", help="file with one DSN per line")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="databases applied at once")
+    parser.add_argument("--mode", choices=sorted(APPLY_MODES), default="fingerprint")
+    parser.add_argument("--check", action="store_true", help="only report drift, change nothing")
+    parser.add_argument("--verbose", action="store_true", help="print every database's log")
+    args = parser.parse_args(argv)
+    rollout(load_dsns(args.dsn_file), mode=args.mode, concurrency=args.concurrency,
+            check_only=args.check, verbose=args.verbose)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
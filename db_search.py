@@ -0,0 +1,172 @@
+
+import argparse
+import sys
+import time
+import psycopg2
+
+from create_db_updated import DB_CONFIG
+
+# Product search support.
+#
+# products.search_vector is a weighted document over name, description and
+# ingredients, kept current by trg_products_search_vector and served by the
+# GIN index idx_products_search_vector (both declared in
+# create_db_updated.py). This module backfills rows that predate the trigger,
+# installs the optional pg_trgm index used for typo-tolerant suggestions, and
+# runs the storefront queries from the command line.
+
+# Keyset-paginated so each batch is an index range scan on the primary key and
+# holds row locks on at most batch_size products.
+SQL_BACKFILL_BATCH = """
+    WITH batch AS (
+        SELECT id FROM products
+        WHERE id > %s
+        ORDER BY id
+        LIMIT %s
+    )
+    UPDATE products p
+    SET search_vector = products_search_document(p.name, p.description, p.ingredients)
+    FROM batch
+    WHERE p.id = batch.id
+      AND p.search_vector IS DISTINCT FROM products_search_document(p.name, p.description, p.ingredients)
+    RETURNING p.id;
+"""
+
+SQL_BATCH_END = "SELECT max(id) FROM (SELECT id FROM products WHERE id > %s ORDER BY id LIMIT %s) batch;"
+
+# pg_trgm ships with the contrib package, which not every host installs, so it
+# is not part of the declared schema.
+SQL_CREATE_TRIGRAM_EXTENSION = "CREATE EXTENSION IF NOT EXISTS pg_trgm;"
+SQL_CREATE_TRIGRAM_INDEX = (
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_products_name_trgm "
+    "ON products USING gin (lower(name) gin_trgm_ops);"
+)
+
+SQL_SEARCH = """
+    SELECT p.id, p.name, ts_rank(p.search_vector, q) AS rank
+    FROM products p, websearch_to_tsquery('english', %s) q
+    WHERE p.search_vector @@ q
+    ORDER BY rank DESC, p.id
+    LIMIT %s;
+"""
+
+# Prefix matches first, then close misspellings; both predicates are served
+# by idx_products_name_trgm.
+SQL_SUGGEST = """
+    SELECT name, similarity(lower(name), lower(%(term)s)) AS score
+    FROM products
+    WHERE lower(name) LIKE lower(%(prefix)s) OR lower(name) %% lower(%(term)s)
+    ORDER BY lower(name) LIKE lower(%(prefix)s) DESC, score DESC, name
+    LIMIT %(limit)s;
+"""
+
+DEFAULT_BATCH_SIZE = 1000
+
+def connect():
+    """Opens a connection using DB_CONFIG."""
+    return psycopg2.connect(**DB_CONFIG)
+
+def escape_like(term):
+    """Escapes LIKE wildcards so a search term only matches literally."""
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def backfill(batch_size=DEFAULT_BATCH_SIZE, pause=0.0, start_after=0):
+    """Recomputes search_vector for existing products, one committed batch at a time.
+
+    Safe to interrupt: rerun with start_after set to the last reported id, or
+    from 0, since rows that are already current are not rewritten.
+    """
+    conn = connect()
+    cursor = conn.cursor()
+    last_id = start_after
+    updated = 0
+    started = time.monotonic()
+    try:
+        while True:
+            cursor.execute(SQL_BATCH_END, (last_id, batch_size))
+            batch_end = cursor.fetchone()[0]
+            if batch_end is None:
+                break
+            cursor.execute(SQL_BACKFILL_BATCH, (last_id, batch_size))
+            updated += cursor.rowcount
+            conn.commit()
+            last_id = batch_end
+            print(f"Backfilled through id {last_id} ({updated} rows updated)")
+            if pause:
+                time.sleep(pause)
+    finally:
+        cursor.close()
+        conn.close()
+    print(f"Backfill complete: {updated} rows updated in {time.monotonic() - started:.1f}s.")
+    return updated
+
+def install_trigram():
+    """Installs pg_trgm and builds the trigram name index concurrently."""
+    conn = connect()
+    conn.autocommit = True
+    cursor = conn.cursor()
+    try:
+        print("Installing pg_trgm...")
+        cursor.execute(SQL_CREATE_TRIGRAM_EXTENSION)
+        print("Building idx_products_name_trgm concurrently...")
+        cursor.execute(SQL_CREATE_TRIGRAM_INDEX)
+        print("Trigram index ready.")
+    finally:
+        cursor.close()
+        conn.close()
+
+def search(term, limit=20):
+    """Returns (id, name, rank) for the best full-text matches."""
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SQL_SEARCH, (term, limit))
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+        conn.close()
+
+def suggest(term, limit=10):
+    """Returns (name, score) suggestions for a partial or misspelled term."""
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SQL_SUGGEST, {"term": term, "prefix": escape_like(term) + "%", "limit": limit})
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+        conn.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Product search maintenance and queries.")
+    actions = parser.add_subparsers(dest="action", required=True)
+
+    backfill_parser = actions.add_parser("backfill", help="recompute search_vector in batches")
+    backfill_parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    backfill_parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    backfill_parser.add_argument("--start-after", type=int, default=0, help="resume after this product id")
+
+    actions.add_parser("trigram", help="install pg_trgm and the trigram suggestion index")
+
+    query_parser = actions.add_parser("query", help="run a full-text product search")
+    query_parser.add_argument("term")
+    query_parser.add_argument("--limit", type=int, default=20)
+
+    suggest_parser = actions.add_parser("suggest", help="typo-tolerant name suggestions (needs the trigram index)")
+    suggest_parser.add_argument("term")
+    suggest_parser.add_argument("--limit", type=int, default=10)
+
+    args = parser.parse_args(argv)
+    if args.action == "backfill":
+        backfill(batch_size=args.batch_size, pause=args.pause, start_after=args.start_after)
+    elif args.action == "trigram":
+        install_trigram()
+    elif args.action == "query":
+        for product_id, name, rank in search(args.term, args.limit):
+            print(f"{rank:8.4f}  {product_id:>8}  {name}")
+    elif args.action == "suggest":
+        for name, score in suggest(args.term, args.limit):
+            print(f"{score:6.3f}  {name}")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,379 @@
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+import psycopg2
+
+from create_db_updated import (
+    DB_CONFIG,
+    SQL_CREATE_ENUMS,
+    constraint_name,
+    declared_objects,
+    enum_name,
+    index_name,
+)
+from db_indexes import index_table
+
+# Bulk seeder for load-test datasets.
+#
+# Rows are produced by generators and streamed through COPY FROM STDIN, so
+# memory stays constant however many rows are requested. Every value that
+# one table needs from another (a user's address ids, a product's price, an
+# order's items) is derived from ids and a per-row random seed instead of
+# being remembered, which is what keeps the streams independent.
+#
+# Foreign keys and secondary indexes on the seeded tables are dropped before
+# the load and recreated from their declared statements afterwards, which
+# also lets chunks of every table load in parallel worker processes. If a run
+# is interrupted, 'create_db_updated.py --mode diff' restores them.
+
+SEEDED_TABLES = ("categories", "products", "users", "addresses", "carts", "cart_items", "orders", "order_items")
+
+ADDRESSES_PER_USER = 2
+ITEMS_PER_CART = 3
+MAX_ITEMS_PER_ORDER = 5
+HISTORY_DAYS = 730
+COPY_CHUNK_BYTES = 1 << 20
+DEFAULT_JOBS = os.cpu_count() or 1
+DEFAULT_CHUNK_ROWS = 100000
+
+# Never matches a bcrypt comparison, so seeded accounts cannot log in unless
+# a real hash is supplied.
+SEED_PASSWORD_HASH = os.getenv("SEED_PASSWORD_HASH", "!")
+
+FIRST_NAMES = ("Ava", "Noah", "Mia", "Liam", "Zoe", "Ethan", "Isla", "Leo", "Chloe", "Kai")
+LAST_NAMES = ("Tan", "Lim", "Wong", "Smith", "Garcia", "Nguyen", "Patel", "Kim", "Brown", "Lee")
+CITIES = (("Singapore", "SG", "Singapore"), ("Sydney", "NSW", "Australia"), ("London", "LDN", "United Kingdom"),
+          ("New York", "NY", "United States"), ("Tokyo", "TYO", "Japan"))
+PRODUCT_WORDS = ("Lavender", "Rose", "Hydrating", "Renewal", "Calming", "Vitamin C", "Night", "Daily", "Gentle", "Radiance")
+PRODUCT_KINDS = ("Serum", "Cleanser", "Toner", "Moisturizer", "Mask", "Oil", "Balm", "Mist")
+INGREDIENTS = ("niacinamide", "hyaluronic acid", "squalane", "rosehip", "ceramides", "retinol", "aloe", "green tea")
+
+def enum_values(name):
+    """Returns the labels of a declared enum, read from SQL_CREATE_ENUMS."""
+    for sql in SQL_CREATE_ENUMS:
+        if enum_name(sql) == name:
+            return re.findall(r"'([^']*)'", sql.split("AS ENUM")[1])
+    raise KeyError(name)
+
+def copy_value(value):
+    """Formats one value for COPY text format."""
+    kind = type(value)
+    if kind is int or kind is float:
+        return str(value)
+    if kind is str:
+        if "\\" in value or "\t" in value or "\n" in value or "\r" in value:
+            return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+        return value
+    if value is None:
+        return "\\N"
+    if kind is bool:
+        return "t" if value else "f"
+    if kind is datetime:
+        return value.isoformat()
+    if kind is list or kind is tuple:
+        elements = (str(v).replace("\\", "\\\\").replace('"', '\\"') for v in value)
+        return copy_value("{" + ",".join('"' + v + '"' for v in elements) + "}")
+    return copy_value(str(value))
+
+class CopyStream:
+    """File-like object feeding generated rows to copy_expert in bounded chunks."""
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = b""
+        self.count = 0
+
+    def read(self, size=COPY_CHUNK_BYTES):
+        size = size if size and size > 0 else COPY_CHUNK_BYTES
+        lines = [self.buffer]
+        length = len(self.buffer)
+        for row in self.rows:
+            line = ("\t".join(copy_value(v) for v in row) + "\n").encode("utf-8")
+            lines.append(line)
+            length += len(line)
+            self.count += 1
+            if length >= size:
+                break
+        data = b"".join(lines)
+        self.buffer = data[size:]
+        return data[:size]
+
+
+class Seeder:
+    """Generates a dataset of a given size on top of whatever rows already exist.
+
+    Rows are produced per chunk of a driving id range, so chunks of the same
+    table can be generated and loaded by different processes.
+    """
+
+    def __init__(self, counts, offsets, seed, now):
+        self.counts = counts
+        self.offsets = offsets
+        self.seed = seed
+        self.now = now
+        self.order_statuses = enum_values("order_status")
+        self.payment_statuses = enum_values("payment_status")
+
+    def rng(self, table, row_id):
+        """Returns a Random seeded per row, so any stream can regenerate the same row."""
+        # Integer seeds are much cheaper than hashing a string seed per row.
+        return random.Random((self.seed << 48) + (zlib.crc32(table.encode()) << 16) + row_id)
+
+    def timestamp(self, rng):
+        return self.now - timedelta(seconds=rng.randrange(HISTORY_DAYS * 86400))
+
+    def product_price(self, product_id):
+        return round(5 + (product_id * 7919 % 9500) / 100, 2)
+
+    def user_addresses(self, user_id):
+        first = self.offsets["addresses"] + (user_id - self.offsets["users"] - 1) * ADDRESSES_PER_USER + 1
+        return first, first + ADDRESSES_PER_USER - 1
+
+    def order_items(self, order_id):
+        rng = self.rng("order_items", order_id)
+        products = rng.sample(range(self.counts["products"]), min(rng.randint(1, MAX_ITEMS_PER_ORDER), self.counts["products"]))
+        return [(self.offsets["products"] + p + 1, rng.randint(1, 3)) for p in products]
+
+    def category_rows(self, lo, hi):
+        for i in range(lo, hi):
+            cid = self.offsets["categories"] + i
+            yield cid, f"Category {cid}", f"Seeded category {cid}", None
+
+    def product_rows(self, lo, hi):
+        for i in range(lo, hi):
+            pid = self.offsets["products"] + i
+            rng = self.rng("products", pid)
+            name = f"{rng.choice(PRODUCT_WORDS)} {rng.choice(PRODUCT_KINDS)} {pid}"
+            category = self.offsets["categories"] + rng.randrange(self.counts["categories"]) + 1 if self.counts["categories"] else None
+            yield (pid, name, self.product_price(pid), f"{name}, seeded for load testing.", f"/images/products/{pid}.jpg",
+                   rng.random() < 0.02, rng.sample(INGREDIENTS, 3), category, rng.randint(0, 500),
+                   f"SKU-{pid:08d}", self.timestamp(rng))
+
+    def user_rows(self, lo, hi):
+        role_user, role_admin = enum_values("user_role")
+        for i in range(lo, hi):
+            uid = self.offsets["users"] + i
+            rng = self.rng("users", uid)
+            yield (uid, f"user{uid}@example.com", SEED_PASSWORD_HASH, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES),
+                   f"+65{rng.randrange(10**7, 10**8)}", role_admin if i == 1 and not self.offsets["users"] else role_user,
+                   self.timestamp(rng))
+
+    def address_rows(self, lo, hi):
+        for i in range(lo, hi):
+            uid = self.offsets["users"] + i
+            first, last = self.user_addresses(uid)
+            for aid in range(first, last + 1):
+                rng = self.rng("addresses", aid)
+                city, state, country = rng.choice(CITIES)
+                yield (aid, uid, f"{rng.randint(1, 999)} Seed Street", None, city, state,
+                       f"{rng.randrange(10**5, 10**6)}", country, aid == first, self.timestamp(rng))
+
+    def cart_user(self, cart_id):
+        step = max(1, self.counts["users"] // max(1, self.counts["carts"]))
+        return self.offsets["users"] + ((cart_id - self.offsets["carts"] - 1) * step) % self.counts["users"] + 1
+
+    def cart_rows(self, lo, hi):
+        for i in range(lo, hi):
+            cid = self.offsets["carts"] + i
+            yield cid, self.cart_user(cid), self.timestamp(self.rng("carts", cid))
+
+    def cart_item_rows(self, lo, hi):
+        for i in range(lo, hi):
+            cid = self.offsets["carts"] + i
+            rng = self.rng("cart_items", cid)
+            for p in rng.sample(range(self.counts["products"]), min(ITEMS_PER_CART, self.counts["products"])):
+                yield cid, self.offsets["products"] + p + 1, rng.randint(1, 3)
+
+    def order_rows(self, lo, hi):
+        for i in range(lo, hi):
+            oid = self.offsets["orders"] + i
+            rng = self.rng("orders", oid)
+            uid = self.offsets["users"] + rng.randrange(self.counts["users"]) + 1
+            shipping, billing = self.user_addresses(uid)
+            created = self.timestamp(rng)
+            total = round(sum(self.product_price(p) * q for p, q in self.order_items(oid)), 2)
+            yield (oid, uid, f"PL-{created:%Y%m%d}-{oid:08d}", rng.choice(self.order_statuses), total, shipping,
+                   billing if rng.random() < 0.3 else shipping, rng.choice(self.payment_statuses), created, created)
+
+    def order_item_rows(self, lo, hi):
+        for i in range(lo, hi):
+            oid = self.offsets["orders"] + i
+            created = self.timestamp(self.rng("orders", oid))
+            for product_id, quantity in self.order_items(oid):
+                yield oid, product_id, quantity, self.product_price(product_id), created
+
+    def streams(self):
+        """Returns (table, columns, generator, driving row count) in foreign key order.
+
+        cart_items and order_items take their ids from their sequences, since
+        nothing references them and it keeps their chunks independent.
+        """
+        return [
+            ("categories", "id, name, description, image_url", self.category_rows, self.counts["categories"]),
+            ("products", "id, name, price, description, image_url, featured, ingredients, category_id, stock, sku, created_at",
+             self.product_rows, self.counts["products"]),
+            ("users", "id, email, password, first_name, last_name, phone, role, created_at", self.user_rows, self.counts["users"]),
+            ("addresses", "id, user_id, address_line1, address_line2, city, state, postal_code, country, is_default, created_at",
+             self.address_rows, self.counts["users"]),
+            ("carts", "id, user_id, created_at", self.cart_rows, self.counts["carts"]),
+            ("cart_items", "cart_id, product_id, quantity", self.cart_item_rows, self.counts["carts"]),
+            ("orders", "id, user_id, order_number, status, total, shipping_address_id, billing_address_id, payment_status, "
+                       "created_at, updated_at", self.order_rows, self.counts["orders"]),
+            ("order_items", "order_id, product_id, quantity, price, created_at", self.order_item_rows, self.counts["orders"]),
+        ]
+
+    def chunks(self, chunk_rows):
+        """Yields (table, lo, hi) work units covering every stream."""
+        for table, _columns, _rows, count in self.streams():
+            for lo in range(1, count + 1, chunk_rows):
+                yield table, lo, min(lo + chunk_rows, count + 1)
+
+# One connection per worker process, opened on first use.
+_worker_conn = None
+
+def load_chunk(seeder, table, lo, hi, config=None):
+    """Streams one chunk of a table through COPY and returns (table, rows, started, finished)."""
+    global _worker_conn
+    if _worker_conn is None:
+        _worker_conn = psycopg2.connect(**(config or DB_CONFIG))
+    started = time.time()
+    columns, rows = next((c, r) for t, c, r, _n in seeder.streams() if t == table)
+    stream = CopyStream(rows(lo, hi))
+    with _worker_conn.cursor() as cursor:
+        cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN", stream, size=COPY_CHUNK_BYTES)
+    _worker_conn.commit()
+    return table, stream.count, started, time.time()
+
+def deferred_objects():
+    """Returns the declared FK and secondary index statements on the seeded tables."""
+    objects = declared_objects()
+    foreign_keys = [sql for kind, _name, sql in objects
+                    if kind == 'foreign_key' and sql.split("ALTER TABLE ")[1].split()[0] in SEEDED_TABLES]
+    indexes = [sql for kind, _name, sql in objects if kind == 'index' and index_table(sql) in SEEDED_TABLES]
+    return foreign_keys, indexes
+
+def drop_deferred(cursor, foreign_keys, indexes):
+    """Drops deferred FKs and indexes ahead of the load."""
+    for sql in foreign_keys:
+        cursor.execute(f"ALTER TABLE {sql.split('ALTER TABLE ')[1].split()[0]} DROP CONSTRAINT IF EXISTS {constraint_name(sql)};")
+    for sql in indexes:
+        cursor.execute(f"DROP INDEX IF EXISTS {index_name(sql)};")
+
+def restore_deferred(cursor, foreign_keys, indexes):
+    """Rebuilds deferred indexes, then re-adds and validates the FKs."""
+    for sql in indexes:
+        started = time.monotonic()
+        cursor.execute(sql)
+        print(f"  index {index_name(sql)} rebuilt in {time.monotonic() - started:.1f}s")
+    for sql in foreign_keys:
+        started = time.monotonic()
+        cursor.execute(sql)
+        print(f"  constraint {constraint_name(sql)} validated in {time.monotonic() - started:.1f}s")
+
+def finish(conn, cursor, foreign_keys, indexes):
+    """Restores the deferred objects and analyzes the loaded tables."""
+    print("Restoring foreign keys and indexes...")
+    restore_deferred(cursor, foreign_keys, indexes)
+    conn.commit()
+    cursor.execute("ANALYZE;")
+    conn.commit()
+
+def max_ids(cursor):
+    """Returns the current max(id) of each seeded table, so new rows are appended."""
+    offsets = {}
+    for table in SEEDED_TABLES:
+        cursor.execute(f"SELECT coalesce(max(id), 0) FROM {table};")
+        offsets[table] = cursor.fetchone()[0]
+    return offsets
+
+def seed(users=10000, products=1000, categories=20, orders_per_user=2.0, cart_ratio=0.3, seed_value=1,
+         truncate=False, jobs=DEFAULT_JOBS, chunk_rows=DEFAULT_CHUNK_ROWS, config=None):
+    """Streams a generated dataset into the seeded tables and reports rows/sec.
+
+    config holds connection parameters and defaults to DB_CONFIG.
+    """
+    conn = psycopg2.connect(**(config or DB_CONFIG))
+    cursor = conn.cursor()
+    foreign_keys, indexes = deferred_objects()
+    try:
+        if truncate:
+            print("Truncating seeded tables...")
+            cursor.execute(f"TRUNCATE {', '.join(SEEDED_TABLES)} RESTART IDENTITY CASCADE;")
+
+        counts = {
+            "categories": categories,
+            "products": products,
+            "users": users,
+            # At most one cart per user (idx_carts_user_unique).
+            "carts": int(users * min(cart_ratio, 1.0)),
+            "orders": int(users * orders_per_user),
+        }
+        seeder = Seeder(counts, max_ids(cursor), seed_value, datetime.now(timezone.utc))
+        print(f"Deferring {len(foreign_keys)} foreign keys and {len(indexes)} indexes...")
+        drop_deferred(cursor, foreign_keys, indexes)
+        conn.commit()
+
+        # With foreign keys deferred, every chunk is independent of the others.
+        print(f"Loading with {jobs} worker processes...")
+        totals = {}
+        load_started = time.time()
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(load_chunk, seeder, *unit, config) for unit in seeder.chunks(chunk_rows)]
+            for future in as_completed(futures):
+                table, rows, started, finished = future.result()
+                count, first, last = totals.get(table, (0, started, finished))
+                totals[table] = (count + rows, min(first, started), max(last, finished))
+        load_elapsed = time.time() - load_started
+
+        total_rows = 0
+        for table in SEEDED_TABLES:
+            count, first, last = totals.get(table, (0, 0.0, 0.0))
+            elapsed = last - first
+            total_rows += count
+            print(f"{table:<12} {count:>12,} rows in {elapsed:7.1f}s  ({count / max(elapsed, 1e-9):,.0f} rows/s)")
+        print(f"{'total':<12} {total_rows:>12,} rows in {load_elapsed:7.1f}s  ({total_rows / max(load_elapsed, 1e-9):,.0f} rows/s)")
+
+        for table in SEEDED_TABLES:
+            cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT coalesce(max(id), 1) FROM {table}));")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        # Report a failed restore but keep the error that stopped the load.
+        try:
+            finish(conn, cursor, foreign_keys, indexes)
+        except Exception as e:
+            conn.rollback()
+            print(f"Restoring foreign keys and indexes failed: {e}")
+        raise
+    else:
+        finish(conn, cursor, foreign_keys, indexes)
+    finally:
+        cursor.close()
+        conn.close()
+    return total_rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream a generated load-test dataset with COPY.")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--categories", type=int, default=20)
+    parser.add_argument("--orders-per-user", type=float, default=2.0)
+    parser.add_argument("--cart-ratio", type=float, default=0.3, help="share of users with a cart")
+    parser.add_argument("--seed", type=int, default=1, help="random seed; the same seed yields the same dataset")
+    parser.add_argument("--truncate", action="store_true", help="empty the seeded tables first")
+    parser.add_argument("--jobs", type=int, default=DEFAULT_JOBS, help="parallel loader processes")
+    parser.add_argument("--chunk-rows", type=int, default=DEFAULT_CHUNK_ROWS, help="driving rows per COPY chunk")
+    args = parser.parse_args(argv)
+    seed(users=args.users, products=args.products, categories=args.categories, orders_per_user=args.orders_per_user,
+         cart_ratio=args.cart_ratio, seed_value=args.seed, truncate=args.truncate, jobs=args.jobs,
+         chunk_rows=args.chunk_rows)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,288 @@
+
+import argparse
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+import psycopg2
+
+from create_db_updated import (
+    ACTIVE_PROFILES,
+    DB_CONFIG,
+    SESSION_STORAGE_OPTIONS,
+    SQL_CREATE_PARTITIONED_SESSIONS,
+    create_schema,
+)
+from db_partitions import with_lock_retry
+
+# Session storage maintenance.
+#
+# The session storage profiles in create_db_updated.py declare sessions with
+# a low fillfactor and an expires_at index ("session_storage"), optionally
+# UNLOGGED ("sessions_unlogged") or partitioned by day of expiry
+# ("sessions_partitioned"). This module applies the enabled profile to an
+# existing table, keeps daily partitions ahead of the 7-day session lifetime,
+# and purges expired sessions, reporting the dead tuples left before and
+# after.
+
+DEFAULT_DAYS_AHEAD = 8
+DEFAULT_BATCH_SIZE = 5000
+
+# Copied by name: tables created by older scripts have captcha_text last.
+SESSION_COLUMNS = "id, user_id, captcha_text, expires_at, created_at"
+# fk_sessions_user as declared in create_db_updated.py.
+SESSION_FOREIGN_KEY = "FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE"
+
+# Sizes and tuple counts summed over sessions and any partitions it has.
+SQL_SESSION_STATS = """
+    WITH leaves AS (
+        SELECT relid FROM pg_partition_tree('sessions') WHERE isleaf
+        UNION
+        SELECT oid FROM pg_class WHERE oid = 'sessions'::regclass AND relkind = 'r'
+    )
+    SELECT coalesce(sum(s.n_live_tup), 0)::bigint, coalesce(sum(s.n_dead_tup), 0)::bigint,
+           coalesce(sum(pg_total_relation_size(l.relid)), 0)::bigint
+    FROM leaves l
+    LEFT JOIN pg_stat_user_tables s ON s.relid = l.relid;
+"""
+
+SQL_SESSION_LAYOUT = """
+    SELECT c.relkind = 'p', c.relpersistence = 'u', coalesce(c.reloptions, '{}')
+    FROM pg_class c WHERE c.oid = to_regclass('sessions');
+"""
+
+SQL_SESSION_PARTITIONS = """
+    SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = to_regclass('sessions')
+    ORDER BY c.relname;
+"""
+
+# SKIP LOCKED keeps the purge from queuing behind a login that is touching
+# one of the expired rows.
+SQL_PURGE_BATCH = """
+    DELETE FROM sessions
+    WHERE ctid = ANY(ARRAY(
+        SELECT ctid FROM sessions
+        WHERE expires_at < now()
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    ));
+"""
+
+SQL_PURGE_PARTITIONED_BATCH = """
+    DELETE FROM sessions_default
+    WHERE ctid = ANY(ARRAY(
+        SELECT ctid FROM sessions_default
+        WHERE expires_at < now()
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    ));
+"""
+
+def connect():
+    """Opens a connection using DB_CONFIG."""
+    return psycopg2.connect(**DB_CONFIG)
+
+def partition_name(day):
+    """Returns the sessions partition name for the day starting at day."""
+    return f"sessions_p{day:%Y%m%d}"
+
+def partition_bounds(day):
+    """Returns the FOR VALUES clause for one UTC day."""
+    return f"FOR VALUES FROM ('{day.isoformat()} 00:00+00') TO ('{(day + timedelta(days=1)).isoformat()} 00:00+00')"
+
+def session_stats(cursor):
+    """Returns (live tuples, dead tuples, total bytes) for sessions."""
+    cursor.execute(SQL_SESSION_STATS)
+    return cursor.fetchone()
+
+def flush_stats(cursor):
+    """Makes this backend's pending table statistics visible at the next commit (PostgreSQL 15+)."""
+    if cursor.connection.server_version >= 150000:
+        cursor.execute("SELECT pg_stat_force_next_flush();")
+
+def session_layout(cursor):
+    """Returns (partitioned, unlogged, reloptions) for the live sessions table."""
+    cursor.execute(SQL_SESSION_LAYOUT)
+    return cursor.fetchone()
+
+def ensure_partitions(days_ahead=DEFAULT_DAYS_AHEAD):
+    """Creates daily sessions partitions from today through days_ahead days from now."""
+    conn = connect()
+    cursor = conn.cursor()
+    today = datetime.now(timezone.utc).date()
+    try:
+        partitioned, _unlogged, _options = session_layout(cursor)
+        if not partitioned:
+            raise RuntimeError("sessions is not partitioned; enable sessions_partitioned and run 'sessions tune'")
+        cursor.execute(SQL_SESSION_PARTITIONS)
+        present = {row[0] for row in cursor.fetchall()}
+        conn.commit()
+        for offset in range(days_ahead + 1):
+            day = today + timedelta(days=offset)
+            if partition_name(day) not in present:
+                with_lock_retry(conn, cursor, partition_name(day), [
+                    f"CREATE TABLE IF NOT EXISTS {partition_name(day)} PARTITION OF sessions {partition_bounds(day)} "
+                    f"WITH ({SESSION_STORAGE_OPTIONS});",
+                ])
+                print(f"Created {partition_name(day)}")
+        print("Session partitions are in place.")
+    finally:
+        cursor.close()
+        conn.close()
+
+def convert_to_partitioned(conn, cursor, days_ahead):
+    """Replaces sessions with the partitioned layout, carrying over unexpired sessions.
+
+    Runs in one transaction under an exclusive lock; only live sessions are
+    copied, so purge first to keep it short. Dropping the old table drops
+    fk_sessions_user with it. PostgreSQL cannot add a NOT VALID foreign key
+    to a partitioned table, so each partition gets one in the swap
+    transaction; they are validated afterwards and then adopted by the
+    foreign key added on sessions, which need not scan again.
+    """
+    today = datetime.now(timezone.utc).date()
+    partitions = ["sessions_default"] + [partition_name(today + timedelta(days=offset))
+                                         for offset in range(days_ahead + 1)]
+    statements = [
+        "LOCK TABLE sessions IN ACCESS EXCLUSIVE MODE;",
+        SQL_CREATE_PARTITIONED_SESSIONS.replace("CREATE TABLE IF NOT EXISTS sessions (", "CREATE TABLE sessions_partitioned (", 1),
+        f"CREATE TABLE sessions_default PARTITION OF sessions_partitioned DEFAULT WITH ({SESSION_STORAGE_OPTIONS});",
+    ]
+    for offset in range(days_ahead + 1):
+        day = today + timedelta(days=offset)
+        statements.append(f"CREATE TABLE {partition_name(day)} PARTITION OF sessions_partitioned {partition_bounds(day)} "
+                          f"WITH ({SESSION_STORAGE_OPTIONS});")
+    statements += [
+        f"INSERT INTO sessions_partitioned ({SESSION_COLUMNS}) "
+        f"SELECT {SESSION_COLUMNS} FROM sessions WHERE expires_at >= now();",
+        "DROP TABLE sessions;",
+        "ALTER TABLE sessions_partitioned RENAME TO sessions;",
+        "ALTER TABLE sessions RENAME CONSTRAINT sessions_partitioned_pkey TO sessions_pkey;",
+    ]
+    statements += [f"ALTER TABLE {name} ADD CONSTRAINT fk_sessions_user {SESSION_FOREIGN_KEY} NOT VALID;"
+                    for name in partitions]
+    with_lock_retry(conn, cursor, "sessions", statements)
+
+    for name in partitions:
+        with_lock_retry(conn, cursor, name, [f"ALTER TABLE {name} VALIDATE CONSTRAINT fk_sessions_user;"])
+    with_lock_retry(conn, cursor, "sessions", [f"ALTER TABLE sessions ADD CONSTRAINT fk_sessions_user {SESSION_FOREIGN_KEY};"])
+    print("Validated fk_sessions_user.")
+
+def tune(days_ahead=DEFAULT_DAYS_AHEAD):
+    """Brings an existing sessions table in line with the enabled session storage profile."""
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        partitioned, unlogged, options = session_layout(cursor)
+        conn.commit()
+        if "sessions_partitioned" in ACTIVE_PROFILES and not partitioned:
+            print("Converting sessions to daily partitions by expires_at...")
+            convert_to_partitioned(conn, cursor, days_ahead)
+            partitioned = True
+        elif partitioned:
+            print("sessions is partitioned; partitions get the storage options when created.")
+        else:
+            # Takes SHARE UPDATE EXCLUSIVE only; existing pages keep their
+            # fill until they are next rewritten.
+            with_lock_retry(conn, cursor, "sessions", [f"ALTER TABLE sessions SET ({SESSION_STORAGE_OPTIONS});"])
+            print(f"Set ({SESSION_STORAGE_OPTIONS}) on sessions (was {options or 'default'}).")
+            if "sessions_unlogged" in ACTIVE_PROFILES and not unlogged:
+                # Rewrites the table under an exclusive lock; purge first.
+                with_lock_retry(conn, cursor, "sessions", ["ALTER TABLE sessions SET UNLOGGED;"])
+                print("sessions is now UNLOGGED.")
+    finally:
+        cursor.close()
+        conn.close()
+    # Creates the expires_at index and anything else the profile declares.
+    create_schema(mode="diff")
+
+def drop_expired_partitions(conn, cursor):
+    """Drops daily partitions whose whole range has expired; returns how many."""
+    today = datetime.now(timezone.utc).date()
+    cursor.execute(SQL_SESSION_PARTITIONS)
+    expired = []
+    for name, _bound in cursor.fetchall():
+        if name.startswith("sessions_p") and len(name) == len("sessions_pYYYYMMDD"):
+            day = datetime.strptime(name[len("sessions_p"):], "%Y%m%d").date()
+            if day < today:
+                expired.append(name)
+    conn.commit()
+    for name in expired:
+        with_lock_retry(conn, cursor, name, [f"DROP TABLE {name};"])
+        print(f"Dropped {name}")
+    return len(expired)
+
+def purge(batch_size=DEFAULT_BATCH_SIZE, pause=0.0, vacuum=False):
+    """Deletes expired sessions in bounded batches (or drops expired partitions).
+
+    Prints dead tuples and size before the purge, after it and, with vacuum,
+    after a plain VACUUM (ANALYZE), which makes the freed space reusable.
+    """
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        partitioned, _unlogged, _options = session_layout(cursor)
+        live, dead, size = session_stats(cursor)
+        print(f"Before: {live} live, {dead} dead tuples, {size / 1024 / 1024:.1f} MB")
+        conn.commit()
+
+        started = time.monotonic()
+        dropped = drop_expired_partitions(conn, cursor) if partitioned else 0
+        batch_sql = SQL_PURGE_PARTITIONED_BATCH if partitioned else SQL_PURGE_BATCH
+        deleted = 0
+        while True:
+            cursor.execute(batch_sql, (batch_size,))
+            count = cursor.rowcount
+            flush_stats(cursor)
+            conn.commit()
+            deleted += count
+            if count < batch_size:
+                break
+            print(f"Deleted {deleted} expired sessions so far")
+            if pause:
+                time.sleep(pause)
+        print(f"Purged {deleted} expired sessions"
+              f"{f' and dropped {dropped} partition(s)' if dropped else ''} in {time.monotonic() - started:.1f}s.")
+
+        live, dead_after, size = session_stats(cursor)
+        conn.commit()
+        print(f"After purge: {live} live, {dead_after} dead tuples, {size / 1024 / 1024:.1f} MB")
+        if vacuum:
+            conn.autocommit = True
+            cursor.execute("VACUUM (ANALYZE) sessions;")
+            live, dead_vacuumed, size = session_stats(cursor)
+            print(f"After vacuum: {live} live, {dead_vacuumed} dead tuples, {size / 1024 / 1024:.1f} MB "
+                  f"({dead_after - dead_vacuumed} dead tuples removed)")
+        return deleted
+    finally:
+        cursor.close()
+        conn.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Session storage tuning and expiry purge.")
+    actions = parser.add_subparsers(dest="action", required=True)
+
+    tune_parser = actions.add_parser("tune", help="apply the enabled session storage profile to the existing table")
+    tune_parser.add_argument("--days-ahead", type=int, default=DEFAULT_DAYS_AHEAD,
+                             help="daily partitions to create when converting to the partitioned layout")
+
+    ensure_parser = actions.add_parser("ensure", help="pre-create daily partitions (partitioned layout)")
+    ensure_parser.add_argument("--days-ahead", type=int, default=DEFAULT_DAYS_AHEAD)
+
+    purge_parser = actions.add_parser("purge", help="delete expired sessions in batches")
+    purge_parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    purge_parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    purge_parser.add_argument("--vacuum", action="store_true", help="VACUUM (ANALYZE) sessions afterwards")
+
+    args = parser.parse_args(argv)
+    if args.action == "tune":
+        tune(days_ahead=args.days_ahead)
+    elif args.action == "ensure":
+        ensure_partitions(days_ahead=args.days_ahead)
+    elif args.action == "purge":
+        purge(batch_size=args.batch_size, pause=args.pause, vacuum=args.vacuum)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
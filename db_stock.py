@@ -0,0 +1,329 @@
+
+import argparse
+import os
+import sys
+import time
+import psycopg2
+
+from create_db_updated import DB_CONFIG
+
+# Sharded stock and reservation ledger maintenance (schema profile
+# "stock_ledger", see create_db_updated.py).
+#
+# enable splits a product's allocatable stock over shards, so that
+# reserve_stock() calls for it stop queueing on one row lock. reconcile is
+# the periodic job:
+#   1. releases held reservations past their expiry back to their shards;
+#   2. folds committed reservations into products.stock, one short
+#      transaction per batch of products;
+#   3. checks every sharded product against
+#          sum(available) = products.stock - held - committed but not folded
+#      and, with the product and its shards locked, rewrites the shards
+#      evenly when they drift or when some are empty while others are not;
+#   4. deletes released and folded reservations past the retention period.
+# Run it every few seconds with --interval; a single pass is cheap when
+# nothing changed.
+
+DEFAULT_SHARDS = max(os.cpu_count() or 1, 4)
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_INTERVAL = 5.0
+DEFAULT_RETENTION_DAYS = 7
+
+SQL_ENABLED = "SELECT to_regclass('stock_shards') IS NOT NULL;"
+
+SQL_FEATURED_PRODUCTS = "SELECT id FROM products WHERE featured ORDER BY id;"
+
+SQL_LOCK_PRODUCT = "SELECT coalesce(stock, 0) FROM products WHERE id = %s FOR NO KEY UPDATE;"
+
+SQL_LOCK_SHARDS = "SELECT shard FROM stock_shards WHERE product_id = %s ORDER BY shard FOR NO KEY UPDATE;"
+
+# Units the shards must not hand out: holds, and committed units that
+# products.stock does not reflect yet.
+SQL_OUTSTANDING = """
+    SELECT coalesce(sum(quantity), 0)
+    FROM stock_reservations
+    WHERE product_id = %s AND (status = 'held' OR (status = 'committed' AND folded_at IS NULL));
+"""
+
+SQL_WRITE_SHARDS = """
+    DELETE FROM stock_shards WHERE product_id = %(product)s AND shard >= %(shards)s;
+    INSERT INTO stock_shards (product_id, shard, available)
+    SELECT %(product)s, s, %(available)s / %(shards)s + (s < %(available)s %% %(shards)s)::integer
+    FROM generate_series(0, %(shards)s - 1) AS s
+    ON CONFLICT (product_id, shard) DO UPDATE SET available = EXCLUDED.available;
+"""
+
+# Holds taken from shards that no longer exist go back to a shard that does.
+SQL_REMAP_HOLDS = """
+    UPDATE stock_reservations SET shard = shard %% %(shards)s
+    WHERE product_id = %(product)s AND status = 'held' AND shard >= %(shards)s;
+"""
+
+SQL_DISABLE = "DELETE FROM stock_shards WHERE product_id = %s;"
+
+SQL_HELD = "SELECT count(*) FROM stock_reservations WHERE product_id = %s AND status = 'held';"
+
+SQL_RELEASE_EXPIRED = "SELECT release_expired_stock(%s);"
+
+SQL_UNFOLDED_PRODUCTS = """
+    SELECT DISTINCT product_id FROM stock_reservations
+    WHERE status = 'committed' AND folded_at IS NULL AND product_id > %s
+    ORDER BY product_id
+    LIMIT %s;
+"""
+
+# The flag keeps trg_products_stock_shards from taking the folded units from
+# the shards a second time.
+SQL_FOLD = """
+    SET LOCAL plenaire.stock_folding = 'on';
+    WITH folded AS (
+        UPDATE stock_reservations
+        SET folded_at = now(), updated_at = now()
+        WHERE status = 'committed' AND folded_at IS NULL AND product_id = ANY(%s)
+        RETURNING product_id, quantity
+    )
+    UPDATE products p
+    SET stock = coalesce(p.stock, 0) - f.quantity, updated_at = now()
+    FROM (SELECT product_id, sum(quantity)::integer AS quantity FROM folded GROUP BY product_id) f
+    WHERE p.id = f.product_id;
+"""
+
+SQL_SHARD_CHECK = """
+    SELECT s.product_id, s.shards, s.available, s.empty,
+           greatest(coalesce(p.stock, 0) - coalesce(o.quantity, 0), 0) AS expected
+    FROM (
+        SELECT product_id, count(*) AS shards, sum(available) AS available,
+               count(*) FILTER (WHERE available = 0) AS empty
+        FROM stock_shards GROUP BY product_id
+    ) s
+    JOIN products p ON p.id = s.product_id
+    LEFT JOIN (
+        SELECT product_id, sum(quantity) AS quantity FROM stock_reservations
+        WHERE status = 'held' OR (status = 'committed' AND folded_at IS NULL)
+        GROUP BY product_id
+    ) o ON o.product_id = s.product_id
+    ORDER BY s.product_id;
+"""
+
+SQL_PRUNE = """
+    DELETE FROM stock_reservations
+    WHERE id IN (
+        SELECT id FROM stock_reservations
+        WHERE (status = 'released' OR folded_at IS NOT NULL) AND updated_at < now() - %s * interval '1 day'
+        LIMIT %s
+    );
+"""
+
+SQL_STATUS = """
+    SELECT s.product_id, p.name, coalesce(p.stock, 0), count(*), sum(s.available),
+           (SELECT coalesce(sum(quantity), 0) FROM stock_reservations r WHERE r.product_id = s.product_id AND r.status = 'held'),
+           (SELECT coalesce(sum(quantity), 0) FROM stock_reservations r
+            WHERE r.product_id = s.product_id AND r.status = 'committed' AND r.folded_at IS NULL)
+    FROM stock_shards s JOIN products p ON p.id = s.product_id
+    GROUP BY s.product_id, p.name, p.stock
+    ORDER BY s.product_id;
+"""
+
+def connect():
+    """Opens a connection using DB_CONFIG."""
+    return psycopg2.connect(**DB_CONFIG)
+
+def require_ledger(cursor):
+    cursor.execute(SQL_ENABLED)
+    if not cursor.fetchone()[0]:
+        raise RuntimeError("stock_shards does not exist; apply the schema with DATABASE_SCHEMA_PROFILES=stock_ledger.")
+
+def redistribute(cursor, product_id, shards=None):
+    """Rewrites a product's shards evenly from its stock; returns the units they hold.
+
+    Locks the product and then its shards, so no reservation or stock change
+    for it runs meanwhile. shards defaults to the current shard count.
+    """
+    cursor.execute(SQL_LOCK_PRODUCT, (product_id,))
+    row = cursor.fetchone()
+    if row is None:
+        raise RuntimeError(f"Product {product_id} does not exist.")
+    cursor.execute(SQL_LOCK_SHARDS, (product_id,))
+    shards = shards or cursor.rowcount
+    cursor.execute(SQL_OUTSTANDING, (product_id,))
+    available = max(row[0] - cursor.fetchone()[0], 0)
+    cursor.execute(SQL_WRITE_SHARDS, {"product": product_id, "available": available, "shards": shards})
+    cursor.execute(SQL_REMAP_HOLDS, {"product": product_id, "shards": shards})
+    return available
+
+def enable(product_ids, shards=DEFAULT_SHARDS, featured=False):
+    """Shards the stock of the given (or featured) products."""
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        require_ledger(cursor)
+        if featured:
+            cursor.execute(SQL_FEATURED_PRODUCTS)
+            product_ids = list(product_ids) + [row[0] for row in cursor.fetchall()]
+        for product_id in sorted(set(product_ids)):
+            available = redistribute(cursor, product_id, shards)
+            conn.commit()
+            print(f"Product {product_id}: {available} units over {shards} shards")
+    finally:
+        cursor.close()
+        conn.close()
+
+def disable(product_ids):
+    """Stops sharding products that have no held reservations; their stock stays in products.stock."""
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        require_ledger(cursor)
+        for product_id in sorted(set(product_ids)):
+            cursor.execute(SQL_LOCK_PRODUCT, (product_id,))
+            cursor.execute(SQL_LOCK_SHARDS, (product_id,))
+            cursor.execute(SQL_HELD, (product_id,))
+            if cursor.fetchone()[0]:
+                conn.rollback()
+                print(f"Product {product_id} has held reservations; release them or let them expire first.")
+                continue
+            cursor.execute(SQL_DISABLE, (product_id,))
+            conn.commit()
+            print(f"Product {product_id}: shards removed")
+    finally:
+        cursor.close()
+        conn.close()
+
+def release_expired(conn, cursor, batch_size):
+    """Releases expired holds in batches; returns the units released."""
+    released = 0
+    while True:
+        cursor.execute(SQL_RELEASE_EXPIRED, (batch_size,))
+        units = cursor.fetchone()[0]
+        conn.commit()
+        released += units
+        if not units:
+            return released
+
+def fold_committed(conn, cursor, batch_size):
+    """Folds committed reservations into products.stock in batches of products; returns the products folded."""
+    last = 0
+    folded = 0
+    while True:
+        cursor.execute(SQL_UNFOLDED_PRODUCTS, (last, batch_size))
+        product_ids = [row[0] for row in cursor.fetchall()]
+        if not product_ids:
+            conn.rollback()
+            return folded
+        cursor.execute(SQL_FOLD, (product_ids,))
+        conn.commit()
+        folded += len(product_ids)
+        last = product_ids[-1]
+
+def rebalance(conn, cursor):
+    """Rewrites the shards of products that drifted or ran unevenly dry; returns [(product, drift)]."""
+    cursor.execute(SQL_SHARD_CHECK)
+    candidates = cursor.fetchall()
+    conn.rollback()
+    fixed = []
+    for product_id, shards, available, empty, expected in candidates:
+        if available == expected and not (empty and expected >= shards):
+            continue
+        try:
+            now_available = redistribute(cursor, product_id)
+            conn.commit()
+            fixed.append((product_id, now_available - available))
+        except psycopg2.errors.DeadlockDetected:
+            # Lost to a reservation spanning several shards; next pass retries.
+            conn.rollback()
+    return fixed
+
+def prune(conn, cursor, retention_days, batch_size):
+    removed = 0
+    while True:
+        cursor.execute(SQL_PRUNE, (retention_days, batch_size))
+        conn.commit()
+        removed += cursor.rowcount
+        if cursor.rowcount < batch_size:
+            return removed
+
+def reconcile(batch_size=DEFAULT_BATCH_SIZE, retention_days=DEFAULT_RETENTION_DAYS):
+    """Runs one reconciliation pass; returns its counts."""
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        require_ledger(cursor)
+        started = time.monotonic()
+        result = {
+            "released": release_expired(conn, cursor, batch_size),
+            "folded": fold_committed(conn, cursor, batch_size),
+            "rebalanced": rebalance(conn, cursor),
+            "pruned": prune(conn, cursor, retention_days, batch_size),
+        }
+        drifted = [f"{product} ({drift:+d})" for product, drift in result["rebalanced"] if drift]
+        print(f"Released {result['released']} expired units, folded {result['folded']} products, "
+              f"rebalanced {len(result['rebalanced'])} products, pruned {result['pruned']} reservations "
+              f"in {time.monotonic() - started:.2f}s")
+        if drifted:
+            print(f"Shards had drifted from products.stock for: {', '.join(drifted)}")
+        return result
+    finally:
+        cursor.close()
+        conn.close()
+
+def run_reconciler(interval=DEFAULT_INTERVAL, **options):
+    """Reconciles every interval seconds until interrupted."""
+    try:
+        while True:
+            reconcile(**options)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+def status():
+    """Returns one row per sharded product: id, name, stock, shards, available, held, unfolded."""
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        require_ledger(cursor)
+        cursor.execute(SQL_STATUS)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+        conn.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain sharded stock and the reservation ledger.")
+    actions = parser.add_subparsers(dest="action", required=True)
+
+    enable_parser = actions.add_parser("enable", help="shard the stock of products")
+    enable_parser.add_argument("products", nargs="*", type=int, help="product ids")
+    enable_parser.add_argument("--featured", action="store_true", help="also every featured product")
+    enable_parser.add_argument("--shards", type=int, default=DEFAULT_SHARDS)
+
+    disable_parser = actions.add_parser("disable", help="stop sharding products")
+    disable_parser.add_argument("products", nargs="+", type=int, help="product ids")
+
+    reconcile_parser = actions.add_parser("reconcile", help="release expired holds and fold committed stock")
+    reconcile_parser.add_argument("--interval", type=float, help="repeat every this many seconds")
+    reconcile_parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    reconcile_parser.add_argument("--retention-days", type=int, default=DEFAULT_RETENTION_DAYS,
+                                  help="keep released and folded reservations this long")
+
+    actions.add_parser("status", help="show sharded products")
+
+    args = parser.parse_args(argv)
+    if args.action == "enable":
+        if not args.products and not args.featured:
+            parser.error("give product ids or --featured")
+        enable(args.products, shards=args.shards, featured=args.featured)
+    elif args.action == "disable":
+        disable(args.products)
+    elif args.action == "reconcile":
+        options = {"batch_size": args.batch_size, "retention_days": args.retention_days}
+        if args.interval:
+            run_reconciler(args.interval, **options)
+        else:
+            reconcile(**options)
+    elif args.action == "status":
+        print(f"{'product':>8}  {'stock':>7} {'shards':>6} {'available':>9} {'held':>6} {'unfolded':>8}  name")
+        for product_id, name, stock, shards, available, held, unfolded in status():
+            print(f"{product_id:>8}  {stock:>7} {shards:>6} {available:>9} {held:>6} {unfolded:>8}  {name}")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
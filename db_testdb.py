@@ -0,0 +1,299 @@
+
+import argparse
+import atexit
+import hashlib
+import json
+import os
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+import psycopg2
+from psycopg2.extensions import make_dsn
+
+from create_db_updated import DB_CONFIG, create_schema, schema_fingerprint
+
+# Fresh databases for integration tests.
+#
+# Replaying the schema for every suite costs seconds; cloning a template
+# with CREATE DATABASE ... TEMPLATE costs milliseconds. prepare builds (and
+# optionally seeds) a template database keyed by the schema fingerprint and
+# the seed options, so a schema change gets a new template instead of a
+# stale one, and keeps a pool of spare clones. acquire renames a spare into
+# a new test database, or clones one when the pool is empty; release drops
+# it. Test databases carry their owner's pid in the name, and cleanup drops
+# the ones whose owner is gone, plus templates and spares of old keys.
+#
+# From Python, fresh_database() yields connection parameters for a new
+# database and drops it afterwards. Other runners call 'testdb acquire',
+# which prints a DSN owned by the calling process.
+
+PREFIX = os.getenv("TESTDB_PREFIX", "plenaire")
+MAINTENANCE_DB = os.getenv("DATABASE_MAINTENANCE_DB", "postgres")
+DEFAULT_SPARES = 4
+
+# Serializes template builds between concurrent test processes.
+SQL_TEMPLATE_LOCK = "SELECT pg_advisory_lock(hashtext('plenaire_testdb_template'));"
+SQL_TEMPLATE_UNLOCK = "SELECT pg_advisory_unlock(hashtext('plenaire_testdb_template'));"
+
+SQL_DATABASES = "SELECT datname FROM pg_database WHERE datname LIKE %s ORDER BY datname;"
+
+_acquired = []
+
+def maintenance_connect():
+    """Opens an autocommit connection to the maintenance database."""
+    conn = psycopg2.connect(**dict(DB_CONFIG, database=MAINTENANCE_DB))
+    conn.autocommit = True
+    return conn
+
+def database_config(name):
+    """Returns DB_CONFIG pointed at another database."""
+    return dict(DB_CONFIG, database=name)
+
+def template_key(seed_options=None):
+    """Returns the key of the template for the current schema and seed options."""
+    digest = hashlib.sha256(schema_fingerprint().encode("utf-8"))
+    digest.update(json.dumps(seed_options or {}, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()[:12]
+
+def template_name(key):
+    return f"{PREFIX}_tpl_{key}"
+
+def spare_prefix(key):
+    return f"{PREFIX}_s_{key}_"
+
+def test_prefix(key):
+    return f"{PREFIX}_t_{key}_"
+
+def databases(cursor, prefix):
+    """Returns the names of databases starting with prefix."""
+    cursor.execute(SQL_DATABASES, (prefix.replace("_", r"\_") + "%",))
+    return [row[0] for row in cursor.fetchall()]
+
+def drop_database(cursor, name):
+    """Drops a database, disconnecting any sessions left on it."""
+    if cursor.connection.server_version >= 130000:
+        cursor.execute(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE);')
+    else:
+        cursor.execute(f'DROP DATABASE IF EXISTS "{name}";')
+
+def clone(cursor, template, name):
+    """Creates name as a copy of template.
+
+    WAL_LOG (PostgreSQL 15+) copies block by block without the checkpoints
+    FILE_COPY needs, which is faster for small templates.
+    """
+    strategy = " STRATEGY WAL_LOG" if cursor.connection.server_version >= 150000 else ""
+    cursor.execute(f'CREATE DATABASE "{name}" TEMPLATE "{template}"{strategy};')
+
+def build_template(cursor, key, seed_options):
+    """Builds the template for key under a fresh name, then renames it into place."""
+    name = template_name(key)
+    building = f"{name}_building"
+    drop_database(cursor, building)
+    cursor.execute(f'CREATE DATABASE "{building}";')
+    config = database_config(building)
+    create_schema(mode="diff", config=config)
+    if seed_options:
+        from db_seed import seed
+        seed(config=config, **seed_options)
+    # Frozen, analyzed pages mean clones start without hint-bit writes or
+    # an immediate autovacuum pass.
+    conn = psycopg2.connect(**config)
+    conn.autocommit = True
+    try:
+        conn.cursor().execute("VACUUM (FREEZE, ANALYZE);")
+    finally:
+        conn.close()
+    cursor.execute(f'ALTER DATABASE "{building}" RENAME TO "{name}";')
+    cursor.execute(f'ALTER DATABASE "{name}" WITH IS_TEMPLATE true ALLOW_CONNECTIONS false;')
+
+def ensure_template(cursor, seed_options=None):
+    """Returns the template name for the current schema, building it if needed."""
+    key = template_key(seed_options)
+    name = template_name(key)
+    if databases(cursor, name) == [name]:
+        return key, name
+    cursor.execute(SQL_TEMPLATE_LOCK)
+    try:
+        if databases(cursor, name) != [name]:
+            started = time.monotonic()
+            print(f"Building template {name}...")
+            build_template(cursor, key, seed_options)
+            print(f"Built template {name} in {time.monotonic() - started:.1f}s")
+    finally:
+        cursor.execute(SQL_TEMPLATE_UNLOCK)
+    return key, name
+
+def fill_spares(cursor, key, template, count):
+    """Clones spares until the pool for key holds count of them; returns how many were made."""
+    present = databases(cursor, spare_prefix(key))
+    made = 0
+    for _ in range(count - len(present)):
+        clone(cursor, template, f"{spare_prefix(key)}{uuid.uuid4().hex[:8]}")
+        made += 1
+    return made
+
+def take_spare(cursor, key, name):
+    """Renames a spare to name; returns False when none could be taken."""
+    for spare in databases(cursor, spare_prefix(key)):
+        try:
+            cursor.execute(f'ALTER DATABASE "{spare}" RENAME TO "{name}";')
+            return True
+        except (psycopg2.errors.UndefinedDatabase, psycopg2.errors.ObjectInUse):
+            # Another process took this spare first.
+            continue
+    return False
+
+def acquire(seed_options=None, owner=None):
+    """Returns connection parameters for a new database cloned from the current template."""
+    owner = os.getpid() if owner is None else owner
+    conn = maintenance_connect()
+    cursor = conn.cursor()
+    try:
+        key, template = ensure_template(cursor, seed_options)
+        name = f"{test_prefix(key)}{owner}_{uuid.uuid4().hex[:6]}"
+        if not take_spare(cursor, key, name):
+            clone(cursor, template, name)
+        return database_config(name)
+    finally:
+        cursor.close()
+        conn.close()
+
+def release(name):
+    """Drops a test database."""
+    conn = maintenance_connect()
+    try:
+        drop_database(conn.cursor(), name)
+    finally:
+        conn.close()
+
+@contextmanager
+def fresh_database(seed_options=None):
+    """Yields connection parameters for a new database and drops it afterwards."""
+    config = acquire(seed_options)
+    _acquired.append(config["database"])
+    try:
+        yield config
+    finally:
+        release(config["database"])
+        _acquired.remove(config["database"])
+
+@atexit.register
+def _release_acquired():
+    for name in list(_acquired):
+        release(name)
+
+def owner_alive(pid):
+    """Returns True when a process with pid exists on this host."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def cleanup(everything=False, seed_options=None):
+    """Drops orphaned test databases and templates and spares of other keys; returns the names dropped."""
+    current = template_key(seed_options)
+    conn = maintenance_connect()
+    cursor = conn.cursor()
+    dropped = []
+    try:
+        for name in databases(cursor, f"{PREFIX}_t_"):
+            owner = name[len(f"{PREFIX}_t_"):].split("_")[1]
+            if everything or not owner.isdigit() or not owner_alive(int(owner)):
+                drop_database(cursor, name)
+                dropped.append(name)
+        for name in databases(cursor, f"{PREFIX}_s_") + databases(cursor, f"{PREFIX}_tpl_"):
+            if everything or current not in name or name.endswith("_building"):
+                if name.startswith(f"{PREFIX}_tpl_"):
+                    cursor.execute(f'ALTER DATABASE "{name}" WITH IS_TEMPLATE false;')
+                drop_database(cursor, name)
+                dropped.append(name)
+        return dropped
+    finally:
+        cursor.close()
+        conn.close()
+
+def status(seed_options=None):
+    """Returns (current template or None, spares, test databases) for the current key."""
+    key = template_key(seed_options)
+    conn = maintenance_connect()
+    cursor = conn.cursor()
+    try:
+        template = databases(cursor, template_name(key))
+        return (template[0] if template else None), databases(cursor, spare_prefix(key)), databases(cursor, f"{PREFIX}_t_")
+    finally:
+        cursor.close()
+        conn.close()
+
+def add_seed_arguments(parser):
+    parser.add_argument("--seed-users", type=int, default=0, help="seed the template with this many users (0: schema only)")
+    parser.add_argument("--seed-products", type=int, default=1000)
+    parser.add_argument("--seed-orders-per-user", type=float, default=2.0)
+
+def seed_options(args):
+    """Returns the seed() keyword arguments the template is built with, or None."""
+    if not args.seed_users:
+        return None
+    return {"users": args.seed_users, "products": args.seed_products, "orders_per_user": args.seed_orders_per_user}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Clone fresh test databases from a fingerprinted template.")
+    actions = parser.add_subparsers(dest="action", required=True)
+
+    prepare_parser = actions.add_parser("prepare", help="build the template and fill the spare pool")
+    prepare_parser.add_argument("--spares", type=int, default=DEFAULT_SPARES)
+    add_seed_arguments(prepare_parser)
+
+    acquire_parser = actions.add_parser("acquire", help="print the DSN of a new test database")
+    acquire_parser.add_argument("--owner-pid", type=int, default=os.getppid(),
+                                help="process whose exit makes the database eligible for cleanup (default: the caller)")
+    add_seed_arguments(acquire_parser)
+
+    release_parser = actions.add_parser("release", help="drop a test database")
+    release_parser.add_argument("name")
+
+    cleanup_parser = actions.add_parser("cleanup", help="drop orphaned test databases and outdated templates")
+    cleanup_parser.add_argument("--all", action="store_true", help="drop every template, spare and test database")
+    add_seed_arguments(cleanup_parser)
+
+    status_parser = actions.add_parser("status", help="show the template, spares and test databases")
+    add_seed_arguments(status_parser)
+
+    args = parser.parse_args(argv)
+    if args.action == "prepare":
+        conn = maintenance_connect()
+        cursor = conn.cursor()
+        try:
+            key, template = ensure_template(cursor, seed_options(args))
+            started = time.monotonic()
+            made = fill_spares(cursor, key, template, args.spares)
+            print(f"Template {template} ready; cloned {made} spare(s) in {time.monotonic() - started:.2f}s.")
+        finally:
+            cursor.close()
+            conn.close()
+    elif args.action == "acquire":
+        started = time.monotonic()
+        config = acquire(seed_options(args), owner=args.owner_pid)
+        print(make_dsn(**config))
+        print(f"Acquired {config['database']} in {(time.monotonic() - started) * 1000:.0f} ms", file=sys.stderr)
+    elif args.action == "release":
+        release(args.name)
+    elif args.action == "cleanup":
+        dropped = cleanup(everything=args.all, seed_options=seed_options(args))
+        for name in dropped:
+            print(f"Dropped {name}")
+        print(f"{len(dropped)} database(s) dropped.")
+    elif args.action == "status":
+        template, spares, tests = status(seed_options(args))
+        print(f"Template: {template or 'not built'}")
+        print(f"Spares: {len(spares)}")
+        print(f"Test databases: {len(tests)}")
+        for name in tests:
+            print(f"  {name}")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
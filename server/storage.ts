@@ -150,6 +150,9 @@ export interface IStorage {
 export class PostgresStorage implements IStorage {
   private client;
   private db;
+  // Whether trg_reviews_aggregate (create_db_updated.py) maintains the
+  // product review counts; databases created with db:push do not have it.
+  private reviewTrigger?: Promise<boolean>;
 
   constructor() {
     if (!connectionString) {
@@ -397,9 +400,12 @@ export class PostgresStorage implements IStorage {
   }
   
   async searchProducts(query: string): Promise<Product[]> {
-    return this.db.select().from(products).where(
-      sql`to_tsvector('english', ${products.name} || ' ' || ${products.description}) @@ to_tsquery('english', ${query.replace(/\s+/g, ' & ')})`
-    );
+    // search_vector is maintained by a trigger from create_db_updated.py and
+    // served by the idx_products_search_vector GIN index.
+    const tsquery = sql`websearch_to_tsquery('english', ${query})`;
+    return this.db.select().from(products)
+      .where(sql`"products"."search_vector" @@ ${tsquery}`)
+      .orderBy(sql`ts_rank("products"."search_vector", ${tsquery}) DESC`);
   }
   
   async getProductsByCategory(categoryId: number): Promise<Product[]> {
@@ -606,23 +612,45 @@ export class PostgresStorage implements IStorage {
       return updated!;
     }
     
-    // Create new review
+    // Create new review. Where the trg_reviews_aggregate trigger exists it
+    // maintains the product's review_count, rating_sum and rating_avg.
     const result = await this.db.insert(reviews).values(review).returning();
     
-    // Update product review count
-    const product = await this.getProduct(review.productId);
-    if (product) {
-      await this.db.update(products)
-        .set({ 
-          reviewCount: (product.reviewCount || 0) + 1,
-          updatedAt: new Date()
-        })
-        .where(eq(products.id, product.id));
+    // Without the trigger, the review count is updated here.
+    if (!(await this.hasReviewTrigger())) {
+      const product = await this.getProduct(review.productId);
+      if (product) {
+        await this.db.update(products)
+          .set({ 
+            reviewCount: (product.reviewCount || 0) + 1,
+            updatedAt: new Date()
+          })
+          .where(eq(products.id, product.id));
+      }
     }
     
     return result[0];
   }
   
+  private hasReviewTrigger(): Promise<boolean> {
+    if (!this.reviewTrigger) {
+      this.reviewTrigger = this.findReviewTrigger();
+      // Look again on the next review if the check itself failed.
+      this.reviewTrigger.catch(() => { this.reviewTrigger = undefined; });
+    }
+    return this.reviewTrigger;
+  }
+  
+  private async findReviewTrigger(): Promise<boolean> {
+    const result = await this.db.execute(sql`
+      SELECT EXISTS (
+        SELECT 1 FROM pg_trigger
+        WHERE tgname = 'trg_reviews_aggregate' AND tgrelid = to_regclass('reviews')
+      ) AS present
+    `);
+    return Boolean(result[0]?.present);
+  }
+  
   async updateReview(id: number, reviewData: Partial<Review>): Promise<Review | undefined> {
     const result = await this.db.update(reviews)
       .set({
@@ -668,38 +696,29 @@ export class PostgresStorage implements IStorage {
   }
   
   async createCart(cart: InsertCart): Promise<Cart> {
-    // Check if user already has a cart
-    const existing = await this.getCartByUserId(cart.userId);
-    if (existing) return existing;
+    // One cart per user (idx_carts_user_unique); a concurrent request may
+    // have created it first, in which case that cart is returned
+    const result = await this.db.insert(carts).values(cart)
+      .onConflictDoNothing({ target: carts.userId })
+      .returning();
+    if (result.length > 0) return result[0];
     
-    // Create new cart
-    const result = await this.db.insert(carts).values(cart).returning();
-    return result[0];
+    const existing = await this.getCartByUserId(cart.userId);
+    return existing!;
   }
   
   async addItemToCart(item: InsertCartItem): Promise<CartItem> {
-    // Check if item already in cart
-    const existing = await this.db.select()
-      .from(cartItems)
-      .where(
-        and(
-          eq(cartItems.cartId, item.cartId),
-          eq(cartItems.productId, item.productId)
-        )
-      )
-      .limit(1);
-    
-    if (existing.length > 0) {
-      // Update quantity
-      const updatedItem = await this.updateCartItem(
-        existing[0].id, 
-        existing[0].quantity + (item.quantity || 1)
-      );
-      return updatedItem!;
-    }
-    
-    // Create new cart item
-    const result = await this.db.insert(cartItems).values(item).returning();
+    // Insert the line, or add to its quantity when the product is already in
+    // the cart (idx_cart_items_cart_product), in a single round trip
+    const result = await this.db.insert(cartItems).values(item)
+      .onConflictDoUpdate({
+        target: [cartItems.cartId, cartItems.productId],
+        set: {
+          quantity: sql`${cartItems.quantity} + excluded.quantity`,
+          updatedAt: new Date()
+        }
+      })
+      .returning();
     return result[0];
   }
   
@@ -759,18 +778,22 @@ export class PostgresStorage implements IStorage {
   }
   
   async createOrder(order: InsertOrder, orderItemsList: InsertOrderItem[]): Promise<Order> {
-    // Create order
-    const [newOrder] = await this.db.insert(orders).values(order).returning();
-    
-    // Create order items
-    for (const item of orderItemsList) {
-      await this.db.insert(orderItems).values({
-        ...item,
-        orderId: newOrder.id
-      });
-    }
-    
-    return newOrder;
+    // Insert the order and its items in one transaction: the order workers
+    // are notified on commit and must see the items along with the order.
+    return await this.db.transaction(async (tx) => {
+      const [newOrder] = await tx.insert(orders).values(order).returning();
+      
+      if (orderItemsList.length > 0) {
+        await tx.insert(orderItems).values(
+          orderItemsList.map(item => ({
+            ...item,
+            orderId: newOrder.id
+          }))
+        );
+      }
+      
+      return newOrder;
+    });
   }
   
   async updateOrderStatus(id: number, status: OrderStatus): Promise<Order | undefined> {